@@ -1,4 +1,5 @@
 import dash
+import flask
 import plotly.graph_objects as go
 from dash import dcc, dash_table
 from dash import html
@@ -7,17 +8,62 @@ from ibapi.contract import Contract
 from ibapi.order import Order
 
 from fintech_ibkr import *
+from fintech_ibkr.durations import parse_end_date_time, parse_duration, \
+    format_end_date_time, duration_for
+from fintech_ibkr.gateway import gateway_address, gateway_client
+from fintech_ibkr.indicators import make_indicator, indicator_from_dict, \
+    compute_indicators, update_indicators, price_indicators
+from fintech_ibkr.jobs import submit_job, job_status, job_result, cancel_job
+from fintech_ibkr.metrics import metrics_content_type
+from fintech_ibkr.order_journal import get_order_journal, journal_columns, \
+    filter_operators
+from fintech_ibkr.resample import downsample_bars
 import pandas as pd
 import datetime
 
+# When server.py runs several worker processes, they all make their IB calls
+#   through one gateway process, which owns the connections and caches.
+if gateway_address() is not None:
+    ibkr_gateway = gateway_client()
+    fetch_contract_details = ibkr_gateway.fetch_contract_details
+    fetch_contract_details_new = ibkr_gateway.fetch_contract_details_new
+    fetch_historical_data = ibkr_gateway.fetch_historical_data
+    fetch_current_time = ibkr_gateway.fetch_current_time
+    place_order = ibkr_gateway.place_order
+    subscribe_historical_bars = ibkr_gateway.subscribe_historical_bars
+    stream_snapshot = ibkr_gateway.stream_snapshot
+    stream_updates = ibkr_gateway.stream_updates
+    # the IB metrics are recorded where the IB calls happen
+    metrics_text = ibkr_gateway.metrics_text
+
 # Make a Dash app!
 app = dash.Dash(__name__)
 
 # ADD this!
 server = app.server
 
-# Read data file
-df = pd.read_csv('submitted_orders.csv')
+
+# Request latencies, in-flight requests, pacing waits, cache hit rates and IB
+#   error codes, for Prometheus to scrape.
+@server.route('/metrics')
+def metrics_endpoint():
+    return flask.Response(metrics_text(), content_type=metrics_content_type)
+
+
+# Submitted orders. The table below is paged, sorted and filtered here on the
+#   server, so the browser only ever receives one page of them.
+journal = get_order_journal()
+orders_page_size = 20
+
+# When streaming, the oldest bars are dropped from the chart past this many.
+stream_max_points = 100000
+
+# When aggregating to the chart width, one candle per this many pixels. The
+#   width is measured in the browser; this is used until it has been.
+chart_pixels_per_bar = 2
+default_chart_width = 1200
+# How long zooming has to pause before the chart is redrawn for the new range.
+zoom_debounce_ms = 300
 
 # Define the layout.
 app.layout = html.Div([
@@ -128,7 +174,7 @@ app.layout = html.Div([
     html.Div(
         ["Choose the size of the bar",
          dcc.Dropdown(
-             ["1 sec", "5 secs", "15 secs", "30 secs", "1 min", "2 mins", "3 mins",
+             ["1 secs", "5 secs", "15 secs", "30 secs", "1 min", "2 mins", "3 mins",
               "5 mins", '15 mins', "30 mins", "1 hour", "1 day"], value="1 day",
              id='bar-size-setting')],
         style={'width': '365px'},
@@ -181,6 +227,51 @@ app.layout = html.Div([
     ),
     # Submit button
     html.Button('Submit', id='submit-button', n_clicks=0),
+    html.Button('Cancel', id='cancel-chart-button', n_clicks=0),
+    # Keep the chart up to date with new bars. Only works when endDateTime is
+    #   left empty, i.e. the chart ends at the present moment.
+    dcc.Checklist(
+        id='stream-live',
+        options=[{'label': 'Stream live bars', 'value': 'stream'}],
+        value=[],
+        style={'display': 'inline-block'}
+    ),
+    dcc.Interval(id='stream-interval', interval=2000, disabled=True),
+    dcc.Store(id='stream-state'),
+    # Long histories are drawn as about one candle per couple of pixels,
+    #   and re-aggregated for the visible range when zooming, down to the
+    #   real bars. Not used while streaming.
+    dcc.Checklist(
+        id='downsample',
+        options=[{'label': 'Aggregate bars to the chart width',
+                  'value': 'downsample'}],
+        value=['downsample'],
+        style={'display': 'inline-block'}
+    ),
+    dcc.Store(id='chart-width'),
+    # What's needed to read the chart's bars again when zooming.
+    dcc.Store(id='chart-view'),
+    # The chart's relayoutData once zooming has paused (see below).
+    dcc.Store(id='chart-zoom'),
+    # Indicators drawn over the chart. RSI and ATR get panes of their own
+    #   below the candles.
+    dcc.Checklist(
+        id='indicators',
+        options=[{'label': 'SMA 20', 'value': 'sma'},
+                 {'label': 'EMA 20', 'value': 'ema'},
+                 {'label': 'Bollinger bands', 'value': 'bollinger'},
+                 {'label': 'VWAP', 'value': 'vwap'},
+                 {'label': 'RSI 14', 'value': 'rsi'},
+                 {'label': 'ATR 14', 'value': 'atr'}],
+        value=[],
+        inline=True
+    ),
+    # New indicator points for streaming charts (see stream_bars).
+    dcc.Store(id='indicator-update'),
+    # The chart is built by a background job; chart-interval polls it until
+    #   it's finished.
+    dcc.Store(id='chart-job'),
+    dcc.Interval(id='chart-interval', interval=500, disabled=True),
     # Line break
     html.Br(),
     # Div to hold the initial instructions and the updated info once submit is pressed
@@ -286,20 +377,39 @@ app.layout = html.Div([
 
     # Submit button for the trade
     html.Button('Trade', id='trade-button', n_clicks=0),
+    # Orders are placed by a background job on their own queue, so they never
+    #   wait behind a slow chart; trade-interval polls it.
+    dcc.Store(id='trade-job'),
+    dcc.Interval(id='trade-interval', interval=500, disabled=True),
     dcc.ConfirmDialog(
         id='confirm-alert',
         message='',
     ),
-    dash_table.DataTable(df.to_dict('records'), [{"name": i, "id": i} for i in df.columns], id='table')
+    dash_table.DataTable(
+        [], [{"name": i, "id": i} for i in journal_columns], id='table',
+        page_current=0,
+        page_size=orders_page_size,
+        page_action='custom',
+        sort_action='custom',
+        sort_mode='multi',
+        sort_by=[],
+        filter_action='custom',
+        filter_query=''
+    ),
+    # Journal id of the newest order; changes after every trade, which
+    #   refreshes the table.
+    dcc.Store(id='journal-cursor', data=0)
 ])
 
 
+# Fetching history can take a while (and a backfill much longer), so this
+#   callback only queues the work as a background job and returns straight
+#   away; poll_chart_job below delivers the figure once the job is done.
 @app.callback(
     [  # there's more than one output here, so you have to use square brackets to pass it in as an array.
         Output(component_id='currency-output', component_property='children'),
-        Output(component_id='candlestick-graph', component_property='figure'),
-        Output(component_id='confirm-alert', component_property='displayed'),
-        Output(component_id='confirm-alert', component_property='message')
+        Output(component_id='chart-job', component_property='data'),
+        Output(component_id='chart-interval', component_property='disabled')
     ],
     Input('submit-button', 'n_clicks'),
     # The callback function will
@@ -311,11 +421,31 @@ app.layout = html.Div([
      State('bar-size-setting', 'value'), State('use-rth', 'value'),
      State('edt-date', 'date'), State('edt-hour', 'value'),
      State('edt-minute', 'value'), State('edt-second', 'value'),
-     State('duration-str-number', 'value'), State('duration-str-unit', 'value')]
+     State('duration-str-number', 'value'), State('duration-str-unit', 'value'),
+     State('stream-live', 'value'), State('chart-job', 'data'),
+     State('downsample', 'value'), State('chart-width', 'data'),
+     State('indicators', 'value')]
 )
 def update_candlestick_graph(n_clicks, currency_string, what_to_show, bar_size_setting, use_rth, edt_date, edt_hour,
-                             edt_minute, edt_second, duration_str_number, duration_str_unit):
+                             edt_minute, edt_second, duration_str_number, duration_str_unit, stream_live, chart_job,
+                             downsample, chart_width, indicators):
     # n_clicks doesn't get used, we only include it for the dependency.
+    # A new query replaces the one still running, if any.
+    if chart_job is not None:
+        cancel_job(chart_job)
+    chart_job = submit_job(
+        'chart', build_candlestick_graph, currency_string, what_to_show,
+        bar_size_setting, use_rth, edt_date, edt_hour, edt_minute, edt_second,
+        duration_str_number, duration_str_unit, stream_live,
+        'downsample' in (downsample or []), chart_width, indicators or [])
+    return ('Fetching ' + currency_string + '...'), chart_job, False
+
+
+# Runs on the chart job queue. Returns the values for poll_chart_job's
+#   outputs.
+def build_candlestick_graph(job, currency_string, what_to_show, bar_size_setting, use_rth, edt_date, edt_hour,
+                            edt_minute, edt_second, duration_str_number, duration_str_unit, stream_live,
+                            downsample=False, chart_width=None, indicators=()):
 
     # First things first -- what currency pair history do you want to fetch?
     # Define it as a contract object!
@@ -351,6 +481,7 @@ def update_candlestick_graph(n_clicks, currency_string, what_to_show, bar_size_s
                         + str(edt_second) + " EST"
 
     duration_str = duration_str_number + " " + duration_str_unit
+    streaming = 'stream' in (stream_live or []) and end_date_time == ''
 
     ############################################################################
     ############################################################################
@@ -364,27 +495,64 @@ def update_candlestick_graph(n_clicks, currency_string, what_to_show, bar_size_s
     # Some default values are provided below to help with your testing.
     # Don't forget -- you'll need to update the signature in this callback
     #   function to include your new vars!
+    if errmsg is None and streaming:
+        # Keep the historical request open; new bars are pushed into the
+        #   figure by stream_bars below.
+        stream = subscribe_historical_bars(
+            contract=contract,
+            durationStr=duration_str,
+            barSizeSetting=bar_size_setting,
+            whatToShow=what_to_show,
+            useRTH=use_rth
+        )
+        cph = stream_snapshot(stream)
+        # The indicators are computed over the history once; stream_bars
+        #   carries on from their state one new bar at a time.
+        states = [make_indicator(name) for name in indicators]
+        completed = with_indicators(cph.iloc[:-1], states)
+        fig = candlestick_figure(completed, forming=cph.iloc[-1:],
+                                 indicators=indicators)
+        fig.update_layout(title=('Exchange Rate: ' + currency_string))
+        stream_state = {'key': stream, 'cursor': max(len(cph) - 1, 0),
+                        'indicators': [state.to_dict() for state in states]}
+        return ('Submitted query for ' + currency_string), fig, False, '', \
+            False, stream_state, None
     if errmsg is None:
+        if end_date_time == '':
+            # pin "now", so zooming reads the same bars again
+            end_date_time = format_end_date_time(parse_end_date_time(''))
         cph = fetch_historical_data(
             contract=contract,
             endDateTime=end_date_time,
             durationStr=duration_str,
             barSizeSetting=bar_size_setting,
             whatToShow=what_to_show,
-            useRTH=use_rth
+            useRTH=use_rth,
+            # Long durations at small bar sizes are fetched in chunks; the
+            #   newest one goes ahead of other backfills, the rest queue
+            #   behind interactive requests at batch priority.
+            priority=interactive_priority,
+            backfill=True,
+            on_progress=lambda windows_done, windows_total: job.report(
+                windows_done, windows_total),
+            is_cancelled=job.cancelled
         )
+        cph = with_indicators(
+            cph, [make_indicator(name) for name in indicators])
+        chart_view = None
+        if downsample:
+            chart_view = {
+                'currency_string': currency_string,
+                'what_to_show': what_to_show,
+                'bar_size_setting': bar_size_setting,
+                'use_rth': use_rth,
+                'end_date_time': end_date_time,
+                'duration_str': duration_str,
+                'indicators': list(indicators),
+            }
+            cph = downsample_bars(cph, max_chart_bars(chart_width))
         # # Make the candlestick figure
-        fig = go.Figure(
-            data=[
-                go.Candlestick(
-                    x=cph['date'],
-                    open=cph['open'],
-                    high=cph['high'],
-                    low=cph['low'],
-                    close=cph['close']
-                )
-            ]
-        )
+        fig = candlestick_figure(cph, indicators=indicators)
     # # Give the candlestick figure a title
         fig.update_layout(title=('Exchange Rate: ' + currency_string))
     else:
@@ -396,7 +564,8 @@ def update_candlestick_graph(n_clicks, currency_string, what_to_show, bar_size_s
         )
         fig.update_layout(title=('Exchange Rate: ' + currency_string))
         print(errmsg)
-        return ('Submitted query for ' + currency_string), fig, True, 'Error: ' + errmsg
+        return ('Submitted query for ' + currency_string), fig, True, 'Error: ' + errmsg, \
+            True, None, None
     ############################################################################
     ############################################################################
 
@@ -424,14 +593,364 @@ def update_candlestick_graph(n_clicks, currency_string, what_to_show, bar_size_s
     ############################################################################
 
     # Return your updated text to currency-output, and the figure to candlestick-graph outputs
-    return ('Submitted query for ' + currency_string), fig, False, ''
+    return ('Submitted query for ' + currency_string), fig, False, '', True, \
+        None, chart_view
+
+
+# Deliver the chart job's figure once it's done, showing its progress until
+#   then.
+@app.callback(
+    Output('currency-output', 'children', allow_duplicate=True),
+    Output('candlestick-graph', 'figure'),
+    Output('confirm-alert', 'displayed'),
+    Output('confirm-alert', 'message'),
+    Output('stream-interval', 'disabled'),
+    Output('stream-state', 'data'),
+    Output('chart-view', 'data'),
+    Output('chart-interval', 'disabled', allow_duplicate=True),
+    Input('chart-interval', 'n_intervals'),
+    State('chart-job', 'data'),
+    prevent_initial_call=True
+)
+def poll_chart_job(n_intervals, chart_job):
+    status = job_status(chart_job)
+    if status is None:
+        return dash.no_update, dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, dash.no_update, dash.no_update, \
+            True
+    if status['status'] in ['queued', 'running']:
+        message = 'Fetching...'
+        if status['progress'] is not None:
+            message = 'Fetching... ' + str(status['progress'][0]) + ' of ' + \
+                str(status['progress'][1]) + ' windows'
+        return message, dash.no_update, dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    if status['status'] == 'cancelled':
+        return 'Query cancelled', dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, dash.no_update, dash.no_update, \
+            True
+    if status['status'] == 'failed':
+        print(status['error'])
+        return 'Query failed', dash.no_update, True, \
+            'Error: ' + status['error'], dash.no_update, dash.no_update, \
+            dash.no_update, True
+    result = job_result(chart_job)
+    if result is None:
+        # Another poll already delivered it.
+        return dash.no_update, dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, dash.no_update, dash.no_update, \
+            True
+    return result + (True,)
+
+
+@app.callback(
+    Output('currency-output', 'children', allow_duplicate=True),
+    Input('cancel-chart-button', 'n_clicks'),
+    State('chart-job', 'data'),
+    prevent_initial_call=True
+)
+def cancel_chart_job(n_clicks, chart_job):
+    if chart_job is None or not cancel_job(chart_job):
+        return dash.no_update
+    return 'Cancelling...'
+
+
+# Trace 0 holds the finished bars. When streaming, trace 1 holds the single
+#   bar that's still forming, so it can be replaced as it changes. The
+#   indicator lines come after those, one per column, in the order the
+#   indicators were picked.
+def candlestick_figure(cph, forming=None, indicators=()):
+    data = [
+        go.Candlestick(
+            x=cph['date'],
+            open=cph['open'],
+            high=cph['high'],
+            low=cph['low'],
+            close=cph['close']
+        )
+    ]
+    if forming is not None:
+        data.append(
+            go.Candlestick(
+                x=forming['date'],
+                open=forming['open'],
+                high=forming['high'],
+                low=forming['low'],
+                close=forming['close'],
+                showlegend=False
+            )
+        )
+    # RSI and ATR have scales of their own, so they get panes below the
+    #   candles, each on its own y axis.
+    panes = [name for name in indicators if name not in price_indicators]
+    for name in indicators:
+        axis = 'y' + str(panes.index(name) + 2) if name in panes else 'y'
+        for column in make_indicator(name).columns:
+            data.append(go.Scatter(x=cph['date'], y=cph[column], name=column,
+                                   mode='lines', line={'width': 1},
+                                   yaxis=axis))
+    fig = go.Figure(data=data)
+    if panes:
+        pane_height = 0.2
+        fig.update_layout(
+            yaxis={'domain': [pane_height * len(panes), 1]},
+            xaxis={'rangeslider': {'visible': False}},
+            **{'yaxis' + str(i + 2): {
+                'domain': [pane_height * (len(panes) - i - 1) + 0.02,
+                           pane_height * (len(panes) - i)],
+                'anchor': 'x', 'title': panes[i].upper()}
+               for i in range(len(panes))}
+        )
+    return fig
+
+
+def with_indicators(cph, states):
+    if not states:
+        return cph
+    return pd.concat([cph, compute_indicators(cph, states)], axis=1)
+
+
+def max_chart_bars(chart_width):
+    return max(1, int(chart_width or default_chart_width) //
+               chart_pixels_per_bar)
+
+
+# The chart's width in pixels, measured in the browser when the page loads
+#   and again on every submit.
+app.clientside_callback(
+    """
+    function(n_clicks) {
+        var graph = document.getElementById('candlestick-graph');
+        return (graph && graph.clientWidth) || window.innerWidth;
+    }
+    """,
+    Output('chart-width', 'data'),
+    Input('submit-button', 'n_clicks')
+)
+
+
+# Scroll-zooming or dragging fires relayoutData many times a second; pass it
+#   on to chart-zoom only once it's been left alone for zoom_debounce_ms,
+#   so the server redraws the chart once per zoom rather than once per event.
+app.clientside_callback(
+    """
+    function(relayout_data) {
+        var zoom = window.chartZoom = (window.chartZoom || 0) + 1;
+        return new Promise(function(resolve) {
+            setTimeout(function() {
+                resolve(zoom === window.chartZoom ? relayout_data
+                        : window.dash_clientside.no_update);
+            }, %d);
+        });
+    }
+    """ % zoom_debounce_ms,
+    Output('chart-zoom', 'data'),
+    Input('candlestick-graph', 'relayoutData'),
+    prevent_initial_call=True
+)
+
+
+# Zooming or panning a downsampled chart reads the bars of the visible range
+#   again and aggregates them to the chart width, so the closer you zoom the
+#   finer the candles get, down to the real bars. Double-clicking back out
+#   shows the whole range again. The bars come from the local bar store only,
+#   where the chart job left them; IB is never asked from here, so a zoom
+#   doesn't wait for (or hold up) anyone's pacing.
+@app.callback(
+    Output('candlestick-graph', 'figure', allow_duplicate=True),
+    Input('chart-zoom', 'data'),
+    State('chart-view', 'data'),
+    State('chart-width', 'data'),
+    prevent_initial_call=True
+)
+def zoom_candlestick_graph(relayout_data, chart_view, chart_width):
+    if not chart_view or not relayout_data:
+        return dash.no_update
+    end = parse_end_date_time(chart_view['end_date_time'])
+    start = end - parse_duration(chart_view['duration_str'])
+    if 'xaxis.range[0]' in relayout_data:
+        x_range = [relayout_data['xaxis.range[0]'],
+                   relayout_data['xaxis.range[1]']]
+    elif 'xaxis.range' in relayout_data:
+        x_range = relayout_data['xaxis.range']
+    elif relayout_data.get('xaxis.autorange'):
+        x_range = None
+    else:
+        return dash.no_update
+
+    end_date_time = chart_view['end_date_time']
+    duration_str = chart_view['duration_str']
+    if x_range is not None:
+        zoom_start = max(pd.Timestamp(x_range[0]).to_pydatetime(), start)
+        zoom_end = min(pd.Timestamp(x_range[1]).to_pydatetime(), end)
+        if zoom_end <= zoom_start:
+            return dash.no_update
+        zoom_duration = duration_for(zoom_end - zoom_start,
+                                     chart_view['bar_size_setting'])
+        # Durations are rounded up; only read less than the whole chart if
+        #   that stays inside what was fetched for it. Indicators need the
+        #   bars before the visible range too, so then it's always all of it.
+        if zoom_end - parse_duration(zoom_duration) >= start and \
+                not chart_view.get('indicators'):
+            end_date_time = format_end_date_time(zoom_end)
+            duration_str = zoom_duration
+
+    currency_string = chart_view['currency_string']
+    contract = Contract()
+    contract.symbol = currency_string.split(".")[0]
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = currency_string.split(".")[1]
+    cph = read_stored_historical_data(
+        contract=contract,
+        endDateTime=end_date_time,
+        durationStr=duration_str,
+        barSizeSetting=chart_view['bar_size_setting'],
+        whatToShow=chart_view['what_to_show'],
+        useRTH=chart_view['use_rth']
+    )
+    if cph.empty:
+        return dash.no_update
+    indicators = chart_view.get('indicators', [])
+    cph = with_indicators(cph, [make_indicator(name) for name in indicators])
+    if x_range is not None:
+        cph = cph[(cph['date'] >= zoom_start) & (cph['date'] <= zoom_end)]
+    fig = candlestick_figure(downsample_bars(cph.reset_index(drop=True),
+                                             max_chart_bars(chart_width)),
+                             indicators=indicators)
+    fig.update_layout(title=('Exchange Rate: ' + currency_string))
+    if x_range is not None:
+        fig.update_xaxes(range=x_range)
+    return fig
+
+
+# Every tick of stream-interval, send the browser only the bars that changed:
+#   finished bars are appended to trace 0 and trace 1 is replaced by the
+#   forming bar (maxPoints of 1), instead of shipping the whole figure again.
+#   Indicator values are worked out for the finished bars only, from the
+#   indicators' state in stream-state, and appended to their lines through
+#   indicator-update (extendData can't mix candlestick and line traces).
+@app.callback(
+    Output('candlestick-graph', 'extendData'),
+    Output('stream-state', 'data', allow_duplicate=True),
+    Output('stream-interval', 'disabled', allow_duplicate=True),
+    Output('indicator-update', 'data'),
+    Input('stream-interval', 'n_intervals'),
+    State('stream-state', 'data'),
+    prevent_initial_call=True
+)
+def stream_bars(n_intervals, stream_state):
+    if not stream_state:
+        return dash.no_update, dash.no_update, True, dash.no_update
+    try:
+        completed, forming, cursor = stream_updates(
+            stream_state['key'], stream_state['cursor'])
+    except Exception as e:
+        # The subscription was dropped (idle, disconnected, ...): stop polling.
+        print(e)
+        return dash.no_update, None, True, dash.no_update
+    if not len(completed) and not len(forming):
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+    states = [indicator_from_dict(state)
+              for state in stream_state.get('indicators', [])]
+    indicator_update = dash.no_update
+    if states and len(completed):
+        values = update_indicators(completed, states)
+        dates = [str(date) for date in completed['date']]
+        indicator_update = [
+            {'x': [dates for column in values.columns],
+             'y': [values[column].tolist() for column in values.columns]},
+            list(range(2, 2 + len(values.columns))),
+            stream_max_points
+        ]
+
+    columns = {'x': 'date', 'open': 'open', 'high': 'high', 'low': 'low',
+               'close': 'close'}
+    update = {}
+    for key, column in columns.items():
+        update[key] = [completed[column].tolist(), forming[column].tolist()]
+    for trace in update['x']:
+        trace[:] = [str(date) for date in trace]
+    max_points = {key: [stream_max_points, 1] for key in columns}
+    return [update, [0, 1], max_points], \
+        {'key': stream_state['key'], 'cursor': cursor,
+         'indicators': [state.to_dict() for state in states]}, \
+        dash.no_update, indicator_update
+
+
+app.clientside_callback(
+    """
+    function(update) {
+        return update || window.dash_clientside.no_update;
+    }
+    """,
+    Output('candlestick-graph', 'extendData', allow_duplicate=True),
+    Input('indicator-update', 'data'),
+    prevent_initial_call=True
+)
+
+
+# Turns the table's filter_query, e.g. "{symbol} contains AUD && {size} > 100",
+#   into [(column, operator, value)] for journal.query_page.
+filter_operator_names = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=',
+                         'gt': '>', 'ge': '>=', 's=': '=', 'scontains': 'contains',
+                         'datestartswith': 'startswith'}
+
+
+def parse_filter_query(filter_query):
+    filters = []
+    for part in (filter_query or '').split(' && '):
+        if not part.strip():
+            continue
+        column, _, rest = part.strip().partition('} ')
+        operator, _, value = rest.partition(' ')
+        operator = filter_operator_names.get(operator, operator)
+        if operator not in filter_operators:
+            continue
+        column = column.lstrip('{')
+        value = value.strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '\'"`':
+            value = value[1:-1]
+        elif operator not in ['contains', 'startswith']:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        filters.append((column, operator, value))
+    return filters
+
+
+# Fetch the page of orders the table is showing.
+@app.callback(
+    Output('table', 'data'),
+    Output('table', 'page_count'),
+    Input('table', 'page_current'),
+    Input('table', 'page_size'),
+    Input('table', 'sort_by'),
+    Input('table', 'filter_query'),
+    Input('journal-cursor', 'data')
+)
+def update_order_table(page_current, page_size, sort_by, filter_query,
+                       journal_cursor):
+    try:
+        rows, total = journal.query_page(
+            page_current or 0, page_size,
+            [(i['column_id'], i['direction']) for i in sort_by or []],
+            parse_filter_query(filter_query)
+        )
+    except Exception as e:
+        print(e)
+        return [], 1
+    return rows, max(1, -(-total // page_size))
 
 
 # Callback for what to do when trade-button is pressed
 @app.callback(
     # We're going to output the result to trade-output
     Output(component_id='trade-output', component_property='children'),
-    Output(component_id='table', component_property='data'),
+    Output('trade-job', 'data'),
+    Output('trade-interval', 'disabled'),
     # We only want to run this callback function when the trade-button is pressed
     Input('trade-button', 'n_clicks'),
     # We DON'T want to run this function whenever buy-or-sell, trade-currency, or trade-amt is updated, so we pass those in as States, not Inputs:
@@ -465,34 +984,59 @@ def trade(n_clicks, action, trade_currency, trade_amt, order_type,
     order.totalQuantity = trade_amt
     if order_type == 'LMT':
         if limit_price is None:
-            return 'Limit price must have a value!'
+            return 'Limit price must have a value!', dash.no_update, \
+                dash.no_update
         order.lmtPrice = limit_price
 
+    trade_job = submit_job('trade', submit_trade, msg, contract, order, symbol,
+                           action, trade_amt, order_type, limit_price)
+    return 'Submitting ' + msg + '...', trade_job, False
+
+
+# Runs on the trade job queue. Returns the values for poll_trade_job's
+#   outputs.
+def submit_trade(job, msg, contract, order, symbol, action, trade_amt,
+                 order_type, limit_price):
     fetch_contract_details_new(contract)
-    file_path = 'submitted_orders.csv'
     info = place_order(contract, order)
     print(info)
 
-    order_id = info['order_id'][0]
-    client_id = info['client_id'][0]
-    perm_id = info['perm_id'][0]
-    con_id = contract.conId
-    timestamp = fetch_current_time()
-    new_data = {'timestamp': [timestamp],
-                'order_id': [order_id],
-                'client_id': [client_id],
-                'perm_id': [perm_id],
-                'con_id': [con_id],
-                'symbol': [symbol],
-                'action': [action],
-                'size': [trade_amt],
-                'order_type': [order_type],
-                'lmt_price': [limit_price]}
-    new_line = pd.DataFrame(new_data)
-    new_line.to_csv(file_path, mode='a', header=False, index=False)
-    df = pd.read_csv(file_path)
-
-    return msg, df.to_dict('records')
+    journal_cursor = journal.append(
+        timestamp=fetch_current_time(),
+        order_id=info['order_id'][0],
+        client_id=info['client_id'][0],
+        perm_id=info['perm_id'][0],
+        con_id=contract.conId,
+        symbol=symbol,
+        action=action,
+        size=trade_amt,
+        order_type=order_type,
+        lmt_price=limit_price
+    )
+
+    return msg, journal_cursor
+
+
+@app.callback(
+    Output('trade-output', 'children', allow_duplicate=True),
+    Output('journal-cursor', 'data'),
+    Output('trade-interval', 'disabled', allow_duplicate=True),
+    Input('trade-interval', 'n_intervals'),
+    State('trade-job', 'data'),
+    prevent_initial_call=True
+)
+def poll_trade_job(n_intervals, trade_job):
+    status = job_status(trade_job)
+    if status is None:
+        return dash.no_update, dash.no_update, True
+    if status['status'] in ['queued', 'running']:
+        return dash.no_update, dash.no_update, dash.no_update
+    if status['status'] != 'done':
+        return 'Error: ' + str(status['error']), dash.no_update, True
+    result = job_result(trade_job)
+    if result is None:
+        return dash.no_update, dash.no_update, True
+    return result + (True,)
 
 
 # Run it!
@@ -0,0 +1,343 @@
+# Benchmarks for the fetch functions, bar ingestion and the chart callback,
+# run against the local IB simulator (fintech_ibkr/simulator.py), so no TWS
+# is needed. From the repo root:
+#   python -m benchmarks.run_benchmarks --output baseline.json
+#   python -m benchmarks.run_benchmarks --baseline baseline.json
+# The second form compares against an earlier run and exits with status 1 if
+# a median latency (p50_ms) or a throughput (*_per_sec) got worse by more than
+# --tolerance. Tail latencies and memory are reported but not compared: over
+# a few dozen samples they're mostly scheduler noise. Timings only mean
+# something next to a run on the same machine, so record the baseline on the
+# machine that compares against it; none is kept in the repo.
+import argparse
+import functools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from ibapi.common import BarData
+from ibapi.contract import Contract
+from ibapi.order import Order
+
+import fintech_ibkr
+from fintech_ibkr import pacing
+from fintech_ibkr.connection_pool import close_all_pools, pools
+from fintech_ibkr.simulator import ib_simulator, simulator_settings
+from fintech_ibkr.synchronous_functions import ibkr_app, bar_columns
+
+bar_counts = [100, 1000, 10000]
+concurrency_levels = [1, 4, 16]
+default_repeat = 50
+default_tolerance = 0.25
+# A median has to be this much slower as well as --tolerance slower to count
+# as a regression, so sub-millisecond timings (a cached lookup, a loopback
+# round trip) don't fail the run over a few microseconds of jitter. It also
+# has to be clear of the noise: the fastest quarter of the new samples
+# (p25_ms) must be slower than the slowest quarter of the baseline's
+# (p75_ms).
+min_regression_ms = 1.0
+# An uncached contract details lookup over loopback (two messages back, like
+# most answers) takes well under a millisecond. Slower than this, plus any
+# --latency, and the numbers would be measuring the socket (a Nagle stall,
+# say) rather than our code, so the run fails instead of recording them.
+max_loopback_round_trip_ms = 5.0
+# The metrics regressions() compares; lower p50_ms and higher *_per_sec are
+# better.
+gated_latency = 'p50_ms'
+gated_throughput = '_per_sec'
+
+
+def fx_contract(symbol='EUR', currency='USD'):
+    contract = Contract()
+    contract.symbol = symbol
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = currency
+    return contract
+
+
+def market_order(quantity=100):
+    order = Order()
+    order.action = 'BUY'
+    order.orderType = 'MKT'
+    order.totalQuantity = quantity
+    return order
+
+
+def percentiles(samples_sec):
+    samples = sorted(sample * 1000 for sample in samples_sec)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    return {'p25_ms': at(0.25), 'p50_ms': at(0.5), 'p75_ms': at(0.75),
+            'p90_ms': at(0.9), 'p99_ms': at(0.99),
+            'mean_ms': statistics.fmean(samples), 'max_ms': samples[-1],
+            'samples': len(samples)}
+
+
+# Calls fn(i) `repeat` times from `concurrency` threads and returns the
+# latency percentiles and throughput.
+def time_calls(fn, repeat, concurrency):
+    def timed(i):
+        started = time.perf_counter()
+        fn(i)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(timed, range(repeat)))
+    result = percentiles(samples)
+    result['calls_per_sec'] = repeat / (time.perf_counter() - started)
+    return result
+
+
+# endDateTime and a 1-minute-bar durationStr that get `bars` bars back from
+# the simulator. Each call ends on a different Tuesday, so there are no
+# Saturday gaps and no two calls are identical.
+def bar_request(bars, i):
+    end = datetime(2024, 1, 2, 12, 0) - i * timedelta(days=7)
+    return end.strftime('%Y%m%d %H:%M:%S'), str(bars * 60 - 60) + ' S'
+
+
+def loopback_round_trip(port, repeat):
+    contract = fx_contract()
+    fintech_ibkr.fetch_contract_details(contract, port=port, use_cache=False)
+    return time_calls(
+        lambda i: fintech_ibkr.fetch_contract_details(
+            contract, port=port, use_cache=False),
+        repeat, 1)
+
+
+def latency_benchmarks(port, repeat):
+    results = {}
+    contract = fx_contract()
+    for concurrency in concurrency_levels:
+        results['contract_details_c' + str(concurrency)] = time_calls(
+            lambda i: fintech_ibkr.fetch_contract_details(
+                contract, port=port, use_cache=False),
+            repeat, concurrency)
+        results['contract_details_cached_c' + str(concurrency)] = time_calls(
+            lambda i: fintech_ibkr.fetch_contract_details(contract,
+                                                          port=port),
+            repeat, concurrency)
+        results['place_order_c' + str(concurrency)] = time_calls(
+            lambda i: fintech_ibkr.place_order(contract, market_order(),
+                                               port=port),
+            repeat, concurrency)
+        for bars in bar_counts:
+            def fetch(i, bars=bars):
+                end_date_time, duration = bar_request(bars, i)
+                fintech_ibkr.fetch_historical_data(
+                    contract, end_date_time, duration, '1 min', port=port,
+                    use_cache=False)
+            results['historical_' + str(bars) + '_bars_c' +
+                    str(concurrency)] = time_calls(fetch, repeat, concurrency)
+
+    # Warm (pooled) against cold connections: the cold case closes the pool
+    # before every call, so each one pays for connect + handshake.
+    def cold_current_time(i):
+        close_all_pools()
+        pools.clear()
+        fintech_ibkr.fetch_current_time(port=port)
+
+    results['current_time_warm'] = time_calls(
+        lambda i: fintech_ibkr.fetch_current_time(port=port), repeat, 1)
+    results['current_time_cold'] = time_calls(cold_current_time, repeat, 1)
+    return results
+
+
+def make_bars(count):
+    bars = []
+    for i in range(count):
+        bar = BarData()
+        bar.date = '20240102  %02d:%02d:00' % (i // 60 % 24, i % 60)
+        bar.open = bar.high = bar.low = bar.close = bar.average = 1.0 + i * 1e-6
+        bar.volume = -1
+        bar.barCount = -1
+        bars.append(bar)
+    return bars
+
+
+# Feeds bars straight into ibkr_app.historicalData / historicalDataEnd, the
+# way the reader thread does, without a socket in the way.
+def ingest(app, reqId, bars):
+    done = app.requests.expect(reqId, 'historical_data', bar_columns)
+    for bar in bars:
+        app.historicalData(reqId, bar)
+    app.historicalDataEnd(reqId, '', '')
+    return done.result
+
+
+def ingestion_benchmarks(port):
+    results = {}
+    app = ibkr_app()
+    for count in [10000, 100000]:
+        bars = make_bars(count)
+        started = time.perf_counter()
+        frame = ingest(app, count, bars)
+        elapsed = time.perf_counter() - started
+        results['historical_data_' + str(count)] = {
+            'bars_per_sec': count / elapsed, 'rows': len(frame)}
+
+    # Memory: what ingesting 100k bars allocates at peak, and what the
+    # resulting frame keeps.
+    bars = make_bars(100000)
+    tracemalloc.start()
+    frame = ingest(app, 1, bars)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results['memory_100k_bars'] = {
+        'peak_bytes': peak,
+        'retained_bytes': current,
+        'frame_bytes': int(frame.memory_usage(deep=True).sum()),
+    }
+
+    # End to end: bars per second through the socket, decoder and app.
+    contract = fx_contract('GBP', 'USD')
+    started = time.perf_counter()
+    frame = fintech_ibkr.fetch_historical_data(
+        contract, '20240105 12:00:00', str(50000 * 60) + ' S', '1 min',
+        port=port, use_cache=False)
+    elapsed = time.perf_counter() - started
+    results['historical_data_socket_50k'] = {
+        'bars_per_sec': len(frame) / elapsed, 'rows': len(frame)}
+    return results
+
+
+# Times the chart callback's work (contract lookup, history fetch, figure
+# build) and the JSON encoding Dash does on the figure it returns.
+def dash_benchmarks(port, repeat):
+    import plotly.io
+    import app
+    from fintech_ibkr.jobs import job
+
+    # The callbacks use the default port; point them at the simulator.
+    for name in ['fetch_contract_details', 'fetch_historical_data']:
+        setattr(app, name, functools.partial(getattr(fintech_ibkr, name),
+                                             port=port))
+    results = {}
+    for duration, bar_size in [('5 D', '1 hour'), ('2 D', '1 min')]:
+        build_samples, encode_samples = [], []
+        for i in range(repeat):
+            started = time.perf_counter()
+            outputs = app.build_candlestick_graph(
+                job('bench', 'chart'), 'EUR.USD', 'MIDPOINT', bar_size, '1',
+                '2024-01-05', 12, 0, 0, duration.split()[0],
+                duration.split()[1], [])
+            build_samples.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            plotly.io.to_json(outputs[1])
+            encode_samples.append(time.perf_counter() - started)
+        name = 'update_candlestick_graph_' + duration.replace(' ', '') + \
+            '_' + bar_size.replace(' ', '')
+        results[name] = percentiles(build_samples)
+        results[name + '_json'] = percentiles(encode_samples)
+    return results
+
+
+# Medians and throughputs in `results` that are worse than in `baseline` by
+# more than `tolerance` (a fraction); medians also by more than
+# min_regression_ms and by more than the two runs' spread.
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if not isinstance(before, (int, float)) or not before:
+                continue
+            if metric == gated_latency:
+                if value - before <= min_regression_ms or \
+                        metrics.get('p25_ms', value) <= \
+                        baseline[name].get('p75_ms', before):
+                    continue
+                change = (value - before) / before
+            elif metric.endswith(gated_throughput):
+                change = (before - value) / before
+            else:
+                continue
+            if change > tolerance:
+                found.append({'benchmark': name, 'metric': metric,
+                              'baseline': before, 'value': value,
+                              'worse_by': change})
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the fetch functions against the IB simulator')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--baseline', help='JSON from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance)
+    parser.add_argument('--repeat', type=int, default=default_repeat)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated gateway latency in seconds')
+    parser.add_argument('--only', choices=['latency', 'ingestion', 'dash'],
+                        action='append')
+    args = parser.parse_args()
+    output = args.output and os.path.abspath(args.output)
+    baseline_path = args.baseline and os.path.abspath(args.baseline)
+
+    # The simulator doesn't enforce pacing, so neither do we: these numbers
+    # are about our side of the socket, not IB's rate limits.
+    pacing.identical_request_sec = 0
+    pacing.same_contract_requests = sys.maxsize
+    pacing.historical_scheduler.max_requests = sys.maxsize
+
+    # The bar store, order journal and job store are created in the working
+    # directory; keep them out of the repo.
+    os.chdir(tempfile.mkdtemp(prefix='fintech_ibkr_bench_'))
+    simulator = ib_simulator(port=0, settings=simulator_settings(
+        latency_sec=args.latency, pacing_limit=None, max_bars=1000000,
+        fill_delay_sec=0.0)).start()
+
+    round_trip = loopback_round_trip(simulator.port, args.repeat)
+    limit_ms = max_loopback_round_trip_ms + args.latency * 1000
+    if round_trip['p50_ms'] > limit_ms:
+        simulator.stop()
+        sys.exit('loopback round trip took %.1f ms (p50), more than %.1f ms; '
+                 'not recording results' % (round_trip['p50_ms'], limit_ms))
+
+    only = args.only or ['latency', 'ingestion', 'dash']
+    results = {'loopback_round_trip': round_trip}
+    if 'latency' in only:
+        results.update(latency_benchmarks(simulator.port, args.repeat))
+    if 'ingestion' in only:
+        results.update(ingestion_benchmarks(simulator.port))
+    if 'dash' in only:
+        results.update(dash_benchmarks(simulator.port, args.repeat))
+    simulator.stop()
+
+    report = {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'simulated_latency_sec': args.latency,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)['results']
+        report['regressions'] = regressions(results, baseline,
+                                            args.tolerance)
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
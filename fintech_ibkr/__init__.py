@@ -1 +1,4 @@
-from fintech_ibkr.synchronous_functions import *
\ No newline at end of file
+from fintech_ibkr.synchronous_functions import *
+from fintech_ibkr.asynchronous_functions import *
+from fintech_ibkr.streaming import *
+from fintech_ibkr.market_data import *
@@ -0,0 +1,148 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from fintech_ibkr.connection_pool import get_pool
+from fintech_ibkr.contract_cache import contract_cache
+from fintech_ibkr.contract_keys import contract_key
+from fintech_ibkr.synchronous_functions import ibkr_app, default_hostname, \
+    default_port, default_client_id, timeout_sec, historical_timeout_sec, \
+    order_timeout_sec, contract_details_result, historical_pacing_keys
+from fintech_ibkr.pacing import historical_scheduler, interactive_priority
+
+# asyncio counterparts of the functions in synchronous_functions.py. They use
+# the same pooled connections; the only threads involved are the connections'
+# own run() reader threads, which resolve asyncio futures through
+# call_soon_threadsafe when a request finishes. Awaiting a request doesn't
+# tie up an OS thread.
+
+
+@asynccontextmanager
+async def ibkr_session_async(hostname=default_hostname, port=default_port,
+                             client_id=default_client_id):
+    pool = get_pool(ibkr_app, hostname, port, client_id)
+    app = pool.try_acquire()
+    if app is None:
+        # Only opening a brand-new connection blocks, so only that goes
+        # through the executor.
+        app = await asyncio.get_running_loop().run_in_executor(
+            None, pool.acquire, timeout_sec)
+    try:
+        yield app
+    finally:
+        pool.release(app)
+
+
+# Waits for a request_state from ibkr_app's start_* methods to finish.
+# Returns False on timeout, like request_completion.wait().
+async def wait_for_request(done, timeout):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve():
+        if not future.done():
+            future.set_result(None)
+
+    def on_done(completion):
+        # Runs on the reader thread; the loop may be gone if we gave up.
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(resolve)
+
+    done.add_done_callback(on_done)
+    try:
+        await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+async def fetch_managed_accounts_async(hostname=default_hostname,
+                                       port=default_port,
+                                       client_id=default_client_id):
+    async with ibkr_session_async(hostname, port, client_id) as app:
+        return app.managed_accounts
+
+
+async def fetch_contract_details_async(contract, hostname=default_hostname,
+                                       port=default_port,
+                                       client_id=default_client_id,
+                                       use_cache=True):
+    key = contract_key(contract)
+    if use_cache:
+        cached = contract_cache.get(key)
+        if cached is not None:
+            return cached
+    async with ibkr_session_async(hostname, port, client_id) as app:
+        tickerId, done = app.start_contract_details(contract)
+        if not await wait_for_request(done, timeout_sec):
+            app.requests.discard(tickerId)
+            raise Exception(
+                "fetch_contract_details_async",
+                "timeout",
+                "contract_details not received"
+            )
+    return contract_details_result(done, key)
+
+
+async def fetch_historical_data_async(contract, endDateTime='',
+                                      durationStr='30 D',
+                                      barSizeSetting='1 hour',
+                                      whatToShow='MIDPOINT', useRTH=True,
+                                      hostname=default_hostname,
+                                      port=default_port,
+                                      client_id=default_client_id,
+                                      priority=interactive_priority):
+    identical, same_contract = historical_pacing_keys(
+        contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH)
+    await historical_scheduler.acquire_async(identical, same_contract,
+                                             priority)
+    async with ibkr_session_async(hostname, port, client_id) as app:
+        tickerId, done = app.start_historical_data(
+            contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+            useRTH)
+        if not await wait_for_request(done, historical_timeout_sec):
+            app.requests.discard(tickerId)
+            app.cancelHistoricalData(tickerId)
+            raise Exception(
+                "fetch_historical_data_async",
+                "timeout",
+                "historical_data not received"
+            )
+        if done.error is not None:
+            if 'pacing violation' in done.error[1].lower():
+                historical_scheduler.report_violation()
+            raise Exception(
+                "fetch_historical_data_async", "error", done.error[1])
+        return done.result
+
+
+async def fetch_current_time_async(hostname=default_hostname,
+                                   port=default_port,
+                                   client_id=default_client_id):
+    async with ibkr_session_async(hostname, port, client_id) as app:
+        key, done = app.start_current_time()
+        if not await wait_for_request(done, timeout_sec):
+            app.requests.discard(key)
+            raise Exception(
+                "fetch_current_time_async",
+                "timeout",
+                "current_time not received"
+            )
+        if done.error is not None:
+            raise Exception("fetch_current_time_async", "error", done.error[1])
+        return done.result
+
+
+async def place_order_async(contract, order, hostname=default_hostname,
+                            port=default_port, client_id=default_client_id):
+    async with ibkr_session_async(hostname, port, client_id) as app:
+        orderId, done = app.start_order(contract, order)
+        if not await wait_for_request(done, order_timeout_sec):
+            app.orders.forget(orderId, done)
+            raise Exception(
+                "place_order_async",
+                "timeout",
+                "order was not Submitted or Filled"
+            )
+        if done.error is not None:
+            raise Exception("place_order_async", "error", done.error[1])
+        return app.orders.frame([orderId])
@@ -0,0 +1,137 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pandas as pd
+
+from fintech_ibkr.durations import format_end_date_time, duration_for, \
+    normalize_bar_size
+from fintech_ibkr.pacing import interactive_priority, batch_priority
+
+# The longest durationStr IB will serve in one reqHistoricalData call for each
+# barSizeSetting offered by the app.
+max_window_per_bar_size = {
+    '1 secs': timedelta(seconds=1800),
+    '5 secs': timedelta(seconds=3600),
+    '15 secs': timedelta(seconds=14400),
+    '30 secs': timedelta(seconds=28800),
+    '1 min': timedelta(days=1),
+    '2 mins': timedelta(days=2),
+    '3 mins': timedelta(weeks=1),
+    '5 mins': timedelta(weeks=1),
+    '15 mins': timedelta(weeks=2),
+    '30 mins': timedelta(days=30),
+    '1 hour': timedelta(days=30),
+    '1 day': timedelta(days=365),
+}
+backfill_workers = 4
+
+
+def max_window(barSizeSetting):
+    return max_window_per_bar_size.get(normalize_bar_size(barSizeSetting),
+                                       timedelta(days=1))
+
+
+# [start, end] cut into IB-sized (window_start, window_end) pieces, newest
+# first so the bars a chart shows first arrive first.
+def split_windows(start, end, barSizeSetting):
+    step = max_window(barSizeSetting)
+    windows = []
+    window_end = end
+    while window_end > start:
+        window_start = max(start, window_end - step)
+        windows.append((window_start, window_end))
+        window_end = window_start
+    return windows
+
+
+# Fetches a long range of history as many IB-legal windows at once. Each
+# window goes through fetch_window (fetch_historical_window, which waits for
+# pacing clearance), so running them concurrently never exceeds IB's limits.
+# Only the newest window asks for pacing at `priority`; the rest go at
+# batch_priority, so a long backfill doesn't hold up interactive requests
+# queued behind it.
+# Finished windows are kept: if some fail, run() raises after the others are
+# done, and calling run() again only fetches what's still missing.
+class backfill_job:
+    def __init__(self, fetch_window, contract, start, end, barSizeSetting,
+                 whatToShow, useRTH, workers=backfill_workers,
+                 priority=interactive_priority, on_window=None,
+                 on_progress=None, is_cancelled=None):
+        self.fetch_window = fetch_window
+        self.contract = contract
+        self.start = pd.Timestamp(start)
+        self.end = pd.Timestamp(end)
+        self.barSizeSetting = barSizeSetting
+        self.whatToShow = whatToShow
+        self.useRTH = useRTH
+        self.workers = workers
+        self.priority = priority
+        # on_window(window_start, window_end, bars) after each window,
+        # on_progress(windows_done, windows_total) to report progress, and
+        # windows not yet started are skipped once is_cancelled() is true.
+        self.on_window = on_window
+        self.on_progress = on_progress
+        self.is_cancelled = is_cancelled
+        self.windows = split_windows(self.start, self.end, barSizeSetting)
+        self.results = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def pending(self):
+        return [window for window in self.windows
+                if window not in self.results]
+
+    def run(self):
+        pending = self.pending()
+        self.failures = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for window, future in [
+                    (window, executor.submit(self.fetch, window))
+                    for window in pending]:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.failures[window] = e
+        if self.failures:
+            raise Exception(
+                "backfill_job",
+                "incomplete",
+                str(len(self.failures)) + " of " + str(len(self.windows)) +
+                " windows failed; call run() again to resume"
+            )
+        return self.frame()
+
+    def fetch(self, window):
+        window_start, window_end = window
+        if self.is_cancelled is not None and self.is_cancelled():
+            raise Exception("backfill_job", "cancelled", "backfill cancelled")
+        bars = self.fetch_window(
+            self.contract, format_end_date_time(window_end),
+            duration_for(window_end - window_start, self.barSizeSetting),
+            self.barSizeSetting, self.whatToShow, self.useRTH,
+            priority=self.window_priority(window))
+        if self.on_window is not None:
+            self.on_window(window_start, window_end, bars)
+        with self.lock:
+            self.results[window] = bars
+            done = len(self.results)
+        if self.on_progress is not None:
+            self.on_progress(done, len(self.windows))
+
+    def window_priority(self, window):
+        if window == self.windows[0]:
+            return self.priority
+        return max(self.priority, batch_priority)
+
+    # All bars fetched so far as one frame, sorted by date, with the bars
+    # that adjacent windows both returned only appearing once.
+    def frame(self):
+        frames = [bars for bars in self.results.values() if len(bars)]
+        if not frames:
+            return pd.DataFrame(columns=next(iter(self.results.values()),
+                                             pd.DataFrame()).columns)
+        bars = pd.concat(frames, ignore_index=True)
+        bars = bars[(bars['date'] >= self.start) & (bars['date'] <= self.end)]
+        return bars.drop_duplicates('date', keep='last') \
+            .sort_values('date', ignore_index=True)
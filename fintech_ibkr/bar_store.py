@@ -0,0 +1,159 @@
+import sqlite3
+import threading
+
+import pandas as pd
+
+from fintech_ibkr.contract_keys import contract_key
+from fintech_ibkr.durations import normalize_bar_size
+
+default_bar_store_path = 'historical_bars.sqlite'
+
+store_columns = ['open', 'high', 'low', 'close', 'volume', 'bar_count',
+                 'average']
+
+
+def to_epoch_seconds(moment):
+    return int(pd.Timestamp(moment).value // 10 ** 9)
+
+
+# Local SQLite cache of historical bars. A "series" is one
+# (contract, barSizeSetting, whatToShow, useRTH) combination. Besides the
+# bars themselves it remembers which time ranges of each series have already
+# been fetched from IB, so fetch_historical_data only has to ask IB for the
+# parts of a request that fall outside them. Ranges fetched out of order (by
+# a backfill, say) are kept separately and merged once they touch.
+class bar_store:
+    def __init__(self, path=default_bar_store_path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+
+    # sqlite3 connections can't be shared between threads, so each thread
+    # (e.g. each waitress worker) gets its own.
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS bars ('
+                'series TEXT, time INTEGER, open REAL, high REAL, low REAL, '
+                'close REAL, volume REAL, bar_count INTEGER, average REAL, '
+                'PRIMARY KEY (series, time)) WITHOUT ROWID'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS coverage_ranges ('
+                'series TEXT, start INTEGER, end INTEGER, '
+                'PRIMARY KEY (series, start))'
+            )
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def series_key(self, contract, barSizeSetting, whatToShow, useRTH):
+        return '|'.join(str(i) for i in contract_key(contract)) + '|' + \
+            '|'.join([normalize_bar_size(barSizeSetting), whatToShow,
+                      str(int(bool(int(useRTH))))])
+
+    def coverage(self, series):
+        rows = self.connection().execute(
+            'SELECT start, end FROM coverage_ranges WHERE series = ? '
+            'ORDER BY start', (series,)
+        ).fetchall()
+        return [(pd.Timestamp(start, unit='s'), pd.Timestamp(end, unit='s'))
+                for start, end in rows]
+
+    # The (start, end) ranges of [start, end] that haven't been fetched yet.
+    # Gaps shorter than min_gap (usually one bar) aren't worth an IB request,
+    # except after `settled`: bars from there on may still have been forming
+    # when they were fetched, so that part is always missing.
+    def missing_ranges(self, series, start, end, min_gap, settled=None):
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        covered = self.coverage(series)
+        if settled is not None:
+            settled = pd.Timestamp(settled)
+            covered = [(a, min(b, settled)) for a, b in covered if a < settled]
+        covered = [(a, b) for a, b in covered if a <= end and b >= start]
+        if not covered:
+            return [(start, end)]
+        missing = []
+        cursor = start
+        for a, b in covered:
+            if a - cursor >= min_gap:
+                missing.append((cursor, a))
+            cursor = max(cursor, b)
+        if end - cursor >= min_gap or \
+                (settled is not None and end > max(cursor, settled)):
+            missing.append((cursor, end))
+        return missing
+
+    def read(self, series, start, end):
+        frame = pd.read_sql_query(
+            'SELECT time, ' + ', '.join(store_columns) + ' FROM bars '
+            'WHERE series = ? AND time >= ? AND time <= ? ORDER BY time',
+            self.connection(),
+            params=(series, to_epoch_seconds(start), to_epoch_seconds(end))
+        )
+        frame.insert(0, 'date', pd.to_datetime(frame.pop('time'), unit='s'))
+        return frame
+
+    # Saves the bars IB returned for [start, end] and marks that range as
+    # covered, merging it with any covered ranges it overlaps or touches.
+    # Bars after `settled` are saved but not marked covered (see
+    # missing_ranges).
+    def write(self, series, bars, start, end, settled=None):
+        if settled is not None:
+            end = min(pd.Timestamp(end), pd.Timestamp(settled))
+        times = bars['date'].values.astype('datetime64[s]').astype('int64')
+        rows = zip(
+            [series] * len(bars), times.tolist(),
+            *(pd.to_numeric(bars[column]).astype(float).tolist()
+              for column in store_columns)
+        )
+        start, end = to_epoch_seconds(start), to_epoch_seconds(end)
+        connection = self.connection()
+        with self.write_lock, connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?, '
+                '?)', rows
+            )
+            if end <= start:
+                return
+            rows = connection.execute(
+                'SELECT start, end FROM coverage_ranges WHERE series = ? '
+                'AND start <= ? AND end >= ?', (series, end, start)
+            ).fetchall()
+            for row in rows:
+                start, end = min(start, row[0]), max(end, row[1])
+            connection.execute(
+                'DELETE FROM coverage_ranges WHERE series = ? '
+                'AND start <= ? AND end >= ?', (series, end, start)
+            )
+            connection.execute(
+                'INSERT OR REPLACE INTO coverage_ranges VALUES (?, ?, ?)',
+                (series, start, end)
+            )
+
+    def clear(self, series=None):
+        connection = self.connection()
+        with self.write_lock, connection:
+            if series is None:
+                connection.execute('DELETE FROM bars')
+                connection.execute('DELETE FROM coverage_ranges')
+            else:
+                connection.execute('DELETE FROM bars WHERE series = ?',
+                                   (series,))
+                connection.execute(
+                    'DELETE FROM coverage_ranges WHERE series = ?', (series,))
+
+
+bar_stores = {}
+bar_stores_lock = threading.Lock()
+
+
+def get_bar_store(path=default_bar_store_path):
+    with bar_stores_lock:
+        if path not in bar_stores:
+            bar_stores[path] = bar_store(path)
+        return bar_stores[path]
@@ -0,0 +1,172 @@
+import atexit
+import os
+import tempfile
+import threading
+import time
+
+# Client ids this app may use, as a range starting at the pool's client_id.
+# Each connection takes one, so this bounds how many connections all
+# processes on this machine can have open to IB at once.
+client_id_range_size = 32
+# TWS/IB Gateway answers a connect with this error when another program is
+# already connected with the same client id.
+client_id_in_use_error = 326
+default_lease_dir = os.path.join(tempfile.gettempdir(),
+                                 'fintech_ibkr_client_ids')
+# A reclaim lock (or a lease file with no pid in it yet) older than this was
+# left behind by a crashed process.
+stale_lock_sec = 10
+
+
+# Whether a process with this pid is running. os.kill(pid, 0) would
+# terminate the process on Windows, so that's done with OpenProcess instead.
+def pid_alive(pid):
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.OpenProcess.restype = wintypes.HANDLE
+        process_query_limited_information = 0x1000
+        still_active = 259
+        error_access_denied = 5
+        handle = kernel32.OpenProcess(process_query_limited_information,
+                                      False, pid)
+        if not handle:
+            # access denied means it exists but belongs to someone else
+            return ctypes.get_last_error() == error_access_denied
+        try:
+            exit_code = wintypes.DWORD()
+            if not kernel32.GetExitCodeProcess(handle,
+                                               ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == still_active
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Hands out client ids from [first, first + count) so that no two
+# connections on this machine, in this process or any other, use the same
+# one. A lease is a file named after the client id, created with O_EXCL and
+# holding the owner's pid; leases whose owner has died are reclaimed.
+class client_id_allocator:
+    def __init__(self, first, count=client_id_range_size,
+                 lease_dir=default_lease_dir):
+        self.first = int(first)
+        self.count = count
+        self.lease_dir = lease_dir
+        self.held = set()
+        self.lock = threading.Lock()
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def lease_path(self, client_id):
+        return os.path.join(self.lease_dir, str(client_id) + '.lease')
+
+    def lease(self, skip=()):
+        with self.lock:
+            for client_id in range(self.first, self.first + self.count):
+                if client_id in self.held or client_id in skip:
+                    continue
+                if self.create_lease(client_id) or \
+                        self.reclaim_lease(client_id):
+                    self.held.add(client_id)
+                    return client_id
+        raise Exception(
+            "client_id_allocator",
+            "error",
+            "no free client id in " + str(self.first) + "-" +
+            str(self.first + self.count - 1)
+        )
+
+    def release(self, client_id):
+        with self.lock:
+            if client_id not in self.held:
+                return
+            self.held.discard(client_id)
+            try:
+                os.remove(self.lease_path(client_id))
+            except OSError:
+                pass
+
+    def release_all(self):
+        for client_id in list(self.held):
+            self.release(client_id)
+
+    def create_lease(self, client_id):
+        try:
+            fd = os.open(self.lease_path(client_id),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+
+    # Takes over the lease if its owner is gone. Only one process reclaims at
+    # a time, so two can't both delete the dead lease and then each think the
+    # new one is theirs.
+    def reclaim_lease(self, client_id):
+        lock_path = os.path.join(self.lease_dir, 'reclaim.lock')
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if self.age(lock_path) > stale_lock_sec:
+                self.remove(lock_path)
+            return False
+        os.close(fd)
+        try:
+            path = self.lease_path(client_id)
+            try:
+                with open(path) as f:
+                    pid = f.read().strip()
+            except FileNotFoundError:
+                return self.create_lease(client_id)
+            if pid.isdigit():
+                # our own pid on a lease we don't hold: left over from before
+                # a fork, or a pid the OS has recycled
+                stale = int(pid) == os.getpid() or not pid_alive(int(pid))
+            else:
+                stale = self.age(path) > stale_lock_sec
+            if not stale:
+                return False
+            self.remove(path)
+            return self.create_lease(client_id)
+        finally:
+            self.remove(lock_path)
+
+    def age(self, path):
+        try:
+            return time.time() - os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+allocators = {}
+allocators_lock = threading.Lock()
+
+
+def get_client_id_allocator(first, count=client_id_range_size):
+    key = (int(first), count)
+    with allocators_lock:
+        if key not in allocators:
+            allocators[key] = client_id_allocator(first, count)
+        return allocators[key]
+
+
+@atexit.register
+def release_all_client_ids():
+    with allocators_lock:
+        for allocator in allocators.values():
+            allocator.release_all()
@@ -0,0 +1,49 @@
+from collections import deque
+
+import pandas as pd
+
+
+# Append-only column store for the rows that the ibkr_app callbacks receive
+# one at a time (bars, errors, order statuses). Appending is just a list
+# append per column; the DataFrame is only built once, in to_frame(), instead
+# of pd.concat-ing a one-row frame for every callback.
+# With maxlen, only the newest maxlen rows are kept, for buffers that live as
+# long as a connection rather than a request.
+class columnar_buffer:
+    def __init__(self, columns, maxlen=None):
+        self.columns = list(columns)
+        self.maxlen = maxlen
+        self.clear()
+
+    def clear(self):
+        if self.maxlen is None:
+            self.data = {column: [] for column in self.columns}
+        else:
+            self.data = {column: deque(maxlen=self.maxlen)
+                         for column in self.columns}
+        self.appenders = [self.data[column].append for column in self.columns]
+
+    def append(self, *values):
+        for append, value in zip(self.appenders, values):
+            append(value)
+
+    def __len__(self):
+        return len(self.data[self.columns[0]])
+
+    def to_frame(self):
+        data = self.data
+        if self.maxlen is not None:
+            data = {column: list(values) for column, values in data.items()}
+        return pd.DataFrame(data, columns=self.columns)
+
+
+# IB sends bar dates as strings: 'yyyyMMdd' for daily bars, 'yyyyMMdd
+# HH:mm:ss' (sometimes followed by a time zone) for intraday bars, or epoch
+# seconds when formatDate=2. Parse the whole column in one vectorized pass.
+def parse_bar_dates(dates):
+    dates = pd.Series(dates, dtype='object').astype(str).str.split()
+    day = dates.str[0]
+    if len(day) and day.str.len().ne(8).all():
+        return pd.to_datetime(day.astype('int64'), unit='s')
+    time_of_day = dates.str[1].fillna('00:00:00')
+    return pd.to_datetime(day + ' ' + time_of_day, format='%Y%m%d %H:%M:%S')
@@ -0,0 +1,250 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+from fintech_ibkr.client_ids import get_client_id_allocator, \
+    client_id_in_use_error
+from fintech_ibkr.metrics import metrics
+
+# How many connections each (hostname, port, client_id) pool may open. Every
+# connection needs its own client id, which the pool leases from the range
+# starting at client_id, so pools in other processes never pick the same one.
+default_pool_size = 4
+# Requests are multiplexed by reqId, so a connection is shared by many
+# callers; another one is only opened once this many are in flight on each.
+max_requests_per_connection = 50
+connect_timeout_sec = 5
+# How many client ids to try when IB says the one we leased is taken (by a
+# program that doesn't use our leases).
+client_id_attempts = 5
+
+connect_seconds = metrics.histogram(
+    'ibkr_connect_seconds',
+    'Time to open a socket to IB and agree on a server version')
+handshake_seconds = metrics.histogram(
+    'ibkr_handshake_seconds',
+    'Time from starting to connect until IB sent nextValidId')
+connect_failures = metrics.counter(
+    'ibkr_connect_failures_total', 'Connections to IB that failed',
+    ['reason'])
+
+
+# Keeps long-lived ibkr_app connections around so the fetch functions don't
+# pay for connect -> run() thread -> nextValidId -> disconnect on every call.
+# Callers borrow the least busy connection with acquire() and hand it back
+# with release(); connections that have dropped are replaced on demand.
+class ibkr_connection_pool:
+    def __init__(self, app_class, hostname, port, client_id,
+                 size=default_pool_size):
+        self.app_class = app_class
+        self.hostname = hostname
+        self.port = int(port)
+        self.client_ids = get_client_id_allocator(client_id)
+        self.free_slots = size
+        # connected app -> number of callers currently using it
+        self.connections = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=connect_timeout_sec):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                self._drop_closed()
+                app = min(self.connections, key=self.connections.get,
+                          default=None)
+                if app is not None and (
+                        self.connections[app] < max_requests_per_connection
+                        or not self.free_slots):
+                    self.connections[app] += 1
+                    return app
+                if self.free_slots:
+                    self.free_slots -= 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    raise Exception(
+                        "ibkr_connection_pool",
+                        "timeout",
+                        "no IBKR connection became available"
+                    )
+        try:
+            app = self._connect()
+        except Exception:
+            with self.condition:
+                self.free_slots += 1
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self.connections[app] = 1
+        return app
+
+    # Returns a warm connection without blocking, or None if getting one would
+    # mean opening a new connection or waiting for one.
+    def try_acquire(self):
+        with self.condition:
+            self._drop_closed()
+            app = min(self.connections, key=self.connections.get, default=None)
+            if app is None or (
+                    self.connections[app] >= max_requests_per_connection
+                    and self.free_slots):
+                return None
+            self.connections[app] += 1
+            return app
+
+    def release(self, app):
+        with self.condition:
+            if app in self.connections:
+                self.connections[app] -= 1
+            self._drop_closed()
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            connections = list(self.connections)
+        for app in connections:
+            app.disconnect()
+        with self.condition:
+            self._drop_closed()
+
+    def in_flight(self):
+        with self.condition:
+            return sum(self.connections.values())
+
+    def apps(self):
+        with self.condition:
+            return list(self.connections)
+
+    @contextmanager
+    def session(self, timeout=connect_timeout_sec):
+        app = self.acquire(timeout)
+        try:
+            yield app
+        finally:
+            self.release(app)
+
+    # Must be called with self.condition held.
+    def _drop_closed(self):
+        for app in [app for app in self.connections if not app.isConnected()]:
+            del self.connections[app]
+            self.free_slots += 1
+            self.client_ids.release(app.clientId)
+
+    # Connects with a freshly leased client id, moving on to another one if
+    # IB rejects it as already in use.
+    def _connect(self):
+        rejected = []
+        try:
+            for attempt in range(client_id_attempts):
+                client_id = self.client_ids.lease(skip=rejected)
+                try:
+                    return self._connect_as(client_id)
+                except Exception as e:
+                    if e.args[1:2] != ("client_id_in_use",):
+                        self.client_ids.release(client_id)
+                        raise
+                    rejected.append(client_id)
+            raise Exception(
+                "ibkr_connection_pool",
+                "error",
+                "every client id tried was already in use"
+            )
+        finally:
+            for client_id in rejected:
+                self.client_ids.release(client_id)
+
+    def _connect_as(self, client_id):
+        app = self.app_class()
+        handshake = app.requests.expect('next_valid_id')
+        started = time.monotonic()
+        app.connect(self.hostname, self.port, client_id)
+        if not app.isConnected():
+            connect_failures.inc(reason='error')
+            raise Exception(
+                "ibkr_connection_pool",
+                "error",
+                "couldn't connect to IBKR"
+            )
+        connect_seconds.observe(time.monotonic() - started)
+
+        api_thread = threading.Thread(target=app.run, daemon=True)
+        api_thread.start()
+        if not handshake.wait(connect_timeout_sec) or \
+                handshake.error is not None:
+            app.disconnect()
+            if handshake.error is not None and \
+                    handshake.error[0] == client_id_in_use_error:
+                connect_failures.inc(reason='client_id_in_use')
+                raise Exception(
+                    "ibkr_connection_pool",
+                    "client_id_in_use",
+                    "client id " + str(client_id) + " is already in use"
+                )
+            connect_failures.inc(reason='timeout')
+            raise Exception(
+                "ibkr_connection_pool",
+                "timeout",
+                "next_valid_id not received"
+            )
+        handshake_seconds.observe(time.monotonic() - started)
+        return app
+
+
+pools = {}
+pools_lock = threading.Lock()
+exit_watcher = None
+
+
+def get_pool(app_class, hostname, port, client_id, size=default_pool_size):
+    global exit_watcher
+    key = (hostname, int(port), int(client_id))
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ibkr_connection_pool(
+                app_class, hostname, port, client_id, size)
+        if exit_watcher is None:
+            exit_watcher = threading.Thread(target=close_pools_on_exit,
+                                            daemon=True)
+            exit_watcher.start()
+        return pools[key]
+
+
+# ibapi's reader thread isn't a daemon thread, and the interpreter waits for
+# those before it runs atexit handlers, so open connections would keep the
+# process alive forever. Close them as soon as the main thread is done.
+def close_pools_on_exit():
+    threading.main_thread().join()
+    close_all_pools()
+
+
+# Per hostname and port, summed over the pools (client ids) for it.
+def per_address(count):
+    with pools_lock:
+        pool_list = list(pools.items())
+    counts = {}
+    for (hostname, port, client_id), pool in pool_list:
+        counts[(hostname, port)] = counts.get((hostname, port), 0) + \
+            count(pool)
+    return counts
+
+
+def pool_connections():
+    return per_address(lambda pool: len(pool.apps()))
+
+
+def pool_sessions():
+    return per_address(lambda pool: pool.in_flight())
+
+
+metrics.gauge('ibkr_connections', 'Open connections to IB',
+              ['hostname', 'port']).set_function(pool_connections)
+metrics.gauge('ibkr_pool_sessions',
+              'Callers currently holding a pooled connection',
+              ['hostname', 'port']).set_function(pool_sessions)
+
+
+@atexit.register
+def close_all_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+from fintech_ibkr.metrics import metrics
+
+default_cache_size = 256
+# Contract definitions practically never change...
+default_ttl_sec = 6 * 60 * 60
+# ...but a "no security definition" answer might just be a typo that gets
+# fixed, so those are only remembered briefly.
+default_negative_ttl_sec = 60
+
+# Shared with the historical bar store (see fetch_historical_data).
+cache_lookups = metrics.counter(
+    'ibkr_cache_lookups_total', 'Cache lookups, by cache and result',
+    ['cache', 'result'])
+
+
+# Bounded in-process cache for fetch_contract_details results, keyed by
+# contract_key(). Entries expire after a TTL, and once the cache is full the
+# least recently used entry is evicted.
+class contract_details_cache:
+    def __init__(self, size=default_cache_size, ttl=default_ttl_sec,
+                 negative_ttl=default_negative_ttl_sec):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # key -> (expires_at, value)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                cache_lookups.inc(cache='contract_details', result='miss')
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        cache_lookups.inc(cache='contract_details', result='hit')
+        return entry[1]
+
+    def put(self, key, value, negative=False):
+        ttl = self.negative_ttl if negative else self.ttl
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+contract_cache = contract_details_cache()
+
+
+def contract_cache_stats():
+    return contract_cache.stats()
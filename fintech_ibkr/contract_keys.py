@@ -0,0 +1,19 @@
+# The Contract fields that identify an instrument. Two Contract objects with
+# the same contract_key() describe the same thing, whatever case or
+# whitespace the user typed them in with.
+contract_key_fields = ['conId', 'symbol', 'secType',
+                       'lastTradeDateOrContractMonth', 'strike', 'right',
+                       'multiplier', 'exchange', 'primaryExchange',
+                       'currency', 'localSymbol', 'tradingClass']
+
+
+def contract_key(contract):
+    key = []
+    for field in contract_key_fields:
+        value = getattr(contract, field, '')
+        if value is None:
+            value = ''
+        elif isinstance(value, str):
+            value = value.strip().upper()
+        key.append(value)
+    return tuple(key)
@@ -0,0 +1,84 @@
+import math
+from datetime import datetime, timedelta
+
+# Helpers for going back and forth between IB's durationStr / barSizeSetting /
+# endDateTime strings and datetimes. IB counts months and years in calendar
+# terms; the approximations here are only used to decide which ranges of bars
+# are missing, so being off by a day at the edges is harmless.
+
+duration_units = {
+    'S': timedelta(seconds=1),
+    'D': timedelta(days=1),
+    'W': timedelta(weeks=1),
+    'M': timedelta(days=30),
+    'Y': timedelta(days=365),
+}
+
+bar_size_units = {
+    'sec': timedelta(seconds=1),
+    'secs': timedelta(seconds=1),
+    'min': timedelta(minutes=1),
+    'mins': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'hours': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'days': timedelta(days=1),
+    'week': timedelta(weeks=1),
+    'weeks': timedelta(weeks=1),
+    'month': timedelta(days=30),
+    'months': timedelta(days=30),
+}
+
+end_date_time_format = '%Y%m%d %H:%M:%S'
+
+
+# '20 D' -> timedelta(days=20)
+def parse_duration(durationStr):
+    number, unit = durationStr.split()
+    return int(number) * duration_units[unit.upper()]
+
+
+# '5 mins' -> timedelta(minutes=5)
+def bar_size_delta(barSizeSetting):
+    number, unit = barSizeSetting.split()
+    return int(number) * bar_size_units[unit.lower()]
+
+
+# IB's spelling of a bar size: '1 secs', but '1 min', '1 hour', '1 day'.
+# '1 sec' and the like mean the same size, so bars are stored and looked up
+# under this spelling whichever one the caller used.
+def normalize_bar_size(barSizeSetting):
+    number, unit = barSizeSetting.split()
+    unit = unit.lower().rstrip('s')
+    if unit == 'sec' or int(number) > 1:
+        unit += 's'
+    return number + ' ' + unit
+
+
+# '' means "now". Otherwise 'yyyyMMdd HH:mm:ss', optionally followed by a
+# time zone, which is dropped. The app doesn't zero-pad the time fields, so
+# they are split rather than parsed with strptime.
+def parse_end_date_time(endDateTime):
+    if not endDateTime:
+        return datetime.now().replace(microsecond=0)
+    fields = endDateTime.split()
+    day = datetime.strptime(fields[0], '%Y%m%d')
+    if len(fields) < 2:
+        return day
+    hour, minute, second = (int(i) for i in fields[1].split(':'))
+    return day.replace(hour=hour, minute=minute, second=second)
+
+
+def format_end_date_time(end):
+    return end.strftime(end_date_time_format)
+
+
+# Smallest durationStr that reaches back at least `span` from endDateTime.
+def duration_for(span, barSizeSetting):
+    seconds = max(int(math.ceil(span.total_seconds())), 60)
+    if seconds < 86400 and bar_size_delta(barSizeSetting) < timedelta(days=1):
+        return str(seconds) + ' S'
+    days = int(math.ceil(seconds / 86400))
+    if days <= 365:
+        return str(days) + ' D'
+    return str(int(math.ceil(days / 365))) + ' Y'
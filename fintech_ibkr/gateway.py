@@ -0,0 +1,141 @@
+import os
+import secrets
+import time
+from multiprocessing.managers import BaseManager
+
+import fintech_ibkr
+from fintech_ibkr.jobs import job_manager
+
+# When the app runs as several worker processes (server.py --workers N), one
+# gateway process owns the IB connections, client ids, pacing scheduler,
+# contract cache and live bar streams, and the workers call into it. Workers
+# find it through these environment variables, which start_gateway() sets
+# before the workers are started.
+gateway_address_variable = 'FINTECH_IBKR_GATEWAY'
+gateway_authkey_variable = 'FINTECH_IBKR_GATEWAY_AUTHKEY'
+gateway_history_workers = 8
+# How often a worker checks on a historical data request running in the
+# gateway.
+gateway_poll_sec = 0.25
+
+# The fintech_ibkr functions workers may call through the gateway.
+gateway_functions = [
+    'fetch_managed_accounts', 'fetch_contract_details',
+    'fetch_contract_details_new', 'fetch_historical_window',
+    'fetch_current_time', 'place_order', 'place_orders',
+    'subscribe_historical_bars', 'stream_snapshot', 'stream_updates',
+    'cancel_stream', 'subscribe_market_data', 'market_data_snapshot',
+    'market_data_ticks', 'market_data_bars', 'cancel_market_data',
+    'contract_cache_stats', 'pacing_stats', 'metrics_text',
+]
+
+
+# Lives in the gateway process. Historical data requests run as jobs there,
+# so a worker can follow a backfill's progress and cancel it.
+class gateway_service:
+    def __init__(self):
+        self.jobs = job_manager({'historical': gateway_history_workers})
+
+    def call(self, name, args, kwargs):
+        if name not in gateway_functions:
+            raise Exception("gateway", "error", name + " is not available")
+        return getattr(fintech_ibkr, name)(*args, **kwargs)
+
+    def start_historical_data(self, args, kwargs):
+        return self.jobs.submit('historical', run_historical_data, args,
+                                kwargs)
+
+    def job_status(self, job_id):
+        return self.jobs.status(job_id)
+
+    def job_result(self, job_id):
+        return self.jobs.result(job_id)
+
+    def cancel_job(self, job_id):
+        return self.jobs.cancel(job_id)
+
+
+def run_historical_data(job, args, kwargs):
+    return fintech_ibkr.fetch_historical_data(
+        *args, on_progress=job.report, is_cancelled=job.cancelled, **kwargs)
+
+
+service = None
+
+
+def get_gateway_service():
+    global service
+    if service is None:
+        service = gateway_service()
+    return service
+
+
+class gateway_manager(BaseManager):
+    pass
+
+
+gateway_manager.register('gateway', callable=get_gateway_service)
+
+
+# Starts the gateway process on a free local port and publishes its address
+# to child processes through the environment.
+def start_gateway():
+    authkey = secrets.token_bytes(32)
+    manager = gateway_manager(address=('127.0.0.1', 0), authkey=authkey)
+    manager.start()
+    os.environ[gateway_address_variable] = \
+        manager.address[0] + ':' + str(manager.address[1])
+    os.environ[gateway_authkey_variable] = authkey.hex()
+    return manager
+
+
+def gateway_address():
+    return os.environ.get(gateway_address_variable)
+
+
+# Worker-side stand-in for the fintech_ibkr functions: same names and
+# arguments, but the work happens in the gateway process.
+class gateway_client:
+    def __init__(self, address=None, authkey=None):
+        hostname, port = (address or gateway_address()).rsplit(':', 1)
+        manager = gateway_manager(
+            address=(hostname, int(port)),
+            authkey=authkey or bytes.fromhex(
+                os.environ[gateway_authkey_variable]))
+        manager.connect()
+        self.service = manager.gateway()
+
+    def __getattr__(self, name):
+        if name not in gateway_functions:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.service.call(name, args, kwargs)
+
+    # on_progress and is_cancelled can't be sent to another process, so the
+    # request runs as a gateway job and this polls it, relaying progress and
+    # passing cancellation on.
+    def fetch_historical_data(self, *args, on_progress=None,
+                              is_cancelled=None, **kwargs):
+        job_id = self.service.start_historical_data(args, kwargs)
+        while True:
+            status = self.service.job_status(job_id)
+            if status is None:
+                raise Exception("fetch_historical_data", "error",
+                                "gateway lost the request")
+            if status['status'] == 'done':
+                return self.service.job_result(job_id)
+            if status['status'] == 'failed':
+                raise Exception("fetch_historical_data", "error",
+                                status['error'])
+            if status['status'] == 'cancelled':
+                raise Exception("fetch_historical_data", "cancelled",
+                                "request was cancelled")
+            try:
+                if is_cancelled is not None and is_cancelled():
+                    raise Exception("fetch_historical_data", "cancelled",
+                                    "request was cancelled")
+                if on_progress is not None and status['progress']:
+                    on_progress(*status['progress'])
+            except Exception:
+                self.service.cancel_job(job_id)
+                raise
+            time.sleep(gateway_poll_sec)
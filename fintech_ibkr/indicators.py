@@ -0,0 +1,378 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from fintech_ibkr.resample import session_open, trading_days, \
+    min_session_break_sec
+
+# Technical indicators over the bar frames fetch_historical_data returns.
+# Each indicator is a small class that computes its whole series at once with
+# batch(bars), vectorized, and afterwards keeps just enough state to compute
+# the value for each further bar in O(1) with update(bar). A live chart calls
+# batch() once on the history and update() for every bar that finishes after
+# that. The state is plain numbers and lists (to_dict/indicator_from_dict),
+# so it can be kept in a dcc.Store between callbacks; the last `period`
+# closes are kept in a deque(maxlen=period) and stored as a list.
+
+default_period = 20
+default_oscillator_period = 14
+default_band_width = 2
+
+
+def values_of(bars, column):
+    return pd.to_numeric(bars[column]).to_numpy(dtype=float)
+
+
+def first_valid(values, count):
+    values[:count] = np.nan
+    return values
+
+
+# Exponential moving average with smoothing factor alpha, seeded with the
+# first value (pandas' adjust=False).
+def exponential_average(values, alpha):
+    return pd.Series(values).ewm(alpha=alpha, adjust=False).mean() \
+        .to_numpy(copy=True)
+
+
+class indicator:
+    name = None
+    # attributes holding a deque(maxlen=self.period)
+    windows = ()
+
+    def to_dict(self):
+        state = dict(self.__dict__)
+        for name in self.windows:
+            state[name] = list(state[name])
+        return {'name': self.name, 'state': state}
+
+
+# Simple moving average of the close over `period` bars.
+class sma(indicator):
+    name = 'sma'
+    windows = ('window',)
+
+    def __init__(self, period=default_period):
+        self.period = period
+        self.window = deque(maxlen=period)
+        self.total = 0.0
+
+    @property
+    def columns(self):
+        return ['sma_' + str(self.period)]
+
+    def batch(self, bars):
+        close = values_of(bars, 'close')
+        sums = np.cumsum(np.r_[0.0, close])
+        values = np.full(len(close), np.nan)
+        if len(close) >= self.period:
+            values[self.period - 1:] = \
+                (sums[self.period:] - sums[:-self.period]) / self.period
+        self.window = deque(close[-self.period:].tolist(),
+                            maxlen=self.period)
+        self.total = float(np.sum(self.window))
+        return {self.columns[0]: values}
+
+    def update(self, bar):
+        if len(self.window) == self.period:
+            self.total -= self.window[0]
+        self.window.append(float(bar.close))
+        self.total += self.window[-1]
+        value = self.total / self.period \
+            if len(self.window) == self.period else np.nan
+        return {self.columns[0]: value}
+
+
+# Exponential moving average of the close, alpha = 2 / (period + 1).
+class ema(indicator):
+    name = 'ema'
+
+    def __init__(self, period=default_period):
+        self.period = period
+        self.value = None
+        self.count = 0
+
+    @property
+    def columns(self):
+        return ['ema_' + str(self.period)]
+
+    def alpha(self):
+        return 2.0 / (self.period + 1)
+
+    def batch(self, bars):
+        close = values_of(bars, 'close')
+        values = exponential_average(close, self.alpha())
+        self.count = len(close)
+        self.value = float(values[-1]) if len(values) else None
+        return {self.columns[0]: first_valid(values, self.period - 1)}
+
+    def update(self, bar):
+        close = float(bar.close)
+        self.value = close if self.value is None else \
+            self.value + self.alpha() * (close - self.value)
+        self.count += 1
+        return {self.columns[0]:
+                self.value if self.count >= self.period else np.nan}
+
+
+# Bollinger bands: the SMA of the close, plus and minus `width` standard
+# deviations (population) of the close over the same bars.
+class bollinger(indicator):
+    name = 'bollinger'
+    windows = ('window',)
+
+    def __init__(self, period=default_period, width=default_band_width):
+        self.period = period
+        self.width = width
+        self.window = deque(maxlen=period)
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    @property
+    def columns(self):
+        suffix = '_' + str(self.period)
+        return ['bollinger_middle' + suffix, 'bollinger_upper' + suffix,
+                'bollinger_lower' + suffix]
+
+    def bands(self, middle, deviation):
+        return dict(zip(self.columns, [middle, middle + self.width * deviation,
+                                       middle - self.width * deviation]))
+
+    def batch(self, bars):
+        close = values_of(bars, 'close')
+        middle = np.full(len(close), np.nan)
+        deviation = np.full(len(close), np.nan)
+        if len(close) >= self.period:
+            windows = sliding_window_view(close, self.period)
+            middle[self.period - 1:] = windows.mean(axis=1)
+            deviation[self.period - 1:] = windows.std(axis=1)
+        self.window = deque(close[-self.period:].tolist(),
+                            maxlen=self.period)
+        self.total = float(np.sum(self.window))
+        self.total_squares = float(np.sum(np.square(self.window)))
+        return self.bands(middle, deviation)
+
+    def update(self, bar):
+        close = float(bar.close)
+        if len(self.window) == self.period:
+            dropped = self.window[0]
+            self.total -= dropped
+            self.total_squares -= dropped * dropped
+        self.window.append(close)
+        self.total += close
+        self.total_squares += close * close
+        if len(self.window) < self.period:
+            return self.bands(np.nan, np.nan)
+        middle = self.total / self.period
+        variance = max(self.total_squares / self.period - middle * middle,
+                       0.0)
+        return self.bands(middle, variance ** 0.5)
+
+
+# Wilder's relative strength index of the close: gains and losses are
+# averaged with alpha = 1 / period.
+class rsi(indicator):
+    name = 'rsi'
+
+    def __init__(self, period=default_oscillator_period):
+        self.period = period
+        self.previous_close = None
+        self.average_gain = None
+        self.average_loss = None
+        self.count = 0
+
+    @property
+    def columns(self):
+        return ['rsi_' + str(self.period)]
+
+    @staticmethod
+    def index(average_gain, average_loss):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(average_loss == 0, 100.0,
+                            100.0 - 100.0 / (1.0 + average_gain /
+                                             average_loss))
+
+    def batch(self, bars):
+        close = values_of(bars, 'close')
+        values = np.full(len(close), np.nan)
+        self.count = len(close)
+        if len(close) > 1:
+            change = np.diff(close)
+            gains = exponential_average(np.maximum(change, 0.0),
+                                        1.0 / self.period)
+            losses = exponential_average(np.maximum(-change, 0.0),
+                                         1.0 / self.period)
+            values[1:] = self.index(gains, losses)
+            self.average_gain = float(gains[-1])
+            self.average_loss = float(losses[-1])
+        self.previous_close = float(close[-1]) if len(close) else None
+        return {self.columns[0]: first_valid(values, self.period)}
+
+    def update(self, bar):
+        close = float(bar.close)
+        self.count += 1
+        if self.previous_close is None:
+            self.previous_close = close
+            return {self.columns[0]: np.nan}
+        change = close - self.previous_close
+        self.previous_close = close
+        gain, loss = max(change, 0.0), max(-change, 0.0)
+        if self.average_gain is None:
+            self.average_gain, self.average_loss = gain, loss
+        else:
+            alpha = 1.0 / self.period
+            self.average_gain += alpha * (gain - self.average_gain)
+            self.average_loss += alpha * (loss - self.average_loss)
+        if self.count <= self.period:
+            return {self.columns[0]: np.nan}
+        return {self.columns[0]: float(self.index(self.average_gain,
+                                                  self.average_loss))}
+
+
+# Wilder's average true range.
+class atr(indicator):
+    name = 'atr'
+
+    def __init__(self, period=default_oscillator_period):
+        self.period = period
+        self.previous_close = None
+        self.value = None
+        self.count = 0
+
+    @property
+    def columns(self):
+        return ['atr_' + str(self.period)]
+
+    def batch(self, bars):
+        high, low = values_of(bars, 'high'), values_of(bars, 'low')
+        close = values_of(bars, 'close')
+        true_range = high - low
+        if len(close) > 1:
+            previous = close[:-1]
+            true_range[1:] = np.maximum(
+                true_range[1:], np.maximum(np.abs(high[1:] - previous),
+                                           np.abs(low[1:] - previous)))
+        values = exponential_average(true_range, 1.0 / self.period)
+        self.count = len(close)
+        self.value = float(values[-1]) if len(values) else None
+        self.previous_close = float(close[-1]) if len(close) else None
+        return {self.columns[0]: first_valid(values, self.period - 1)}
+
+    def update(self, bar):
+        high, low = float(bar.high), float(bar.low)
+        true_range = high - low
+        if self.previous_close is not None:
+            true_range = max(true_range, abs(high - self.previous_close),
+                             abs(low - self.previous_close))
+        self.previous_close = float(bar.close)
+        self.value = true_range if self.value is None else \
+            self.value + (true_range - self.value) / self.period
+        self.count += 1
+        return {self.columns[0]:
+                self.value if self.count >= self.period else np.nan}
+
+
+# Volume-weighted average of the typical price (high + low + close) / 3,
+# starting over every trading day (see resample.trading_days). Bars without
+# volume (MIDPOINT and the like) count once each.
+class vwap(indicator):
+    name = 'vwap'
+
+    def __init__(self):
+        self.open_time = 0
+        self.day = None
+        self.weighted_total = 0.0
+        self.weight_total = 0.0
+
+    @property
+    def columns(self):
+        return ['vwap']
+
+    def weights(self, volume):
+        return np.where(volume > 0, volume, 1.0)
+
+    def batch(self, bars):
+        high, low = values_of(bars, 'high'), values_of(bars, 'low')
+        typical = (high + low + values_of(bars, 'close')) / 3
+        weights = self.weights(values_of(bars, 'volume'))
+        times = bars['date'].values.astype('datetime64[s]').astype('int64')
+        gaps = np.diff(times)
+        step = gaps[gaps > 0].min() if (gaps > 0).any() else 1
+        breaks = np.r_[True, gaps - step >= min_session_break_sec]
+        self.open_time = session_open(times, breaks)
+        days = trading_days(times, self.open_time)
+        starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        counts = np.diff(np.r_[starts, len(days)])
+
+        def daily_cumsum(values):
+            sums = np.cumsum(values)
+            before = np.r_[0.0, sums][starts]
+            return sums - np.repeat(before, counts)
+
+        weighted = daily_cumsum(typical * weights)
+        weight = daily_cumsum(weights)
+        if len(times):
+            self.day = int(days[-1])
+            self.weighted_total = float(weighted[-1])
+            self.weight_total = float(weight[-1])
+        return {'vwap': weighted / weight}
+
+    def update(self, bar):
+        time = pd.Timestamp(bar.date).value // 10 ** 9
+        day = int(trading_days(np.array([time]), self.open_time)[0])
+        if day != self.day:
+            self.day = day
+            self.weighted_total = self.weight_total = 0.0
+        weight = float(self.weights(np.array([float(bar.volume)]))[0])
+        typical = (float(bar.high) + float(bar.low) + float(bar.close)) / 3
+        self.weighted_total += typical * weight
+        self.weight_total += weight
+        return {'vwap': self.weighted_total / self.weight_total}
+
+
+indicator_classes = {cls.name: cls for cls in [sma, ema, bollinger, rsi, atr,
+                                               vwap]}
+# Drawn on the price axis; the others have a scale of their own.
+price_indicators = ['sma', 'ema', 'bollinger', 'vwap']
+
+
+def make_indicator(name, **parameters):
+    if name not in indicator_classes:
+        raise Exception("make_indicator", "error", "no such indicator: " +
+                        str(name))
+    return indicator_classes[name](**parameters)
+
+
+def indicator_from_dict(data):
+    restored = indicator_classes[data['name']].__new__(
+        indicator_classes[data['name']])
+    restored.__dict__.update(data['state'])
+    for name in restored.windows:
+        setattr(restored, name, deque(getattr(restored, name),
+                                      maxlen=restored.period))
+    return restored
+
+
+# Runs batch() for every indicator and returns the results as one frame,
+# indexed like `bars`. The indicators are left ready for update().
+def compute_indicators(bars, indicators):
+    columns = {}
+    for item in indicators:
+        columns.update(item.batch(bars))
+    return pd.DataFrame(columns, index=bars.index)
+
+
+# Runs update() for every indicator on each of `bars`, in order, and returns
+# the results as one frame.
+def update_indicators(bars, indicators):
+    rows = []
+    for bar in bars.itertuples(index=False):
+        row = {}
+        for item in indicators:
+            row.update(item.update(bar))
+        rows.append(row)
+    return pd.DataFrame(rows, index=bars.index,
+                        columns=[column for item in indicators
+                                 for column in item.columns])
@@ -0,0 +1,302 @@
+import itertools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Worker threads per queue. Charts and trades get separate pools so a slow
+# backfill can never hold up an order.
+job_queue_workers = {'chart': 4, 'trade': 2}
+# Finished jobs are forgotten this long after they finish, whether or not
+# anybody collected the result.
+job_ttl_sec = 600
+# When several worker processes serve the app, a job's status has to be
+# visible to whichever worker the browser's next poll lands on, so it's kept
+# in the SQLite file this variable names.
+job_store_variable = 'FINTECH_IBKR_JOB_STORE'
+
+queued, running, done, failed, cancelled = \
+    'queued', 'running', 'done', 'failed', 'cancelled'
+
+
+# One unit of background work. The function it runs gets the job as its
+# first argument, and can call report() to publish progress; report() also
+# raises once the job has been cancelled, so cancellation takes effect at the
+# next progress report.
+class job:
+    def __init__(self, job_id, queue, store=None):
+        self.job_id = job_id
+        self.queue = queue
+        self.store = store
+        self.status = queued
+        self.progress = None
+        self.message = None
+        self.result = None
+        self.error = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    def report(self, progress_done=None, progress_total=None, message=None):
+        if self.cancel_event.is_set():
+            raise Exception("job", "cancelled", "job was cancelled")
+        if progress_total:
+            self.progress = (progress_done, progress_total)
+        if message is not None:
+            self.message = message
+        if self.store is not None:
+            self.store.put(self)
+            if self.cancelled():
+                raise Exception("job", "cancelled", "job was cancelled")
+
+    def cancelled(self):
+        # A cancel may have come in through another worker process.
+        if self.store is not None and not self.cancel_event.is_set() and \
+                self.store.cancel_requested(self.job_id):
+            self.cancel_event.set()
+        return self.cancel_event.is_set()
+
+    def snapshot(self):
+        return {'job_id': self.job_id, 'status': self.status,
+                'progress': self.progress, 'message': self.message,
+                'error': self.error}
+
+
+# Job statuses and results in SQLite, shared by every process using the same
+# file. Results are pickled.
+class job_store:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'job_id TEXT PRIMARY KEY, status TEXT, progress_done INTEGER, '
+                'progress_total INTEGER, message TEXT, error TEXT, '
+                'result BLOB, cancel INTEGER DEFAULT 0, finished REAL)'
+            )
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def put(self, job):
+        progress = job.progress or (None, None)
+        result = pickle.dumps(job.result) if job.status == done else None
+        finished = None if job.finished is None else time.time()
+        connection = self.connection()
+        with connection:
+            connection.execute(
+                'INSERT INTO jobs (job_id, status, progress_done, '
+                'progress_total, message, error, result, finished) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (job_id) DO '
+                'UPDATE SET status = excluded.status, '
+                'progress_done = excluded.progress_done, '
+                'progress_total = excluded.progress_total, '
+                'message = excluded.message, error = excluded.error, '
+                'result = excluded.result, finished = excluded.finished',
+                (job.job_id, job.status, progress[0], progress[1],
+                 job.message, job.error, result, finished)
+            )
+
+    def status(self, job_id):
+        row = self.connection().execute(
+            'SELECT status, progress_done, progress_total, message, error '
+            'FROM jobs WHERE job_id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'job_id': job_id, 'status': row[0],
+                'progress': None if row[2] is None else (row[1], row[2]),
+                'message': row[3], 'error': row[4]}
+
+    def take_result(self, job_id):
+        connection = self.connection()
+        with connection:
+            row = connection.execute(
+                'SELECT result FROM jobs WHERE job_id = ? AND status = ?',
+                (job_id, done)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute('DELETE FROM jobs WHERE job_id = ?',
+                               (job_id,))
+        return pickle.loads(row[0])
+
+    # Flags an unfinished job as cancelled; its own process notices at the
+    # job's next report().
+    def request_cancel(self, job_id):
+        connection = self.connection()
+        with connection:
+            return connection.execute(
+                'UPDATE jobs SET cancel = 1 WHERE job_id = ? AND '
+                'finished IS NULL', (job_id,)
+            ).rowcount > 0
+
+    def cancel_requested(self, job_id):
+        row = self.connection().execute(
+            'SELECT cancel FROM jobs WHERE job_id = ?', (job_id,)
+        ).fetchone()
+        return row is not None and bool(row[0])
+
+    def expire(self, ttl):
+        connection = self.connection()
+        with connection:
+            connection.execute('DELETE FROM jobs WHERE finished < ?',
+                               (time.time() - ttl,))
+
+
+# With store_variable, the store's path is read from that environment
+# variable when the manager is first used rather than when it's created, so
+# it doesn't matter whether this module was imported before the variable was
+# set (server.py sets it for the worker processes it starts).
+class job_manager:
+    def __init__(self, queue_workers=None, store_path=None,
+                 store_variable=None):
+        self.executors = {
+            queue: ThreadPoolExecutor(max_workers=workers,
+                                      thread_name_prefix=queue + '-job')
+            for queue, workers in (queue_workers or job_queue_workers).items()
+        }
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.store_path = store_path
+        self.store_variable = store_variable
+        self._store = None
+        self.store_lock = threading.Lock()
+
+    @property
+    def store(self):
+        if self._store is None:
+            path = self.store_path
+            if path is None and self.store_variable is not None:
+                path = os.environ.get(self.store_variable)
+            if path:
+                with self.store_lock:
+                    if self._store is None:
+                        self._store = job_store(path)
+        return self._store
+
+    # Queues fn(job, *args, **kwargs) and returns the job id straight away.
+    def submit(self, queue, fn, *args, **kwargs):
+        if queue not in self.executors:
+            raise Exception("submit", "error", "no such job queue: " + queue)
+        self.expire()
+        with self.lock:
+            # the pid keeps ids unique across worker processes
+            new_job = job(str(os.getpid()) + '-' + str(next(self.ids)), queue,
+                          self.store)
+            self.jobs[new_job.job_id] = new_job
+        if self.store is not None:
+            self.store.put(new_job)
+        new_job.future = self.executors[queue].submit(
+            self.run, new_job, fn, args, kwargs)
+        return new_job.job_id
+
+    def run(self, job, fn, args, kwargs):
+        if job.cancelled():
+            self.finish(job, cancelled)
+            return
+        job.status = running
+        if self.store is not None:
+            self.store.put(job)
+        try:
+            job.result = fn(job, *args, **kwargs)
+        except Exception as e:
+            if job.cancelled():
+                self.finish(job, cancelled)
+            else:
+                job.error = str(e.args[-1]) if e.args else repr(e)
+                self.finish(job, failed)
+            return
+        self.finish(job, done)
+
+    def finish(self, job, status):
+        job.finished = time.monotonic()
+        job.status = status
+        if self.store is not None:
+            self.store.put(job)
+            # the store answers for it from now on
+            with self.lock:
+                self.jobs.pop(job.job_id, None)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    # The job's status, progress and error as a dict, or None if there's no
+    # such job (never submitted, or expired).
+    def status(self, job_id):
+        if self.store is not None:
+            return self.store.status(job_id)
+        job = self.get(job_id)
+        return None if job is None else job.snapshot()
+
+    # A finished job's result; the job is forgotten once it's collected.
+    def result(self, job_id):
+        if self.store is not None:
+            return self.store.take_result(job_id)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status != done:
+                return None
+            del self.jobs[job_id]
+        return job.result
+
+    # Jobs still in the queue never start; running ones stop at their next
+    # report().
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None and self.store is not None:
+            return self.store.request_cancel(job_id)
+        if job is None or job.finished is not None:
+            return False
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            self.finish(job, cancelled)
+        return True
+
+    def expire(self):
+        if self.store is not None:
+            self.store.expire(job_ttl_sec)
+        now = time.monotonic()
+        with self.lock:
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job.finished is not None and
+                           now - job.finished > job_ttl_sec]:
+                del self.jobs[job_id]
+
+    def stats(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return {queue: {status: sum(1 for job in jobs if job.queue == queue
+                                    and job.status == status)
+                        for status in [queued, running, done, failed,
+                                       cancelled]}
+                for queue in self.executors}
+
+
+background_jobs = job_manager(store_variable=job_store_variable)
+
+
+def submit_job(queue, fn, *args, **kwargs):
+    return background_jobs.submit(queue, fn, *args, **kwargs)
+
+
+def job_status(job_id):
+    return background_jobs.status(job_id)
+
+
+def job_result(job_id):
+    return background_jobs.result(job_id)
+
+
+def cancel_job(job_id):
+    return background_jobs.cancel(job_id)
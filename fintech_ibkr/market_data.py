@@ -0,0 +1,368 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from ibapi.ticktype import TickTypeEnum
+
+from fintech_ibkr.connection_pool import get_pool
+from fintech_ibkr.contract_keys import contract_key
+from fintech_ibkr.metrics import metrics
+from fintech_ibkr.resample import aggregate_bars, bar_size_seconds
+from fintech_ibkr.synchronous_functions import ibkr_app, default_hostname, \
+    default_port, default_client_id, timeout_sec, bar_columns
+
+# Live quotes and ticks from reqMktData / reqTickByTickData. Every
+# subscription keeps its ticks in a fixed-size ring buffer of NumPy arrays,
+# so memory stays flat however long it runs, and the latest quote in a dict,
+# so a Dash callback can read either (market_data_snapshot,
+# market_data_ticks) or have bars of any size built from the ticks
+# (market_data_bars) without a round trip to IB.
+
+# Ticks kept per subscription; older ones are overwritten.
+default_tick_capacity = 100000
+# A subscription nobody has read for this long is cancelled.
+market_data_idle_sec = 120
+reap_interval_sec = 30
+
+# What a tick in the ring buffer is a price of.
+tick_fields = ['bid', 'ask', 'last', 'midpoint']
+bid_field, ask_field, last_field, midpoint_field = range(len(tick_fields))
+tick_columns = ['time', 'field', 'price', 'size']
+# reqTickByTickData's tickType values.
+tick_by_tick_types = ['Last', 'AllLast', 'BidAsk', 'MidPoint']
+
+# IB tick types (live and delayed) and the quote entry they update.
+quote_ticks = {
+    TickTypeEnum.BID: 'bid', TickTypeEnum.ASK: 'ask',
+    TickTypeEnum.LAST: 'last', TickTypeEnum.HIGH: 'high',
+    TickTypeEnum.LOW: 'low', TickTypeEnum.CLOSE: 'close',
+    TickTypeEnum.OPEN: 'open', TickTypeEnum.BID_SIZE: 'bid_size',
+    TickTypeEnum.ASK_SIZE: 'ask_size', TickTypeEnum.LAST_SIZE: 'last_size',
+    TickTypeEnum.VOLUME: 'volume',
+    TickTypeEnum.DELAYED_BID: 'bid', TickTypeEnum.DELAYED_ASK: 'ask',
+    TickTypeEnum.DELAYED_LAST: 'last', TickTypeEnum.DELAYED_HIGH: 'high',
+    TickTypeEnum.DELAYED_LOW: 'low', TickTypeEnum.DELAYED_CLOSE: 'close',
+    TickTypeEnum.DELAYED_OPEN: 'open',
+    TickTypeEnum.DELAYED_BID_SIZE: 'bid_size',
+    TickTypeEnum.DELAYED_ASK_SIZE: 'ask_size',
+    TickTypeEnum.DELAYED_LAST_SIZE: 'last_size',
+    TickTypeEnum.DELAYED_VOLUME: 'volume',
+}
+quote_fields = ['bid', 'ask', 'last', 'midpoint', 'bid_size', 'ask_size',
+                'last_size', 'volume', 'open', 'high', 'low', 'close', 'time']
+
+ticks_received = metrics.counter(
+    'ibkr_ticks_total', 'Market data ticks received, by field', ['field'])
+
+
+# The last `capacity` ticks of one subscription, in preallocated arrays.
+# Appending writes one slot and never allocates; reads copy out the ticks
+# asked for, oldest first. Ticks are numbered from 0 in the order they
+# arrived, so a reader can ask for just the ones it hasn't seen.
+class tick_ring_buffer:
+    def __init__(self, capacity=default_tick_capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.fields = np.zeros(capacity, dtype=np.int8)
+        self.prices = np.zeros(capacity)
+        self.sizes = np.zeros(capacity)
+        # ticks ever appended; the next one goes in slot count % capacity
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, moment, field, price, size):
+        with self.lock:
+            slot = self.count % self.capacity
+            self.times[slot] = moment
+            self.fields[slot] = field
+            self.prices[slot] = price
+            self.sizes[slot] = size
+            self.count += 1
+
+    # The ticks numbered `since` and up that are still in the buffer, as
+    # (times, fields, prices, sizes), and the number to pass next time.
+    def read(self, since=0):
+        with self.lock:
+            first = max(since, self.count - self.capacity, 0)
+            slots = np.arange(first, self.count) % self.capacity
+            return (self.times[slots], self.fields[slots],
+                    self.prices[slots], self.sizes[slots]), self.count
+
+
+# One reqMktData or reqTickByTickData subscription. The ibkr_app reader
+# thread calls the on_* methods; everything else reads.
+class market_data_subscription:
+    def __init__(self, key, tick_by_tick=None,
+                 capacity=default_tick_capacity):
+        self.key = key
+        self.tick_by_tick = tick_by_tick
+        self.ticks = tick_ring_buffer(capacity)
+        self.quote = dict.fromkeys(quote_fields)
+        self.lock = threading.Lock()
+        self.error = None
+        self.last_polled = time.monotonic()
+        self.app = None
+        self.reqId = None
+        self.pool = None
+
+    def add_tick(self, moment, field, price, size):
+        self.ticks.append(moment, field, price, size)
+        ticks_received.inc(field=tick_fields[field])
+
+    def update_quote(self, moment, values):
+        with self.lock:
+            self.quote.update(values)
+            self.quote['time'] = moment
+            bid, ask = self.quote['bid'], self.quote['ask']
+        return bid, ask
+
+    # The midpoint tick that goes with a new bid or ask, once both are known.
+    def add_midpoint(self, moment, bid, ask):
+        if bid is not None and ask is not None and bid > 0 and ask > 0:
+            midpoint = (bid + ask) / 2
+            with self.lock:
+                self.quote['midpoint'] = midpoint
+            self.add_tick(moment, midpoint_field, midpoint, 0)
+
+    # reqMktData. IB sends a trade as LAST followed by LAST_SIZE (or just
+    # LAST_SIZE when the price didn't change), so trades are recorded when
+    # the size arrives.
+    def on_price(self, tickType, price):
+        name = quote_ticks.get(tickType)
+        if name is None or price < 0:
+            return
+        moment = time.time()
+        bid, ask = self.update_quote(moment, {name: price})
+        if name in ['bid', 'ask']:
+            field = bid_field if name == 'bid' else ask_field
+            self.add_tick(moment, field, price,
+                          self.quote[name + '_size'] or 0)
+            self.add_midpoint(moment, bid, ask)
+
+    def on_size(self, tickType, size):
+        name = quote_ticks.get(tickType)
+        if name is None:
+            return
+        moment = time.time()
+        self.update_quote(moment, {name: size})
+        last = self.quote['last']
+        if name == 'last_size' and last is not None and size > 0:
+            self.add_tick(moment, last_field, last, size)
+
+    # reqTickByTickData; IB dates these ticks itself, to the second.
+    def on_last(self, moment, price, size):
+        self.update_quote(moment, {'last': price, 'last_size': size})
+        self.add_tick(moment, last_field, price, size)
+
+    def on_bid_ask(self, moment, bid, ask, bid_size, ask_size):
+        self.update_quote(moment, {'bid': bid, 'ask': ask,
+                                   'bid_size': bid_size,
+                                   'ask_size': ask_size})
+        self.add_tick(moment, bid_field, bid, bid_size)
+        self.add_tick(moment, ask_field, ask, ask_size)
+        self.add_midpoint(moment, bid, ask)
+
+    def on_midpoint(self, moment, midpoint):
+        self.update_quote(moment, {'midpoint': midpoint})
+        self.add_tick(moment, midpoint_field, midpoint, 0)
+
+    def fail(self, errorCode, errorString):
+        self.error = (errorCode, errorString)
+
+    def snapshot(self):
+        with self.lock:
+            quote = dict(self.quote)
+        self.last_polled = time.monotonic()
+        quote['ticks'] = self.ticks.count
+        return quote
+
+    def read(self, since=0):
+        self.last_polled = time.monotonic()
+        return self.ticks.read(since)
+
+
+# Epoch seconds as local wall-clock seconds, the way formatDate=1 historical
+# bars are dated, so live bars line up with the history on a chart.
+def local_seconds(times):
+    if not len(times):
+        return times
+    newest = datetime.fromtimestamp(float(times[-1]), timezone.utc)
+    return times + newest.astimezone().utcoffset().total_seconds()
+
+
+# Bars of interval_sec seconds from one field's ticks, aligned to the clock
+# like IB's: OHLC of the tick prices, volume the summed sizes of trades
+# (-1 for quotes, like MIDPOINT bars), average weighted by size.
+def tick_bars(times, prices, sizes, interval_sec, has_volume):
+    if not len(times):
+        return pd.DataFrame(columns=bar_columns)
+    local = local_seconds(times)
+    labels = local - local % interval_sec
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    ticks = pd.DataFrame({
+        'open': prices, 'high': prices, 'low': prices, 'close': prices,
+        'volume': sizes if has_volume else np.full(len(prices), -1.0),
+        'bar_count': np.ones(len(prices)), 'average': prices,
+    })
+    return aggregate_bars(ticks, starts,
+                          pd.to_datetime(labels[starts], unit='s')) \
+        [bar_columns]
+
+
+subscriptions = {}
+subscriptions_lock = threading.Lock()
+reaper = None
+
+active_subscriptions = metrics.gauge(
+    'ibkr_market_data_subscriptions', 'Open market data subscriptions')
+active_subscriptions.set_function(lambda: len(subscriptions))
+
+
+def market_data_key(contract, tick_by_tick=None):
+    return '|'.join(str(i) for i in contract_key(contract)) + '|' + \
+        (tick_by_tick or 'quotes')
+
+
+# Starts (or joins) streaming market data for `contract` on a pooled
+# connection and returns the subscription's key. With tick_by_tick=None
+# it's reqMktData (top of book, sampled by IB a few times a second);
+# 'BidAsk', 'Last', 'AllLast' or 'MidPoint' asks for every tick of that
+# kind instead. Identical subscriptions are shared.
+def subscribe_market_data(contract, tick_by_tick=None, genericTickList='',
+                          capacity=default_tick_capacity,
+                          hostname=default_hostname, port=default_port,
+                          client_id=default_client_id):
+    if tick_by_tick is not None and tick_by_tick not in tick_by_tick_types:
+        raise Exception("subscribe_market_data", "error",
+                        "tick_by_tick must be one of " +
+                        ", ".join(tick_by_tick_types))
+    key = market_data_key(contract, tick_by_tick)
+    with subscriptions_lock:
+        failed = subscriptions.get(key)
+        if failed is not None and failed.error is None:
+            return key
+        subscription = market_data_subscription(key, tick_by_tick, capacity)
+        subscriptions[key] = subscription
+        start_reaper()
+    if failed is not None:
+        # release what the failed subscription still holds before it's out
+        # of reach of the reaper
+        close_subscription(failed)
+
+    try:
+        subscription.pool = get_pool(ibkr_app, hostname, port, client_id)
+        subscription.app = subscription.pool.acquire(timeout_sec)
+    except Exception as e:
+        subscription.fail(504, str(e.args[-1]))
+        close_subscription(subscription)
+        raise
+    app = subscription.app
+    subscription.reqId = app.next_request_id()
+    app.market_data[subscription.reqId] = subscription
+    if tick_by_tick is None:
+        app.reqMktData(subscription.reqId, contract, genericTickList, False,
+                       False, [])
+    else:
+        app.reqTickByTickData(subscription.reqId, contract, tick_by_tick, 0,
+                              False)
+    return key
+
+
+def get_subscription(key):
+    with subscriptions_lock:
+        subscription = subscriptions.get(key)
+    if subscription is None:
+        raise Exception("get_subscription", "error",
+                        "no such subscription: " + key)
+    if subscription.error is not None:
+        raise Exception("get_subscription", "error", subscription.error[1])
+    return subscription
+
+
+# The latest quote: bid, ask, last, their sizes, volume, the session's
+# open/high/low/close as far as IB sent them, the epoch time of the last
+# update, and how many ticks have arrived. None for what hasn't arrived yet.
+def market_data_snapshot(key):
+    return get_subscription(key).snapshot()
+
+
+# The ticks numbered `cursor` and up that are still buffered, as a frame
+# with tick_columns (field is one of tick_fields), and the cursor to pass
+# next time.
+def market_data_ticks(key, cursor=0):
+    (times, fields, prices, sizes), cursor = \
+        get_subscription(key).read(cursor)
+    frame = pd.DataFrame({
+        'time': pd.to_datetime(local_seconds(times), unit='s'),
+        'field': np.array(tick_fields)[fields],
+        'price': prices,
+        'size': sizes,
+    }, columns=tick_columns)
+    return frame, cursor
+
+
+# Bars built from the buffered ticks, with bar_columns like
+# fetch_historical_data's. barSizeSetting is one of IB's bar sizes or a
+# number of seconds, so it doesn't have to be a size IB offers. field is
+# 'last' (trades), 'bid', 'ask' or 'midpoint'; by default trades if there
+# are any and midpoints otherwise (FX has no trades).
+def market_data_bars(key, barSizeSetting='5 secs', field=None):
+    (times, fields, prices, sizes), _ = get_subscription(key).read()
+    if field is None:
+        field = 'last' if (fields == last_field).any() else 'midpoint'
+    if field not in tick_fields:
+        raise Exception("market_data_bars", "error",
+                        "field must be one of " + ", ".join(tick_fields))
+    interval_sec = barSizeSetting if isinstance(barSizeSetting,
+                                                (int, float)) \
+        else bar_size_seconds(barSizeSetting)
+    chosen = fields == tick_fields.index(field)
+    return tick_bars(times[chosen], prices[chosen], sizes[chosen],
+                     interval_sec, field == 'last')
+
+
+def cancel_market_data(key):
+    with subscriptions_lock:
+        subscription = subscriptions.get(key)
+    if subscription is not None:
+        close_subscription(subscription)
+
+
+def close_subscription(subscription):
+    with subscriptions_lock:
+        if subscriptions.get(subscription.key) is subscription:
+            del subscriptions[subscription.key]
+        app, subscription.app = subscription.app, None
+    if app is None:
+        return
+    app.market_data.pop(subscription.reqId, None)
+    if app.isConnected():
+        if subscription.tick_by_tick is None:
+            app.cancelMktData(subscription.reqId)
+        else:
+            app.cancelTickByTickData(subscription.reqId)
+    subscription.pool.release(app)
+
+
+def start_reaper():
+    global reaper
+    if reaper is None:
+        reaper = threading.Thread(target=reap_idle_subscriptions,
+                                  daemon=True)
+        reaper.start()
+
+
+def reap_idle_subscriptions():
+    while True:
+        time.sleep(reap_interval_sec)
+        now = time.monotonic()
+        with subscriptions_lock:
+            idle = [subscription for subscription in subscriptions.values()
+                    if subscription.app is not None and (
+                        subscription.error is not None or
+                        now - subscription.last_polled >
+                        market_data_idle_sec)]
+        for subscription in idle:
+            close_subscription(subscription)
@@ -0,0 +1,236 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cached lookup up to a long backfill
+# window.
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+metrics_content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if value != value:
+        return 'NaN'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(name + '="' + escape_label(value) + '"'
+                          for name, value in zip(names, values)) + '}'
+
+
+# The parts every metric has: a name, help text, label names, and one series
+# per combination of label values. Label values are passed as keyword
+# arguments, e.g. requests.inc(request='historical_data').
+class metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def label_values(self, labels):
+        if len(labels) != len(self.label_names):
+            raise Exception(
+                "metric",
+                "error",
+                self.name + " takes labels " + ", ".join(self.label_names)
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def header(self):
+        return ['# HELP ' + self.name + ' ' + self.help_text,
+                '# TYPE ' + self.name + ' ' + self.kind]
+
+
+# Only goes up: requests made, errors received, cache hits.
+class counter(metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.series.get(self.label_values(labels), 0)
+
+    def render(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        return self.header() + [
+            self.name + format_labels(self.label_names, key) + ' ' +
+            format_value(value) for key, value in series]
+
+
+# A value that goes up and down. Instead of being set, a gauge can be given a
+# function that's called at scrape time and returns {label values: value},
+# for things that are cheaper to count when asked (open connections, queue
+# depth) than to keep track of.
+class gauge(metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label_names=()):
+        metric.__init__(self, name, help_text, label_names)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.series[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn):
+        self.function = fn
+
+    def values(self):
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return {tuple(str(i) for i in key): value
+                    for key, value in values.items()}
+        with self.lock:
+            return dict(self.series)
+
+    def render(self):
+        return self.header() + [
+            self.name + format_labels(self.label_names, key) + ' ' +
+            format_value(value) for key, value in sorted(self.values().items())]
+
+
+# Counts observations into buckets, like a Prometheus histogram: per series,
+# a count per bucket, the sum and the number of observations. Buckets are
+# cumulated only when rendered, so observe() is one bisect and two adds.
+class histogram(metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=default_buckets):
+        metric.__init__(self, name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # [count per bucket..., count above the last bucket, sum]
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + \
+                    [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def snapshot(self, **labels):
+        with self.lock:
+            series = self.series.get(self.label_values(labels))
+            series = list(series) if series is not None else None
+        if series is None:
+            return {'count': 0, 'sum': 0.0}
+        return {'count': sum(series[:-1]), 'sum': series[-1]}
+
+    def render(self):
+        with self.lock:
+            all_series = sorted((key, list(series))
+                                for key, series in self.series.items())
+        lines = self.header()
+        label_names = self.label_names + ('le',)
+        for key, series in all_series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series[:-1]):
+                cumulative += count
+                lines.append(self.name + '_bucket' +
+                             format_labels(label_names,
+                                           key + (format_value(bound),)) +
+                             ' ' + format_value(cumulative))
+            labels = format_labels(self.label_names, key)
+            lines.append(self.name + '_sum' + labels + ' ' +
+                         format_value(series[-1]))
+            lines.append(self.name + '_count' + labels + ' ' +
+                         format_value(cumulative))
+        return lines
+
+
+# Every metric this process records, rendered in Prometheus' text format by
+# metrics_text(). Asking for a metric that already exists returns it, so
+# modules can declare the metrics they use at import time.
+class metrics_registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            existing = self.metrics.get(name)
+            if existing is not None:
+                if not isinstance(existing, metric_class):
+                    raise Exception(
+                        "metrics_registry",
+                        "error",
+                        name + " is already a " + existing.kind
+                    )
+                return existing
+            self.metrics[name] = metric_class(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self.register(gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=default_buckets):
+        return self.register(histogram, name, help_text, label_names,
+                             buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = metrics_registry()
+
+
+def metrics_text():
+    return metrics.render()
@@ -0,0 +1,145 @@
+import csv
+import math
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+default_order_journal_path = 'submitted_orders.sqlite'
+# Orders recorded before the journal existed; imported once into an empty
+# journal.
+legacy_orders_csv = 'submitted_orders.csv'
+
+journal_columns = ['timestamp', 'order_id', 'client_id', 'perm_id', 'con_id',
+                   'symbol', 'action', 'size', 'order_type', 'lmt_price']
+# Filter operators accepted by query_page, as SQL.
+filter_operators = {
+    '=': '= ?', '!=': '!= ?', '<': '< ?', '<=': '<= ?', '>': '> ?',
+    '>=': '>= ?', 'contains': "LIKE '%' || ? || '%'",
+    'startswith': "LIKE ? || '%'",
+}
+
+
+def to_sql_value(value):
+    # numpy scalars (e.g. from a DataFrame cell) -> plain Python
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+# Append-only journal of submitted orders in SQLite (WAL mode, so readers
+# never block the writer), indexed on timestamp, order_id and symbol. Every
+# row gets an increasing id, so callers can ask for just the rows they
+# haven't seen yet instead of re-reading the whole history.
+class order_journal:
+    def __init__(self, path=default_order_journal_path,
+                 csv_path=legacy_orders_csv):
+        self.path = path
+        self.local = threading.local()
+        if csv_path and os.path.exists(csv_path):
+            self.import_csv(csv_path)
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS orders ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, '
+                'order_id INTEGER, client_id INTEGER, perm_id INTEGER, '
+                'con_id INTEGER, symbol TEXT, action TEXT, size REAL, '
+                'order_type TEXT, lmt_price REAL)'
+            )
+            for column in ['timestamp', 'order_id', 'symbol']:
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS orders_' + column +
+                    ' ON orders (' + column + ')')
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    # Imports the legacy CSV, but only into an empty journal. The check and
+    # the insert share one write transaction, so two processes starting at
+    # once can't both import it.
+    def import_csv(self, csv_path):
+        with open(csv_path, newline='') as f:
+            rows = [[row.get(column) or None for column in journal_columns]
+                    for row in csv.DictReader(f)]
+        for row in rows:
+            for i in [1, 2, 3, 4]:
+                # ids were written out as floats ('33.0')
+                if row[i] is not None:
+                    row[i] = int(float(row[i]))
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if connection.execute(
+                    'SELECT COUNT(*) FROM orders').fetchone()[0] == 0:
+                connection.executemany(
+                    'INSERT INTO orders (' + ', '.join(journal_columns) +
+                    ') VALUES (' + ', '.join('?' * len(journal_columns)) +
+                    ')', rows
+                )
+
+    # Appends one order; returns its journal id.
+    def append(self, **row):
+        values = [to_sql_value(row.get(column)) for column in journal_columns]
+        connection = self.connection()
+        with connection:
+            cursor = connection.execute(
+                'INSERT INTO orders (' + ', '.join(journal_columns) +
+                ') VALUES (' + ', '.join('?' * len(journal_columns)) + ')',
+                values
+            )
+        return cursor.lastrowid
+
+    # One page of the journal: rows matching every (column, operator, value)
+    # in filters, ordered by sort_by [(column, 'asc' | 'desc')] (journal order
+    # by default), and how many rows match in total. Column names and
+    # operators are checked against journal_columns and filter_operators, and
+    # values are passed as parameters, so nothing from the caller is pasted
+    # into the SQL.
+    def query_page(self, page, page_size, sort_by=(), filters=()):
+        where = []
+        params = []
+        for column, operator, value in filters:
+            if column not in journal_columns or \
+                    operator not in filter_operators:
+                raise Exception("query_page", "error",
+                                "can't filter on " + column + " " + operator)
+            where.append(column + ' ' + filter_operators[operator])
+            params.append(to_sql_value(value))
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+        order = []
+        for column, direction in sort_by:
+            if column not in journal_columns:
+                raise Exception("query_page", "error",
+                                "can't sort on " + column)
+            order.append(column + (' DESC' if direction == 'desc' else ''))
+        order.append('id')
+        connection = self.connection()
+        total = connection.execute(
+            'SELECT COUNT(*) FROM orders' + where, params).fetchone()[0]
+        rows = connection.execute(
+            'SELECT ' + ', '.join(journal_columns) + ' FROM orders' + where +
+            ' ORDER BY ' + ', '.join(order) + ' LIMIT ? OFFSET ?',
+            params + [page_size, page * page_size]
+        ).fetchall()
+        return [dict(row) for row in rows], total
+
+
+order_journals = {}
+order_journals_lock = threading.Lock()
+
+
+def get_order_journal(path=default_order_journal_path):
+    with order_journals_lock:
+        if path not in order_journals:
+            order_journals[path] = order_journal(path)
+        return order_journals[path]
@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import pandas as pd
+
+from fintech_ibkr.metrics import metrics
+from fintech_ibkr.request_completion import request_completion
+from fintech_ibkr.request_router import request_seconds
+
+order_status_columns = ['order_id', 'status', 'filled', 'remaining',
+                        'avg_fill_price', 'perm_id', 'parent_id',
+                        'last_fill_price', 'client_id', 'why_held',
+                        'mkt_cap_price', 'timestamp']
+default_history_size = 1000
+final_statuses = ('Filled', 'Cancelled', 'ApiCancelled', 'Inactive')
+failed_statuses = ('Cancelled', 'ApiCancelled', 'Inactive')
+
+order_statuses = metrics.counter(
+    'ibkr_order_status_total', 'orderStatus messages received, by status',
+    ['status'])
+
+
+class order_status_record:
+    __slots__ = order_status_columns
+
+    def __init__(self, *values):
+        for column, value in zip(order_status_columns, values):
+            setattr(self, column, value)
+
+    def as_tuple(self):
+        return tuple(getattr(self, column) for column in order_status_columns)
+
+
+# Latest orderStatus per orderId, plus an optional ring buffer of every
+# status message. Each message costs O(1): one dict write, one deque append
+# and a look at the waiters registered for that orderId only.
+class order_status_store:
+    def __init__(self, history_size=default_history_size):
+        self.latest = {}
+        self.history = deque(maxlen=history_size) if history_size else None
+        # orderId -> [(statuses, request_completion)]
+        self.waiters = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def update(self, orderId, status, filled, remaining, avgFillPrice,
+               permId, parentId, lastFillPrice, clientId, whyHeld,
+               mktCapPrice):
+        record = order_status_record(
+            orderId, status, filled, remaining, avgFillPrice, permId,
+            parentId, lastFillPrice, clientId, whyHeld, mktCapPrice,
+            datetime.now())
+        order_statuses.inc(status=status)
+        with self.lock:
+            self.latest[orderId] = record
+            if self.history is not None:
+                self.history.append(record)
+            waiters = self.waiters.pop(orderId, [])
+            keep = [(statuses, done) for statuses, done in waiters
+                    if status not in statuses and status not in
+                    failed_statuses]
+            if keep:
+                self.waiters[orderId] = keep
+            subscribers = list(self.subscribers)
+        for statuses, done in waiters:
+            if status in statuses:
+                done.set_result(record)
+            elif status in failed_statuses:
+                done.set_error(202, 'Order ' + status)
+        for fn in subscribers:
+            fn(record)
+
+    # Returns a request_completion that finishes (with the record) as soon as
+    # orderId reaches one of `statuses`, or fails if the order is cancelled
+    # or rejected first. Register before placing the order.
+    def expect_status(self, orderId, statuses):
+        done = request_completion()
+        done.started = time.monotonic()
+        done.add_done_callback(record_order)
+        with self.lock:
+            record = self.latest.get(orderId)
+            if record is None or (record.status not in statuses and
+                                  record.status not in failed_statuses):
+                self.waiters.setdefault(orderId, []).append((statuses, done))
+                return done
+        if record.status in statuses:
+            done.set_result(record)
+        else:
+            done.set_error(202, 'Order ' + record.status)
+        return done
+
+    def wait_for_status(self, orderId, statuses, timeout):
+        done = self.expect_status(orderId, statuses)
+        if not done.wait(timeout):
+            self.forget(orderId, done)
+            return None
+        if done.error is not None:
+            raise Exception("wait_for_status", "error", done.error[1])
+        return done.result
+
+    # IB reported an error against orderId (e.g. 201 order rejected).
+    def fail(self, orderId, errorCode, errorString):
+        with self.lock:
+            waiters = self.waiters.pop(orderId, [])
+        for statuses, done in waiters:
+            done.set_error(errorCode, errorString)
+
+    def fail_all(self, errorCode, errorString):
+        with self.lock:
+            waiters, self.waiters = self.waiters, {}
+        for pending in waiters.values():
+            for statuses, done in pending:
+                done.set_error(errorCode, errorString)
+
+    def forget(self, orderId, done):
+        if not done.done():
+            request_seconds.observe(time.monotonic() - done.started,
+                                    request='order', outcome='timeout')
+        with self.lock:
+            pending = [waiter for waiter in self.waiters.get(orderId, [])
+                       if waiter[1] is not done]
+            if pending:
+                self.waiters[orderId] = pending
+            else:
+                self.waiters.pop(orderId, None)
+
+    # fn(order_status_record) is called for every status message, on the
+    # connection's reader thread.
+    def subscribe(self, fn):
+        with self.lock:
+            self.subscribers.append(fn)
+
+    def unsubscribe(self, fn):
+        with self.lock:
+            self.subscribers.remove(fn)
+
+    def get(self, orderId):
+        with self.lock:
+            return self.latest.get(orderId)
+
+    def waiting(self):
+        with self.lock:
+            return sum(len(waiters) for waiters in self.waiters.values())
+
+    # Latest status of the given orders (all of them by default).
+    def frame(self, order_ids=None):
+        with self.lock:
+            if order_ids is None:
+                records = list(self.latest.values())
+            else:
+                records = [self.latest[i] for i in order_ids
+                           if i in self.latest]
+        return pd.DataFrame([record.as_tuple() for record in records],
+                            columns=order_status_columns)
+
+    def history_frame(self):
+        with self.lock:
+            records = list(self.history or [])
+        return pd.DataFrame([record.as_tuple() for record in records],
+                            columns=order_status_columns)
+
+
+def record_order(done):
+    request_seconds.observe(time.monotonic() - done.started, request='order',
+                            outcome='ok' if done.error is None else 'error')
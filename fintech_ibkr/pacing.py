@@ -0,0 +1,228 @@
+import asyncio
+import itertools
+import threading
+import time
+from collections import deque
+
+from fintech_ibkr.metrics import metrics
+
+# IB's historical data pacing rules:
+#  - no identical request within 15 seconds,
+#  - no more than 6 requests for the same contract/exchange/tick type
+#    within 2 seconds,
+#  - no more than 60 requests within any 10 minute period.
+identical_request_sec = 15
+same_contract_requests = 6
+same_contract_sec = 2
+max_requests = 60
+window_sec = 600
+
+# Lower number goes first: Dash callbacks beat backfills.
+interactive_priority = 0
+batch_priority = 1
+
+pacing_timeout_sec = 600
+# How often a request queued with acquire_async looks again while another
+# request is about to go.
+async_poll_sec = 0.05
+
+priority_names = {interactive_priority: 'interactive',
+                  batch_priority: 'batch'}
+pacing_wait_seconds = metrics.histogram(
+    'ibkr_pacing_wait_seconds',
+    'Time historical data requests waited for pacing clearance',
+    ['priority'])
+pacing_violations = metrics.counter(
+    'ibkr_pacing_violations_total',
+    'Pacing violations IB reported despite the scheduler')
+
+
+# Queues historical data requests and lets each one go only when sending it
+# can't trip a pacing violation. The 60-per-10-minutes allowance is a token
+# bucket whose tokens come back window_sec after they were spent, which is
+# exactly IB's sliding window, so the full allowance can be used. Waiting
+# requests are released in priority order, then first come first served; a
+# request that is held back by the identical/same-contract rules doesn't
+# block the ones behind it.
+class historical_request_scheduler:
+    def __init__(self, max_requests=max_requests, window_sec=window_sec):
+        self.max_requests = max_requests
+        self.window_sec = window_sec
+        self.spent = deque()
+        # request key -> when it was last sent
+        self.last_sent = {}
+        # (contract, tick type) -> deque of send times within same_contract_sec
+        self.contract_sent = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.paused_until = 0.0
+        self.dispatched = 0
+        self.violations = 0
+        self.total_wait_sec = 0.0
+        self.max_wait_sec = 0.0
+
+    # Blocks until the request may be sent and returns how long it waited.
+    def acquire(self, request_key, contract_key, priority=interactive_priority,
+                timeout=pacing_timeout_sec):
+        ticket, queued_at = self.enqueue(request_key, contract_key, priority)
+        with self.condition:
+            while True:
+                taken, delay = self._try_take(ticket, queued_at, timeout)
+                if taken:
+                    return delay
+                self.condition.wait(delay)
+
+    # acquire() for asyncio callers: the wait is an asyncio.sleep rather than
+    # a blocked thread, so any number of requests can queue without tying up
+    # the loop's executor.
+    async def acquire_async(self, request_key, contract_key,
+                            priority=interactive_priority,
+                            timeout=pacing_timeout_sec):
+        ticket, queued_at = self.enqueue(request_key, contract_key, priority)
+        try:
+            while True:
+                taken, delay = self.poll(ticket, queued_at, timeout)
+                if taken:
+                    return delay
+                # nothing wakes a sleeping coroutine when another request
+                # goes, so it looks again now and then
+                await asyncio.sleep(async_poll_sec if delay is None
+                                    else min(delay, async_poll_sec))
+        except asyncio.CancelledError:
+            self.withdraw(ticket)
+            raise
+
+    # The non-blocking parts of acquire(): queue a request, then poll() it
+    # until it's taken, which returns (True, seconds waited), or
+    # (False, seconds until it's worth polling again, or None if unknown).
+    def enqueue(self, request_key, contract_key,
+                priority=interactive_priority):
+        ticket = (priority, next(self.sequence), request_key, contract_key)
+        with self.condition:
+            self.waiting.append(ticket)
+        return ticket, time.monotonic()
+
+    def poll(self, ticket, queued_at, timeout=pacing_timeout_sec):
+        with self.condition:
+            return self._try_take(ticket, queued_at, timeout)
+
+    def withdraw(self, ticket):
+        with self.condition:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+
+    # Must be called with self.condition held.
+    def _try_take(self, ticket, queued_at, timeout):
+        now = time.monotonic()
+        chosen, delay = self._next_ticket(now)
+        if chosen is ticket:
+            self.waiting.remove(ticket)
+            self._spend(ticket, now)
+            waited = now - queued_at
+            self.dispatched += 1
+            self.total_wait_sec += waited
+            self.max_wait_sec = max(self.max_wait_sec, waited)
+            self.condition.notify_all()
+            pacing_wait_seconds.observe(
+                waited, priority=priority_names.get(ticket[0], ticket[0]))
+            return True, waited
+        if timeout is not None and now - queued_at > timeout:
+            self.waiting.remove(ticket)
+            self.condition.notify_all()
+            raise Exception(
+                "historical_request_scheduler",
+                "timeout",
+                "waited too long for historical data pacing"
+            )
+        if chosen is not None:
+            # Another ticket may go now. Its thread takes it and
+            # notify_all()s, which is when it's worth looking again; waking
+            # up before that would only spin on the lock.
+            delay = None
+        if timeout is not None:
+            remaining = queued_at + timeout - now
+            delay = remaining if delay is None else min(delay, remaining)
+        return False, delay
+
+    # IB complained anyway (e.g. requests from another client id): stop
+    # sending for a while and let the window drain.
+    def report_violation(self, backoff_sec=identical_request_sec):
+        pacing_violations.inc()
+        with self.condition:
+            self.violations += 1
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + backoff_sec)
+
+    def stats(self):
+        with self.condition:
+            self._expire(time.monotonic())
+            return {
+                'queue_depth': len(self.waiting),
+                'requests_in_window': len(self.spent),
+                'dispatched': self.dispatched,
+                'violations': self.violations,
+                'total_wait_sec': self.total_wait_sec,
+                'max_wait_sec': self.max_wait_sec,
+                'average_wait_sec':
+                    self.total_wait_sec / self.dispatched
+                    if self.dispatched else 0.0,
+            }
+
+    # Must be called with self.condition held. Returns the ticket that may
+    # go now (or None) and how long to sleep before looking again.
+    def _next_ticket(self, now):
+        self._expire(now)
+        if now < self.paused_until:
+            return None, self.paused_until - now
+        if len(self.spent) >= self.max_requests:
+            return None, self.spent[0] + self.window_sec - now
+        delay = None
+        for ticket in sorted(self.waiting):
+            wait = self._ticket_delay(ticket, now)
+            if wait <= 0:
+                return ticket, 0
+            delay = wait if delay is None else min(delay, wait)
+        return None, delay
+
+    def _ticket_delay(self, ticket, now):
+        priority, sequence, request_key, contract_key = ticket
+        wait = 0.0
+        last_sent = self.last_sent.get(request_key)
+        if last_sent is not None:
+            wait = max(wait, last_sent + identical_request_sec - now)
+        sent = self.contract_sent.get(contract_key)
+        if sent is not None and len(sent) >= same_contract_requests:
+            wait = max(wait, sent[0] + same_contract_sec - now)
+        return wait
+
+    def _spend(self, ticket, now):
+        priority, sequence, request_key, contract_key = ticket
+        self.spent.append(now)
+        self.last_sent[request_key] = now
+        self.contract_sent.setdefault(contract_key, deque()).append(now)
+
+    def _expire(self, now):
+        while self.spent and self.spent[0] + self.window_sec <= now:
+            self.spent.popleft()
+        for key in [key for key, sent in self.last_sent.items()
+                    if sent + identical_request_sec <= now]:
+            del self.last_sent[key]
+        for key in list(self.contract_sent):
+            sent = self.contract_sent[key]
+            while sent and sent[0] + same_contract_sec <= now:
+                sent.popleft()
+            if not sent:
+                del self.contract_sent[key]
+
+
+historical_scheduler = historical_request_scheduler()
+metrics.gauge(
+    'ibkr_pacing_queue_depth',
+    'Historical data requests waiting for pacing clearance'
+).set_function(lambda: len(historical_scheduler.waiting))
+
+
+def pacing_stats():
+    return historical_scheduler.stats()
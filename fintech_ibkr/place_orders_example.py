@@ -58,15 +58,19 @@ lmt_order.account = 'DU1267861'
 # wild options strategy using the account owned by your conservative, careful
 # client who only trades index funds and dividend-paying stocks in the SP500!
 
-# Place orders!
-order_response_stk_lmt = place_order(contract_stk, lmt_order)
-order_response_cp_mkt = place_order(contract_cp, mkt_order)
-order_response_crypto_mkt = place_order(contract_crypto, mkt_order)
+# Place orders! place_orders sends all of them over one connection and waits
+# for all the acknowledgements at once; you get one row back per order.
+order_responses = place_orders([
+    (contract_stk, lmt_order),
+    (contract_cp, mkt_order),
+    (contract_crypto, mkt_order)
+])
 
 # Print the info returned by placing orders:
-print(order_response_stk_lmt)
-print(order_response_crypto_mkt)
-print(order_response_cp_mkt)
+print(order_responses)
 
 # You can select what you want from the response, for example:
-print(order_response_cp_mkt['perm_id'])
+print(order_responses['perm_id'])
+
+# To place the same order in several FA accounts in one go:
+# place_orders([(contract_cp, mkt_order)], accounts=['DU1267861', 'DU1267862'])
@@ -0,0 +1,89 @@
+import threading
+
+
+# One of these is created for every outstanding request. The ibkr_app wrapper
+# callbacks (historicalDataEnd, contractDetailsEnd, orderStatus, error, ...)
+# complete it directly from the reader thread, so whoever is waiting on it
+# wakes up immediately instead of polling every 10 ms.
+class request_completion:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        # (errorCode, errorString) if the request failed
+        self.error = None
+        self.callbacks = []
+        self.callbacks_lock = threading.Lock()
+
+    def set_result(self, result=None):
+        self.result = result
+        self._finish()
+
+    def set_error(self, errorCode, errorString):
+        self.error = (errorCode, errorString)
+        self._finish()
+
+    # fn(completion) is called once the request finishes, from whichever
+    # thread finished it (usually the connection's reader thread), or right
+    # away if it already has.
+    def add_done_callback(self, fn):
+        with self.callbacks_lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self):
+        with self.callbacks_lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def done(self):
+        return self.event.is_set()
+
+    # Returns False if the request didn't finish within timeout seconds.
+    def wait(self, timeout):
+        return self.event.wait(timeout)
+
+
+# Outstanding requests on one connection, keyed by reqId (or orderId, or a
+# name like 'current_time' for the requests that don't carry an id).
+class completion_registry:
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def expect(self, key):
+        completion = request_completion()
+        with self.lock:
+            self.pending[key] = completion
+        return completion
+
+    def is_pending(self, key):
+        with self.lock:
+            return key in self.pending
+
+    def complete(self, key, result=None):
+        with self.lock:
+            completion = self.pending.pop(key, None)
+        if completion is not None:
+            completion.set_result(result)
+        return completion is not None
+
+    def fail(self, key, errorCode, errorString):
+        with self.lock:
+            completion = self.pending.pop(key, None)
+        if completion is not None:
+            completion.set_error(errorCode, errorString)
+        return completion is not None
+
+    def fail_all(self, errorCode, errorString):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for completion in pending.values():
+            completion.set_error(errorCode, errorString)
+
+    def discard(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
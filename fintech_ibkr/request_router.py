@@ -0,0 +1,102 @@
+import time
+
+from fintech_ibkr.columnar_buffer import columnar_buffer
+from fintech_ibkr.metrics import metrics
+from fintech_ibkr.request_completion import completion_registry, \
+    request_completion
+
+request_seconds = metrics.histogram(
+    'ibkr_request_seconds',
+    'Time from sending a request to IB until it finished',
+    ['request', 'outcome'])
+first_bar_seconds = metrics.histogram(
+    'ibkr_first_bar_seconds',
+    'Time from sending a historical data request until its first bar',
+    ['request'])
+
+
+# Everything that belongs to one in-flight request: its own completion,
+# a column buffer for rows (bars, order statuses), a list for objects
+# (contract details) and every error IB reported against its reqId.
+class request_state(request_completion):
+    def __init__(self, kind, columns=None):
+        request_completion.__init__(self)
+        self.kind = kind
+        self.buffer = columnar_buffer(columns) if columns else None
+        self.items = []
+        self.errors = []
+        self.started = time.monotonic()
+        # when the first bar/contract arrived
+        self.first_data = None
+
+
+# Routes wrapper callbacks to the request they belong to by reqId/orderId, so
+# any number of requests can be in flight on one connection without
+# overwriting each other's results.
+class request_router(completion_registry):
+    def expect(self, key, kind=None, columns=None):
+        state = request_state(kind, columns)
+        with self.lock:
+            self.pending[key] = state
+        if kind is not None:
+            state.add_done_callback(record_request)
+        return state
+
+    # For requests without an id (reqCurrentTime): callers that arrive while
+    # one is already in flight wait on that one instead of sending another.
+    # Returns (state, True) if the caller should send the request itself.
+    def expect_shared(self, key, kind=None):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key], False
+            state = request_state(kind)
+            self.pending[key] = state
+        if kind is not None:
+            state.add_done_callback(record_request)
+        return state, True
+
+    def get(self, key):
+        with self.lock:
+            return self.pending.get(key)
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.pending)
+
+    # Pending requests by kind, for the in-flight gauge.
+    def in_flight_by_kind(self):
+        with self.lock:
+            kinds = [state.kind for state in self.pending.values()]
+        counts = {}
+        for kind in kinds:
+            if kind is not None:
+                counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    # The caller gave up waiting: the request never finishes, so its time is
+    # recorded as a timeout here.
+    def discard(self, key):
+        with self.lock:
+            state = self.pending.pop(key, None)
+        if state is not None and state.kind is not None and \
+                not state.done():
+            request_seconds.observe(time.monotonic() - state.started,
+                                    request=state.kind, outcome='timeout')
+
+    def add_error(self, key, errorCode, errorString, fatal=True):
+        state = self.get(key)
+        if state is None:
+            return False
+        state.errors.append((errorCode, errorString))
+        if fatal:
+            self.fail(key, errorCode, errorString)
+        return True
+
+
+def record_request(state):
+    now = time.monotonic()
+    request_seconds.observe(now - state.started, request=state.kind,
+                            outcome='ok' if state.error is None else 'error')
+    if state.first_data is not None and state.buffer is not None:
+        first_bar_seconds.observe(state.first_data - state.started,
+                                  request=state.kind)
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+from fintech_ibkr.durations import bar_size_delta
+
+# The barSizeSetting values IB accepts, finest first.
+bar_sizes = ['1 secs', '5 secs', '10 secs', '15 secs', '30 secs', '1 min',
+             '2 mins', '3 mins', '5 mins', '10 mins', '15 mins', '20 mins',
+             '30 mins', '1 hour', '2 hours', '3 hours', '4 hours', '8 hours',
+             '1 day', '1 week', '1 month']
+resampled_columns = ['date', 'open', 'high', 'low', 'close', 'volume',
+                     'bar_count', 'average']
+# A gap between two bars counts as a break between sessions (overnight, the
+# daily FX break, a weekend) if it's this much longer than one bar. Shorter
+# gaps are just bars IB left out because nothing traded.
+min_session_break_sec = 600
+day_sec = 86400
+
+
+def bar_size_seconds(barSizeSetting):
+    return int(bar_size_delta(barSizeSetting).total_seconds())
+
+
+def is_intraday(barSizeSetting):
+    return bar_size_seconds(barSizeSetting) < day_sec
+
+
+# Whether bars of source_bar_size add up exactly to bars of barSizeSetting:
+# intraday sizes have to divide evenly, and days, weeks and months can be
+# built from any intraday size (and weeks and months from days).
+def can_resample(source_bar_size, barSizeSetting):
+    source = bar_size_seconds(source_bar_size)
+    target = bar_size_seconds(barSizeSetting)
+    if source >= target:
+        return False
+    if target < day_sec:
+        return target % source == 0
+    return source < day_sec or source_bar_size == '1 day'
+
+
+# Bar sizes that barSizeSetting can be built from, coarsest (cheapest to
+# read) first.
+def finer_bar_sizes(barSizeSetting):
+    return [size for size in reversed(bar_sizes)
+            if can_resample(size, barSizeSetting)]
+
+
+# Time of day (in seconds) at which sessions usually open: the most common
+# time of day of the first bar after a session break. 0 if there are no
+# breaks, i.e. trading around the clock.
+def session_open(times, breaks):
+    opens = times[1:][breaks[1:]] % day_sec
+    if not len(opens):
+        return 0
+    values, counts = np.unique(opens, return_counts=True)
+    return int(values[counts.argmax()])
+
+
+# The trading day each bar belongs to, as epoch seconds at midnight. Sessions
+# that open in the afternoon or evening (FX opens at 17:15 New York time)
+# count towards the next calendar day, the way IB dates its daily bars.
+def trading_days(times, open_time):
+    days = (times - open_time) // day_sec * day_sec
+    if open_time >= day_sec // 2:
+        days += day_sec
+    return days
+
+
+# Aggregates `bars` (the columns fetch_historical_data returns, sorted by
+# date) into bars of barSizeSetting: open is the first open, high the
+# highest high, low the lowest low, close the last close, volume and
+# bar_count are summed and average is weighted by volume. Intraday bars are
+# aligned to the clock, like IB's, but never span a session break; a bar
+# that starts before the session opens is dated at the open (the 09:30
+# "hour" bar of a US stock). Daily bars follow the sessions' trading days,
+# weekly and monthly bars are dated by their first trading day.
+# source_bar_size is the size of the bars in `bars`; it's only needed to
+# tell session breaks from ordinary spacing, and is guessed if not given.
+def resample_bars(bars, barSizeSetting, source_bar_size=None):
+    if not len(bars):
+        return pd.DataFrame(columns=resampled_columns)
+    times = bars['date'].values.astype('datetime64[s]').astype('int64')
+    gaps = np.diff(times)
+    if source_bar_size is not None:
+        step = bar_size_seconds(source_bar_size)
+    else:
+        step = int(gaps[gaps > 0].min()) if (gaps > 0).any() else 1
+    breaks = np.empty(len(times), dtype=bool)
+    breaks[0] = True
+    breaks[1:] = gaps - step >= min_session_break_sec
+
+    if is_intraday(barSizeSetting):
+        size = bar_size_seconds(barSizeSetting)
+        session_starts = times[breaks][np.cumsum(breaks) - 1]
+        labels = np.maximum(times - times % size, session_starts)
+    else:
+        labels = trading_days(times, session_open(times, breaks))
+        unit = barSizeSetting.split()[1].lower()
+        if unit.startswith('week'):
+            # Monday of the week; 1970-01-01 was a Thursday
+            keys = labels - (labels // day_sec + 3) % 7 * day_sec
+        elif unit.startswith('month'):
+            keys = labels.astype('datetime64[s]').astype('datetime64[M]') \
+                .astype('int64')
+        else:
+            keys = labels
+        if keys is not labels:
+            # dated by the first trading day in the week or month
+            new_group = np.r_[True, keys[1:] != keys[:-1]]
+            labels = labels[new_group][np.cumsum(new_group) - 1]
+
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    return aggregate_bars(bars, starts,
+                          pd.to_datetime(labels[starts], unit='s'))
+
+
+# At most max_bars bars covering the same time as `bars`, for drawing: runs
+# of consecutive bars are merged into one, dated by the first of them. Unlike
+# resample_bars this ignores the clock and sessions; it's only about how
+# many candles the chart has to draw.
+def downsample_bars(bars, max_bars):
+    if len(bars) <= max_bars:
+        return bars
+    per_bar = -(-len(bars) // max_bars)
+    starts = np.arange(0, len(bars), per_bar)
+    return aggregate_bars(bars, starts, bars['date'].values[starts])
+
+
+# One bar per run of rows starting at each index in `starts` (ascending):
+# first open, highest high, lowest low, last close, summed volume and
+# bar_count, volume-weighted average. Any other columns (indicators, say)
+# are taken from the last row of the run, like the close.
+def aggregate_bars(bars, starts, dates):
+    ends = np.r_[starts[1:], len(bars)] - 1
+
+    def column(name):
+        return pd.to_numeric(bars[name]).to_numpy(dtype=float)
+
+    volume = column('volume')
+    bar_count = column('bar_count')
+    average = column('average')
+    # IB sends -1 where there's no volume (MIDPOINT, BID, ASK, ...).
+    has_volume = np.maximum.reduceat(volume, starts) >= 0
+    weights = np.where(volume > 0, volume, 0.0)
+    weight_sums = np.add.reduceat(weights, starts)
+    weighted = np.add.reduceat(average * weights, starts)
+    plain = np.add.reduceat(average, starts) / (ends - starts + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages = np.where(weight_sums > 0, weighted / weight_sums, plain)
+
+    aggregated = pd.DataFrame({
+        'date': dates,
+        'open': column('open')[starts],
+        'high': np.maximum.reduceat(column('high'), starts),
+        'low': np.minimum.reduceat(column('low'), starts),
+        'close': column('close')[ends],
+        'volume': np.where(has_volume, np.add.reduceat(
+            np.where(volume >= 0, volume, 0.0), starts), -1.0),
+        'bar_count': np.where(has_volume, np.add.reduceat(
+            np.where(bar_count >= 0, bar_count, 0.0), starts), -1.0)
+        .astype('int64'),
+        'average': averages,
+    }, columns=resampled_columns)
+    for name in bars.columns:
+        if name not in resampled_columns:
+            aggregated[name] = bars[name].to_numpy()[ends]
+    return aggregated
@@ -0,0 +1,617 @@
+import argparse
+import math
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from fintech_ibkr.durations import parse_duration, parse_end_date_time, \
+    bar_size_delta
+
+# A stand-in for TWS / IB Gateway that speaks enough of the socket protocol
+# for ibkr_app: the handshake, startApi, reqIds, reqCurrentTime,
+# reqContractDetails, reqHistoricalData (including keepUpToDate), reqMktData,
+# reqTickByTickData, placeOrder and cancelOrder. Bars are synthetic but
+# deterministic, so overlapping requests agree with each other; ticks follow
+# the same prices. Run it with
+#   python -m fintech_ibkr.simulator --port 7499 --latency 0.05
+# and point the fetch functions at port=7499.
+
+# Message layouts below are the ones ibapi's decoder expects at this server
+# version.
+simulator_server_version = 140
+default_simulator_port = 7499
+default_accounts = 'DU0000001,DU0000002'
+first_valid_id = 1
+
+# incoming message ids
+start_api_msg, req_ids_msg, req_current_time_msg = 71, 8, 49
+req_contract_data_msg, req_historical_data_msg = 9, 20
+cancel_historical_data_msg, place_order_msg, cancel_order_msg = 25, 3, 4
+req_managed_accts_msg = 17
+req_mkt_data_msg, cancel_mkt_data_msg = 1, 2
+req_tick_by_tick_data_msg, cancel_tick_by_tick_data_msg = 97, 98
+# outgoing message ids
+order_status_msg, error_msg, next_valid_id_msg = 3, 4, 9
+contract_data_msg, managed_accts_msg, historical_data_msg = 10, 15, 17
+current_time_msg, contract_data_end_msg = 49, 52
+historical_data_update_msg = 90
+tick_price_msg, tick_size_msg, tick_by_tick_msg = 1, 2, 99
+# tick types
+bid_tick, ask_tick, last_tick, volume_tick = 1, 2, 4, 8
+tick_by_tick_types = {'Last': 1, 'AllLast': 2, 'BidAsk': 3, 'MidPoint': 4}
+
+no_data_message = 'Historical Market Data Service error message:HMDS query ' \
+                  'returned no data: '
+pacing_violation_message = 'Historical Market Data Service error message:' \
+                           'Historical data request pacing violation'
+
+
+# The simulator's knobs. Every field can also be changed while it's running.
+class simulator_settings:
+    def __init__(self, latency_sec=0.0, latency_jitter_sec=0.0,
+                 max_bars=100000, bars_per_sec=0, update_interval_sec=1.0,
+                 pacing_limit=60, pacing_window_sec=600,
+                 pacing_error_rate=0.0, disconnect_rate=0.0,
+                 disconnect_after=None, fill_delay_sec=0.5,
+                 order_reject_rate=0.0, accounts=default_accounts,
+                 tick_interval_sec=0.25, spread=0.0002):
+        # delay before every answer: latency_sec plus up to
+        # latency_jitter_sec more
+        self.latency_sec = latency_sec
+        self.latency_jitter_sec = latency_jitter_sec
+        # longest historical answer; longer requests get the newest max_bars
+        self.max_bars = max_bars
+        # how fast historical bars are "transferred"; 0 means instantly
+        self.bars_per_sec = bars_per_sec
+        # how often keepUpToDate subscriptions get a historicalDataUpdate
+        self.update_interval_sec = update_interval_sec
+        # more than pacing_limit historical requests in pacing_window_sec
+        # (None for no limit) are answered with a pacing violation, as are
+        # a random pacing_error_rate of all of them
+        self.pacing_limit = pacing_limit
+        self.pacing_window_sec = pacing_window_sec
+        self.pacing_error_rate = pacing_error_rate
+        # chance that any request drops the connection instead of being
+        # answered, and a hard limit on requests per connection
+        self.disconnect_rate = disconnect_rate
+        self.disconnect_after = disconnect_after
+        # orders go Submitted straight away and Filled this much later
+        self.fill_delay_sec = fill_delay_sec
+        self.order_reject_rate = order_reject_rate
+        self.accounts = accounts
+        # market data subscriptions get a quote (and, for stocks, a trade)
+        # this often, spread apart around the synthetic price
+        self.tick_interval_sec = tick_interval_sec
+        self.spread = spread
+
+
+def encode_message(fields):
+    payload = ''.join(str(field) + '\0' for field in fields).encode()
+    return struct.pack('!I', len(payload)) + payload
+
+
+# A price in (0.5, 1.5) for `moment` that only depends on the series and the
+# moment, so every request sees the same bars.
+def synthetic_price(seed, moment):
+    seconds = (moment - datetime(1970, 1, 1)).total_seconds()
+    noise = zlib.crc32((seed + str(int(seconds))).encode()) / 2 ** 32 - 0.5
+    return 1.0 + 0.3 * math.sin(seconds / 864000.0) + \
+        0.05 * math.sin(seconds / 3600.0) + 0.002 * noise
+
+
+def synthetic_bar(seed, moment, step, with_volume):
+    open_price = synthetic_price(seed, moment)
+    close = synthetic_price(seed, moment + step)
+    middle = synthetic_price(seed, moment + step / 2)
+    high = max(open_price, close, middle)
+    low = min(open_price, close, middle)
+    if with_volume:
+        volume = 100 + zlib.crc32((seed + str(moment)).encode()) % 10000
+        bar_count = volume // 10
+    else:
+        # what IB sends for MIDPOINT, BID, ASK, ...
+        volume, bar_count = -1, -1
+    average = round((high + low + close) / 3, 5)
+    return [round(open_price, 5), round(high, 5), round(low, 5),
+            round(close, 5), volume, average, bar_count]
+
+
+def format_bar_date(moment, step, formatDate):
+    if formatDate == 2:
+        return str(int((moment - datetime(1970, 1, 1)).total_seconds()))
+    if step >= timedelta(days=1):
+        return moment.strftime('%Y%m%d')
+    return moment.strftime('%Y%m%d  %H:%M:%S')
+
+
+# Start times of the bars covering [end - duration, end], aligned to the bar
+# size; the last one may still be forming. Like IB's FX data, there's nothing
+# on Saturdays.
+def bar_times(end, duration, step, max_bars):
+    step_sec = step.total_seconds()
+    epoch = datetime(1970, 1, 1)
+    last = epoch + timedelta(seconds=math.floor(
+        (end - epoch).total_seconds() / step_sec) * step_sec)
+    times = []
+    moment = last
+    while moment >= end - duration and len(times) < max_bars:
+        if moment.weekday() != 5:
+            times.append(moment)
+        moment -= step
+    times.reverse()
+    return times
+
+
+class ib_simulator(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=default_simulator_port,
+                 settings=None):
+        self.settings = settings or simulator_settings()
+        self.client_ids = set()
+        self.next_perm_id = 1000
+        self.pacing_log = []
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        socketserver.ThreadingTCPServer.__init__(self, (host, port),
+                                                 simulator_session)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def perm_id(self):
+        with self.lock:
+            self.next_perm_id += 1
+            return self.next_perm_id
+
+    # Whether one more historical request now would break the pacing limit.
+    def pacing_violation(self):
+        settings = self.settings
+        if random.random() < settings.pacing_error_rate:
+            return True
+        if settings.pacing_limit is None:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.pacing_log = [t for t in self.pacing_log
+                               if now - t < settings.pacing_window_sec]
+            if len(self.pacing_log) >= settings.pacing_limit:
+                return True
+            self.pacing_log.append(now)
+        return False
+
+
+# One client connection.
+class simulator_session(socketserver.BaseRequestHandler):
+    def setup(self):
+        # Answers are small and the client waits on each one; without this,
+        # Nagle's algorithm and the client's delayed ACK hold them back ~40 ms.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.write_lock = threading.Lock()
+        self.connected = True
+        self.client_id = None
+        self.request_count = 0
+        # reqId -> threading.Event that stops a keepUpToDate subscription
+        self.subscriptions = {}
+        self.next_order_id = first_valid_id
+
+    def handle(self):
+        if self.read_exactly(4) != b'API\0':
+            return
+        self.read_message()
+        # server version and connection time, length-prefixed like the rest
+        self.send([simulator_server_version,
+                   datetime.now().strftime('%Y%m%d %H:%M:%S') + ' EST'])
+        while self.connected:
+            fields = self.read_message()
+            if fields is None:
+                break
+            self.dispatch(fields)
+
+    def finish(self):
+        self.connected = False
+        for stop in self.subscriptions.values():
+            stop.set()
+        with self.server.lock:
+            self.server.client_ids.discard(self.client_id)
+
+    def read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            try:
+                chunk = self.request.recv(size - len(data))
+            except OSError:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def read_message(self):
+        header = self.read_exactly(4)
+        if header is None:
+            return None
+        payload = self.read_exactly(struct.unpack('!I', header)[0])
+        if payload is None:
+            return None
+        return payload.decode().split('\0')[:-1]
+
+    def send(self, fields):
+        self.send_bytes(encode_message(fields))
+
+    def send_bytes(self, data):
+        with self.write_lock:
+            if not self.connected:
+                return
+            try:
+                self.request.sendall(data)
+            except OSError:
+                self.connected = False
+
+    def disconnect(self):
+        self.connected = False
+        try:
+            self.request.shutdown(2)
+        except OSError:
+            pass
+
+    def error(self, reqId, errorCode, errorString):
+        self.send([error_msg, 2, reqId, errorCode, errorString])
+
+    # Runs fn after the configured latency, on its own thread, so slow
+    # answers don't hold up the requests behind them.
+    def later(self, fn, *args, delay=0.0):
+        settings = self.server.settings
+        delay += settings.latency_sec + \
+            random.random() * settings.latency_jitter_sec
+        if delay <= 0:
+            fn(*args)
+            return
+        timer = threading.Timer(delay, fn, args)
+        timer.daemon = True
+        timer.start()
+
+    def dispatch(self, fields):
+        msg_id = int(fields[0])
+        settings = self.server.settings
+        if msg_id != start_api_msg:
+            self.request_count += 1
+            if random.random() < settings.disconnect_rate or (
+                    settings.disconnect_after is not None and
+                    self.request_count > settings.disconnect_after):
+                self.server.count('disconnects')
+                self.disconnect()
+                return
+        handler = {
+            start_api_msg: self.start_api,
+            req_ids_msg: self.req_ids,
+            req_current_time_msg: self.req_current_time,
+            req_managed_accts_msg: self.req_managed_accts,
+            req_contract_data_msg: self.req_contract_data,
+            req_historical_data_msg: self.req_historical_data,
+            cancel_historical_data_msg: self.cancel_historical_data,
+            req_mkt_data_msg: self.req_mkt_data,
+            cancel_mkt_data_msg: self.cancel_subscription,
+            req_tick_by_tick_data_msg: self.req_tick_by_tick_data,
+            cancel_tick_by_tick_data_msg: self.cancel_subscription,
+            place_order_msg: self.place_order,
+            cancel_order_msg: self.cancel_order,
+        }.get(msg_id)
+        if handler is not None:
+            self.server.count(handler.__name__)
+            handler(fields)
+
+    def start_api(self, fields):
+        client_id = int(fields[2])
+        with self.server.lock:
+            in_use = client_id in self.server.client_ids
+            if not in_use:
+                self.server.client_ids.add(client_id)
+                self.client_id = client_id
+        if in_use:
+            self.error(-1, 326, 'Unable to connect as the client id is '
+                                'already in use. Retry with a unique client '
+                                'id.')
+            self.disconnect()
+            return
+        self.send_all([[managed_accts_msg, 1, self.server.settings.accounts],
+                       [next_valid_id_msg, 1, self.next_order_id]])
+
+    def req_ids(self, fields):
+        self.later(self.send, [next_valid_id_msg, 1, self.next_order_id])
+
+    def req_current_time(self, fields):
+        self.later(lambda: self.send([current_time_msg, 1,
+                                      int(time.time())]))
+
+    def req_managed_accts(self, fields):
+        self.later(self.send,
+                   [managed_accts_msg, 1, self.server.settings.accounts])
+
+    # [9, version, reqId, conId, symbol, secType, lastTradeDate, strike,
+    #  right, multiplier, exchange, primaryExchange, currency, localSymbol,
+    #  tradingClass, includeExpired, secIdType, secId]
+    def req_contract_data(self, fields):
+        reqId = int(fields[2])
+        symbol, sec_type = fields[4], fields[5]
+        exchange, primary_exchange, currency = fields[10], fields[11], \
+            fields[12]
+        if sec_type not in ['CASH', 'STK'] or not symbol.isalpha() or \
+                not currency.isalpha():
+            self.later(self.error, reqId, 200,
+                       'No security definition has been found for the '
+                       'request')
+            return
+        local_symbol = symbol + '.' + currency if sec_type == 'CASH' \
+            else symbol
+        con_id = zlib.crc32((symbol + sec_type + currency).encode()) % \
+            100000000
+        details = [
+            contract_data_msg, 8, reqId, symbol, sec_type, '', 0.0, '',
+            exchange or 'IDEALPRO', currency, local_symbol, local_symbol,
+            local_symbol, con_id, 0.00005, 1, '',
+            'ACTIVETIM,AD,ADJUST,ALERT,ALLOC,AVGCOST,BASKET,LMT,MKT,STP',
+            exchange or 'IDEALPRO', 1, 0, symbol + ' ' + currency,
+            primary_exchange, '', '', '', '', 'US/Eastern',
+            '', '', '', 0, 0, 0, '', '', '239', ''
+        ]
+        self.later(self.send_all, [
+            details, [contract_data_end_msg, 1, reqId]])
+
+    # Several messages in one write, the way TWS sends an answer.
+    def send_all(self, messages):
+        self.send_bytes(b''.join(encode_message(fields)
+                                 for fields in messages))
+
+    # [20, reqId, conId, symbol, secType, lastTradeDate, strike, right,
+    #  multiplier, exchange, primaryExchange, currency, localSymbol,
+    #  tradingClass, includeExpired, endDateTime, barSizeSetting,
+    #  durationStr, useRTH, whatToShow, formatDate, keepUpToDate,
+    #  chartOptions]
+    def req_historical_data(self, fields):
+        reqId = int(fields[1])
+        symbol, currency = fields[3], fields[11]
+        end_date_time, bar_size, duration = fields[15], fields[16], fields[17]
+        what_to_show, format_date = fields[19], int(fields[20])
+        keep_up_to_date = fields[21] == '1'
+        settings = self.server.settings
+        if self.server.pacing_violation():
+            self.server.count('pacing_violations')
+            self.later(self.error, reqId, 162, pacing_violation_message)
+            return
+        try:
+            end = parse_end_date_time(end_date_time)
+            step = bar_size_delta(bar_size)
+            span = parse_duration(duration)
+        except Exception:
+            self.later(self.error, reqId, 321,
+                       'Error validating request: invalid historical data '
+                       'query')
+            return
+        seed = symbol + currency + bar_size + what_to_show
+        with_volume = what_to_show == 'TRADES'
+        times = bar_times(end, span, step, settings.max_bars)
+        if not times:
+            self.later(self.error, reqId, 162, no_data_message + 'simulated')
+            return
+        message = [historical_data_msg, reqId,
+                   (end - span).strftime('%Y%m%d  %H:%M:%S'),
+                   end.strftime('%Y%m%d  %H:%M:%S'), len(times)]
+        for moment in times:
+            message.append(format_bar_date(moment, step, format_date))
+            message.extend(synthetic_bar(seed, moment, step, with_volume))
+        delay = len(times) / settings.bars_per_sec \
+            if settings.bars_per_sec else 0.0
+        self.later(self.send, message, delay=delay)
+        if keep_up_to_date:
+            stop = threading.Event()
+            self.subscriptions[reqId] = stop
+            thread = threading.Thread(
+                target=self.stream_updates,
+                args=(reqId, stop, seed, step, format_date, with_volume),
+                daemon=True)
+            thread.start()
+
+    def stream_updates(self, reqId, stop, seed, step, format_date,
+                       with_volume):
+        settings = self.server.settings
+        while not stop.wait(settings.update_interval_sec) and self.connected:
+            now = datetime.now()
+            moment = bar_times(now, step, step, 1)
+            if not moment:
+                continue
+            bar = synthetic_bar(seed, moment[-1], now - moment[-1],
+                                with_volume)
+            open_price, high, low, close, volume, average, bar_count = bar
+            self.send([historical_data_update_msg, reqId, bar_count,
+                       format_bar_date(moment[-1], step, format_date),
+                       open_price, close, high, low, average, volume])
+            self.server.count('historical_data_updates')
+
+    def cancel_historical_data(self, fields):
+        stop = self.subscriptions.pop(int(fields[2]), None)
+        if stop is not None:
+            stop.set()
+
+    # [1, version, reqId, conId, symbol, secType, lastTradeDate, strike,
+    #  right, multiplier, exchange, primaryExchange, currency, localSymbol,
+    #  tradingClass, deltaNeutral, genericTickList, snapshot, ...]
+    def req_mkt_data(self, fields):
+        reqId = int(fields[2])
+        symbol, sec_type, currency = fields[4], fields[5], fields[12]
+        snapshot = fields[17] == '1'
+        self.start_ticks(reqId, self.market_data_ticks, symbol + currency,
+                         sec_type != 'CASH', snapshot)
+
+    # [97, reqId, conId, symbol, secType, lastTradeDate, strike, right,
+    #  multiplier, exchange, primaryExchange, currency, localSymbol,
+    #  tradingClass, tickType, numberOfTicks, ignoreSize]
+    def req_tick_by_tick_data(self, fields):
+        reqId = int(fields[1])
+        symbol, currency, tick_type = fields[3], fields[11], fields[14]
+        if tick_type not in tick_by_tick_types:
+            self.later(self.error, reqId, 10189,
+                       'Failed to request tick-by-tick data:invalid tick '
+                       'type ' + tick_type)
+            return
+        self.start_ticks(reqId, self.tick_by_tick_ticks, symbol + currency,
+                         tick_by_tick_types[tick_type], False)
+
+    def start_ticks(self, reqId, send_ticks, seed, kind, snapshot):
+        stop = threading.Event()
+        self.subscriptions[reqId] = stop
+        threading.Thread(target=self.stream_ticks,
+                         args=(reqId, stop, send_ticks, seed, kind, snapshot),
+                         daemon=True).start()
+
+    def stream_ticks(self, reqId, stop, send_ticks, seed, kind, snapshot):
+        settings = self.server.settings
+        volume = 0
+        while self.connected:
+            now = datetime.now()
+            price = synthetic_price(seed, now)
+            bid = round(price - settings.spread / 2, 5)
+            ask = round(price + settings.spread / 2, 5)
+            size = 100 + zlib.crc32((seed + str(now)).encode()) % 900
+            volume += size
+            send_ticks(reqId, kind, now, bid, ask, size, volume)
+            self.server.count('ticks')
+            if snapshot or stop.wait(settings.tick_interval_sec):
+                break
+
+    # kind is whether there are trades (stocks) or only quotes (FX).
+    def market_data_ticks(self, reqId, kind, now, bid, ask, size, volume):
+        messages = [[tick_price_msg, 6, reqId, bid_tick, bid, size, 0],
+                    [tick_price_msg, 6, reqId, ask_tick, ask, size, 0]]
+        if kind:
+            messages += [[tick_price_msg, 6, reqId, last_tick,
+                          round((bid + ask) / 2, 5), size // 10, 0],
+                         [tick_size_msg, 6, reqId, volume_tick, volume]]
+        self.later(self.send_all, messages)
+
+    def tick_by_tick_ticks(self, reqId, kind, now, bid, ask, size, volume):
+        epoch = int(time.mktime(now.timetuple()))
+        if kind in [1, 2]:
+            message = [tick_by_tick_msg, reqId, kind, epoch,
+                       round((bid + ask) / 2, 5), size // 10, 0, 'IDEALPRO',
+                       '']
+        elif kind == 3:
+            message = [tick_by_tick_msg, reqId, kind, epoch, bid, ask, size,
+                       size, 0]
+        else:
+            message = [tick_by_tick_msg, reqId, kind, epoch,
+                       round((bid + ask) / 2, 5)]
+        self.later(self.send, message)
+
+    def cancel_subscription(self, fields):
+        reqId = int(fields[2] if int(fields[0]) == cancel_mkt_data_msg
+                    else fields[1])
+        stop = self.subscriptions.pop(reqId, None)
+        if stop is not None:
+            stop.set()
+
+    # [3, version, orderId, conId, symbol, secType, lastTradeDate, strike,
+    #  right, multiplier, exchange, primaryExchange, currency, localSymbol,
+    #  tradingClass, secIdType, secId, action, totalQuantity, orderType,
+    #  lmtPrice, ...]
+    def place_order(self, fields):
+        order_id = int(fields[2])
+        quantity = float(fields[18])
+        settings = self.server.settings
+        self.next_order_id = max(self.next_order_id, order_id + 1)
+        if random.random() < settings.order_reject_rate:
+            self.later(self.error, order_id, 201,
+                       'Order rejected - reason:simulated rejection')
+            return
+        perm_id = self.server.perm_id()
+        price = round(synthetic_price(fields[4] + fields[12], datetime.now()),
+                      5)
+        self.later(self.order_status, order_id, 'Submitted', 0.0, quantity,
+                   0.0, perm_id, 0.0)
+        self.later(self.order_status, order_id, 'Filled', quantity, 0.0,
+                   price, perm_id, price, delay=settings.fill_delay_sec)
+
+    def order_status(self, order_id, status, filled, remaining, avg_price,
+                     perm_id, last_price):
+        self.send([order_status_msg, order_id, status, filled, remaining,
+                   avg_price, perm_id, 0, last_price, self.client_id, '',
+                   0.0])
+
+    def cancel_order(self, fields):
+        order_id = int(fields[2])
+        self.later(self.send_all, [
+            [order_status_msg, order_id, 'Cancelled', 0.0, 0.0, 0.0, 0, 0,
+             0.0, self.client_id, '', 0.0],
+            [error_msg, 2, order_id, 202, 'Order Canceled - reason:'],
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for TWS / IB Gateway')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=default_simulator_port)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each answer')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this many extra seconds of latency')
+    parser.add_argument('--bars-per-sec', type=float, default=0,
+                        help='historical transfer rate (0 = instant)')
+    parser.add_argument('--max-bars', type=int, default=100000)
+    parser.add_argument('--update-interval', type=float, default=1.0)
+    parser.add_argument('--pacing-limit', type=int, default=60,
+                        help='historical requests per pacing window '
+                             '(0 = no limit)')
+    parser.add_argument('--pacing-window', type=float, default=600)
+    parser.add_argument('--pacing-error-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-after', type=int, default=None)
+    parser.add_argument('--fill-delay', type=float, default=0.5)
+    parser.add_argument('--reject-rate', type=float, default=0.0)
+    parser.add_argument('--tick-interval', type=float, default=0.25)
+    args = parser.parse_args()
+    settings = simulator_settings(
+        latency_sec=args.latency, latency_jitter_sec=args.jitter,
+        max_bars=args.max_bars, bars_per_sec=args.bars_per_sec,
+        update_interval_sec=args.update_interval,
+        pacing_limit=args.pacing_limit or None,
+        pacing_window_sec=args.pacing_window,
+        pacing_error_rate=args.pacing_error_rate,
+        disconnect_rate=args.disconnect_rate,
+        disconnect_after=args.disconnect_after,
+        fill_delay_sec=args.fill_delay, order_reject_rate=args.reject_rate,
+        tick_interval_sec=args.tick_interval)
+    server = ib_simulator(args.host, args.port, settings)
+    print('IB simulator listening on ' + args.host + ':' + str(server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import copy
+import threading
+from concurrent.futures import Future
+
+from fintech_ibkr.metrics import metrics
+
+coalesced_calls = metrics.counter(
+    'ibkr_coalesced_requests_total',
+    'Calls that waited on an identical call already in flight instead of '
+    'making their own request, by request', ['request'])
+
+
+# Coalesces identical calls that overlap in time. The first caller for a key
+# runs the call; anyone asking for the same key while it's running waits for
+# that call and gets its result (or its exception) instead of sending IB the
+# same request again. Once the call finishes the key is forgotten, so later
+# callers start a new one; remembering results is the caches' job, not this.
+# Waiters get a copy of the result, so nobody can change someone else's
+# frame.
+class single_flight:
+    def __init__(self, name):
+        self.name = name
+        # key -> Future of the call in flight
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = Future()
+        if not is_leader:
+            coalesced_calls.inc(request=self.name)
+            return copy.copy(call.result())
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.forget(key)
+            call.set_exception(e)
+            raise
+        self.forget(key)
+        call.set_result(result)
+        return result
+
+    def forget(self, key):
+        with self.lock:
+            self.calls.pop(key, None)
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls)
@@ -0,0 +1,207 @@
+import threading
+import time
+
+import pandas as pd
+
+from fintech_ibkr.columnar_buffer import parse_bar_dates
+from fintech_ibkr.connection_pool import get_pool
+from fintech_ibkr.contract_keys import contract_key
+from fintech_ibkr.durations import normalize_bar_size
+from fintech_ibkr.pacing import historical_scheduler, interactive_priority
+from fintech_ibkr.request_completion import request_completion
+from fintech_ibkr.synchronous_functions import ibkr_app, default_hostname, \
+    default_port, default_client_id, timeout_sec, historical_timeout_sec, \
+    bar_columns, historical_pacing_keys
+
+# A subscription nobody has polled for this long is cancelled.
+stream_idle_sec = 120
+reap_interval_sec = 30
+
+
+# The bars of one keepUpToDate=True historical data subscription. IB first
+# sends the history (historicalData ... historicalDataEnd) and then keeps
+# sending historicalDataUpdate for the bar that's currently forming; when a
+# bar with a new date shows up, the previous one is final.
+class bar_stream:
+    def __init__(self, key):
+        self.key = key
+        # bar tuples in bar_columns order; dates are IB's strings until
+        # they're handed out
+        self.rows = []
+        self.lock = threading.Lock()
+        self.ready = request_completion()
+        self.error = None
+        self.last_polled = time.monotonic()
+        self.app = None
+        self.reqId = None
+        self.pool = None
+
+    def add_bar(self, bar):
+        with self.lock:
+            self.rows.append((bar.date, bar.open, bar.high, bar.low,
+                              bar.close, bar.volume, bar.barCount,
+                              bar.average))
+
+    def update_bar(self, bar):
+        row = (bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume,
+               bar.barCount, bar.average)
+        with self.lock:
+            if self.rows and self.rows[-1][0] == bar.date:
+                self.rows[-1] = row
+            else:
+                self.rows.append(row)
+
+    def end(self):
+        self.ready.set_result()
+
+    def fail(self, errorCode, errorString):
+        self.error = (errorCode, errorString)
+        self.ready.set_error(errorCode, errorString)
+
+    def snapshot(self):
+        with self.lock:
+            rows = list(self.rows)
+        self.last_polled = time.monotonic()
+        return rows_to_frame(rows)
+
+    # What changed since the caller last saw `cursor` final bars: the newly
+    # finalized bars, the bar that's still forming (a 0 or 1 row frame), and
+    # the cursor to pass next time.
+    def updates(self, cursor):
+        with self.lock:
+            rows = self.rows[cursor:]
+            completed = len(self.rows) - 1
+        self.last_polled = time.monotonic()
+        return rows_to_frame(rows[:-1]), rows_to_frame(rows[-1:]), \
+            max(completed, cursor)
+
+
+def rows_to_frame(rows):
+    frame = pd.DataFrame(rows, columns=bar_columns)
+    frame['date'] = parse_bar_dates(frame['date'])
+    return frame
+
+
+streams = {}
+streams_lock = threading.Lock()
+reaper = None
+
+
+def stream_key(contract, durationStr, barSizeSetting, whatToShow, useRTH):
+    return '|'.join(str(i) for i in contract_key(contract)) + '|' + \
+        '|'.join([durationStr, normalize_bar_size(barSizeSetting), whatToShow,
+                  str(int(bool(int(useRTH))))])
+
+
+# Opens (or joins) a keepUpToDate subscription on a pooled connection and
+# returns its key once the initial history has arrived. Identical
+# subscriptions are shared, so several charts on the same series cost IB one
+# request.
+def subscribe_historical_bars(contract, durationStr='1 D',
+                              barSizeSetting='1 min', whatToShow='MIDPOINT',
+                              useRTH=True, hostname=default_hostname,
+                              port=default_port, client_id=default_client_id,
+                              priority=interactive_priority):
+    key = stream_key(contract, durationStr, barSizeSetting, whatToShow, useRTH)
+    with streams_lock:
+        stream = streams.get(key)
+        failed = stream if stream is not None and \
+            stream.error is not None else None
+        is_new = stream is None or failed is not None
+        if is_new:
+            stream = bar_stream(key)
+            streams[key] = stream
+        start_reaper()
+    if failed is not None:
+        # release what the failed subscription still holds before it's out
+        # of reach of the reaper
+        close_stream(failed)
+
+    if is_new:
+        try:
+            historical_scheduler.acquire(
+                *historical_pacing_keys(contract, '', durationStr,
+                                        barSizeSetting, whatToShow, useRTH),
+                priority=priority)
+            stream.pool = get_pool(ibkr_app, hostname, port, client_id)
+            stream.app = stream.pool.acquire(timeout_sec)
+        except Exception as e:
+            stream.fail(504, str(e.args[-1]))
+            close_stream(stream)
+            raise
+        stream.reqId = stream.app.next_request_id()
+        stream.app.streams[stream.reqId] = stream
+        stream.app.reqHistoricalData(
+            stream.reqId, contract, '', durationStr, barSizeSetting,
+            whatToShow, useRTH, formatDate=1, keepUpToDate=True,
+            chartOptions=[])
+
+    if not stream.ready.wait(historical_timeout_sec):
+        close_stream(stream)
+        raise Exception(
+            "subscribe_historical_bars",
+            "timeout",
+            "historical_data not received"
+        )
+    if stream.error is not None:
+        close_stream(stream)
+        raise Exception("subscribe_historical_bars", "error", stream.error[1])
+    return key
+
+
+def get_stream(key):
+    with streams_lock:
+        stream = streams.get(key)
+    if stream is None:
+        raise Exception("get_stream", "error", "no such subscription: " + key)
+    if stream.error is not None:
+        raise Exception("get_stream", "error", stream.error[1])
+    return stream
+
+
+def stream_snapshot(key):
+    return get_stream(key).snapshot()
+
+
+def stream_updates(key, cursor):
+    return get_stream(key).updates(cursor)
+
+
+def cancel_stream(key):
+    with streams_lock:
+        stream = streams.get(key)
+    if stream is not None:
+        close_stream(stream)
+
+
+def close_stream(stream):
+    with streams_lock:
+        if streams.get(stream.key) is stream:
+            del streams[stream.key]
+        app, stream.app = stream.app, None
+    if app is None:
+        return
+    app.streams.pop(stream.reqId, None)
+    if app.isConnected():
+        app.cancelHistoricalData(stream.reqId)
+    stream.pool.release(app)
+
+
+def start_reaper():
+    global reaper
+    if reaper is None:
+        reaper = threading.Thread(target=reap_idle_streams, daemon=True)
+        reaper.start()
+
+
+def reap_idle_streams():
+    while True:
+        time.sleep(reap_interval_sec)
+        now = time.monotonic()
+        with streams_lock:
+            idle = [stream for stream in streams.values()
+                    if stream.ready.done() and (
+                        stream.error is not None or
+                        now - stream.last_polled > stream_idle_sec)]
+        for stream in idle:
+            close_stream(stream)
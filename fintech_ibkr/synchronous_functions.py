@@ -1,139 +1,222 @@
-from datetime import datetime
+import copy
+import time
+from datetime import datetime, timedelta
 
+import numpy as np
 import pandas as pd
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
 import threading
-import time
+
+from fintech_ibkr.backfill import backfill_job, max_window
+from fintech_ibkr.bar_store import get_bar_store, default_bar_store_path
+from fintech_ibkr.client_ids import client_id_in_use_error
+from fintech_ibkr.columnar_buffer import columnar_buffer, parse_bar_dates
+from fintech_ibkr.connection_pool import get_pool, pools
+from fintech_ibkr.contract_cache import contract_cache, contract_cache_stats, \
+    cache_lookups
+from fintech_ibkr.contract_keys import contract_key
+from fintech_ibkr.durations import parse_duration, parse_end_date_time, \
+    format_end_date_time, duration_for, bar_size_delta
+from fintech_ibkr.metrics import metrics, metrics_text
+from fintech_ibkr.order_store import order_status_store, order_status_columns
+from fintech_ibkr.pacing import historical_scheduler, interactive_priority, \
+    batch_priority, pacing_stats
+from fintech_ibkr.request_router import request_router
+from fintech_ibkr.resample import resample_bars, finer_bar_sizes
+from fintech_ibkr.single_flight import single_flight
 
 # If you want different default values, configure it here.
 default_hostname = '127.0.0.1'
 default_port = 7497
 default_client_id = 10645 # can set and use your Master Client ID
 timeout_sec = 5
+historical_timeout_sec = 60
+order_timeout_sec = 30
+
+# Error codes that are only warnings/notices and shouldn't fail a request
+# (market data farm messages, delayed data notices, order warnings, ...).
+informational_error_codes = set(range(2100, 2200)) | {399, 10167}
+
+error_columns = ['reqId', 'errorCode', 'errorString']
+# How many of a connection's latest errors ibkr_app.error_messages keeps;
+# pooled connections live for days, and every error is counted in
+# ibkr_errors_total anyway.
+max_error_messages = 1000
+bar_columns = ['date', 'open', 'high', 'low', 'close', 'volume', 'bar_count',
+               'average']
+
+ib_errors = metrics.counter(
+    'ibkr_errors_total', 'Errors and notices IB sent, by error code',
+    ['code'])
+
+# Identical requests that are in flight at the same time (a double click,
+# two users opening the same chart) are sent to IB once; see
+# single_flight.py.
+contract_details_flights = single_flight('contract_details')
+historical_data_flights = single_flight('historical_data')
 
 # This is the main app that we'll be using for sync and async functions.
 class ibkr_app(EWrapper, EClient):
     def __init__(self):
         EClient.__init__(self, self)
-        self.error_messages = pd.DataFrame(columns=[
-            'reqId', 'errorCode', 'errorString'
-        ])
         self.next_valid_id = None
+        self.request_id_lock = threading.Lock()
+        self.requests = request_router()
+        # keepUpToDate subscriptions (see streaming.py), by reqId. They
+        # outlive historicalDataEnd, so they aren't kept in self.requests.
+        self.streams = {}
+        # reqMktData / reqTickByTickData subscriptions (see market_data.py),
+        # by reqId.
+        self.market_data = {}
+        # Latest status of every order placed on this connection.
+        self.orders = order_status_store()
+        # The latest errors, including the ones that aren't tied to a
+        # request (reqId -1).
+        self.errors = columnar_buffer(error_columns,
+                                      maxlen=max_error_messages)
         self.current_time = None
-        ########################################################################
-        # Here, you'll need to change Line 30 to initialize
-        # self.historical_data as a dataframe having the column names you
-        # want to use. Clearly, you'll want to make sure your colnames match
-        # with what you tell the candlestick figure to expect when you create
-        # it in your app!
-        # I've already done the same general process you need to go through
-        # in the self.error_messages instance variable, so you can use that as
-        # a guide.
-        self.historical_data = pd.DataFrame(
-            columns=['date', 'open', 'high', 'low', 'close', 'volume',
-                     'bar_count', 'average']
-        )
-        self.historical_data_end = None
-        self.contract_details = None
-        self.contract_details_end = None
-        self.matching_symbols = None
-        self.order_status = pd.DataFrame(
-            columns=['orderId', 'status', 'filled', 'remaining', 'avgFillPrice',
-                     'permId', 'parentId', 'lastFillPrice', 'clientId',
-                     'whyHeld', 'mktCapPrice']
-        )
+
+    @property
+    def error_messages(self):
+        return self.errors.to_frame()
 
     def error(self, reqId, errorCode, errorString):
         print("Error: ", reqId, " ", errorCode, " ", errorString)
-        self.error_messages = pd.concat(
-            [self.error_messages, pd.DataFrame({
-                "reqId": [reqId],
-                "errorCode": [errorCode],
-                "errorString": [errorString]
-            })])
+        ib_errors.inc(code=errorCode)
+        self.errors.append(reqId, errorCode, errorString)
+        self.requests.add_error(
+            reqId, errorCode, errorString,
+            fatal=errorCode not in informational_error_codes
+        )
+        if errorCode == client_id_in_use_error:
+            # sent with reqId -1; it's the handshake that failed
+            self.requests.fail('next_valid_id', errorCode, errorString)
+        if errorCode not in informational_error_codes:
+            self.orders.fail(reqId, errorCode, errorString)
+            stream = self.streams.get(reqId)
+            if stream is not None:
+                stream.fail(errorCode, errorString)
+            subscription = self.market_data.get(reqId)
+            if subscription is not None:
+                subscription.fail(errorCode, errorString)
+
+    def connectionClosed(self):
+        self.requests.fail_all(504, "Not connected")
+        self.orders.fail_all(504, "Not connected")
+        for stream in list(self.streams.values()):
+            stream.fail(504, "Not connected")
+        for subscription in list(self.market_data.values()):
+            subscription.fail(504, "Not connected")
 
     def managedAccounts(self, accountsList):
         self.managed_accounts = [i for i in accountsList.split(",") if i]
 
     def nextValidId(self, orderId: int):
-        self.next_valid_id = orderId
+        with self.request_id_lock:
+            self.next_valid_id = orderId
+            self.request_id = orderId
+        self.requests.complete('next_valid_id', orderId)
+
+    # Hands out a fresh id for each request/order made on this connection.
+    def next_request_id(self):
+        with self.request_id_lock:
+            request_id = self.request_id
+            self.request_id += 1
+        return request_id
+
+    # `count` consecutive ids, e.g. for a batch of orders.
+    def next_request_ids(self, count):
+        with self.request_id_lock:
+            first = self.request_id
+            self.request_id += count
+        return list(range(first, first + count))
 
     def currentTime(self, time: int):
         self.current_time = datetime.fromtimestamp(time)
+        self.requests.complete('current_time', self.current_time)
 
     def historicalData(self, reqId, bar):
-        # YOUR CODE GOES HERE: Turn "bar" into a pandas dataframe, formatted
-        #   so that it's accepted by the plotly candlestick function.
-        # Take a look at candlestick_plot.ipynb for some help!
-        # assign the dataframe to self.historical_data.
-        #print(bar)
-        date = bar.date
-        open = bar.open
-        high = bar.high
-        low = bar.low
-        close = bar.close
-        volume = bar.volume
-        average = bar.average
-        barCount = bar.barCount
-        df = pd.DataFrame(data={'date': [date], 'open': [open], 'high': [high], 'low': [low], 'close': [close], 'volume': [volume],
-                           'Average': [average], 'BarCount': [barCount]})
-        self.historical_data = pd.concat([self.historical_data, df])
-       # print(self.historical_data)
+        stream = self.streams.get(reqId)
+        if stream is not None:
+            stream.add_bar(bar)
+            return
+        request = self.requests.get(reqId)
+        if request is not None:
+            if request.first_data is None:
+                request.first_data = time.monotonic()
+            request.buffer.append(
+                bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume,
+                bar.barCount, bar.average
+            )
+
     def contractDetails(self, reqId:int, contractDetails):
-        print(type(contractDetails))
-        print(contractDetails)
-        self.contract_details = contractDetails
+        request = self.requests.get(reqId)
+        if request is not None:
+            request.items.append(contractDetails)
 
     def contractDetailsEnd(self, reqId:int):
-        print("ContractDetailsEnd. ReqId:", reqId)
-        self.contract_details_end = reqId
+        request = self.requests.get(reqId)
+        if request is not None:
+            self.requests.complete(reqId, request.items)
+
+    def historicalDataUpdate(self, reqId: int, bar):
+        stream = self.streams.get(reqId)
+        if stream is not None:
+            stream.update_bar(bar)
+
+    def tickPrice(self, reqId, tickType, price: float, attrib):
+        subscription = self.market_data.get(reqId)
+        if subscription is not None:
+            subscription.on_price(tickType, price)
+
+    def tickSize(self, reqId, tickType, size: int):
+        subscription = self.market_data.get(reqId)
+        if subscription is not None:
+            subscription.on_size(tickType, size)
+
+    def tickByTickAllLast(self, reqId: int, tickType: int, time: int,
+                          price: float, size: int, tickAttribLast,
+                          exchange: str, specialConditions: str):
+        subscription = self.market_data.get(reqId)
+        if subscription is not None:
+            subscription.on_last(time, price, size)
+
+    def tickByTickBidAsk(self, reqId: int, time: int, bidPrice: float,
+                         askPrice: float, bidSize: int, askSize: int,
+                         tickAttribBidAsk):
+        subscription = self.market_data.get(reqId)
+        if subscription is not None:
+            subscription.on_bid_ask(time, bidPrice, askPrice, bidSize,
+                                    askSize)
+
+    def tickByTickMidPoint(self, reqId: int, time: int, midPoint: float):
+        subscription = self.market_data.get(reqId)
+        if subscription is not None:
+            subscription.on_midpoint(time, midPoint)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
-        # super().historicalDataEnd(reqId, start, end)
-        #print("HistoricalDataEnd. ReqId:", reqId, "from", start, "to", end)
-        self.historical_data_end = reqId
+        stream = self.streams.get(reqId)
+        if stream is not None:
+            stream.end()
+            return
+        request = self.requests.get(reqId)
+        if request is None:
+            return
+        # Bars were collected column by column as they arrived; the frame is
+        # built once, here.
+        historical_data = request.buffer.to_frame()
+        historical_data['date'] = parse_bar_dates(historical_data['date'])
+        self.requests.complete(reqId, historical_data)
 
     def orderStatus(self, orderId, status: str, filled: float,
                     remaining: float, avgFillPrice: float, permId: int,
                     parentId: int, lastFillPrice: float, clientId: int,
                     whyHeld: str, mktCapPrice: float):
-        print('order status')
-        # print('orderId:' + str(orderId))
-        # print('status:' + status)
-        # print('filled:' + str(filled))
-        # print('remaining:' + str(remaining))
-        # print('avgFillPrice:' + str(avgFillPrice))
-        # print('permId:' + str(permId))
-        # print('parentId:' + str(parentId))
-        # print('lastFillPrice:' + str(lastFillPrice))
-        # print('clientId:' + str(clientId))
-        # print('whyHeld:' + str(69))
-        # print('mktCapPrice:' + str(mktCapPrice))
-
-        print(self.order_status)
-        print(type(self.order_status))
-        self.order_status = pd.concat(
-            [
-                self.order_status,
-                pd.DataFrame({
-                    'order_id': [orderId],
-                    'status': [status],
-                    'filled': [filled],
-                    'remaining': [remaining],
-                    'avg_fill_price': [avgFillPrice],
-                    'perm_id': [permId],
-                    'parent_id': [parentId],
-                    'last_fill_price': [lastFillPrice],
-                    'client_id': [clientId],
-                    'why_held': [whyHeld],
-                    'mkt_cap_price': [mktCapPrice],
-                    'timestamp':['']
-                })
-            ],
-            ignore_index=True
+        self.orders.update(
+            orderId, status, filled, remaining, avgFillPrice, permId,
+            parentId, lastFillPrice, clientId, whyHeld, mktCapPrice
         )
-        self.order_status.drop_duplicates(inplace=True)
 
     def openOrder(self, orderId, contract, order, orderState):
         print('open order')
@@ -144,185 +227,372 @@ class ibkr_app(EWrapper, EClient):
     def openOrderEnd(self):
         print('open order end')
 
+    # The start_* methods send a request and return (id, request_state)
+    # without waiting, so the sync and async fetch functions can share them.
+    def start_contract_details(self, contract):
+        tickerId = self.next_request_id()
+        done = self.requests.expect(tickerId, 'contract_details')
+        self.reqContractDetails(tickerId, contract)
+        return tickerId, done
+
+    def start_historical_data(self, contract, endDateTime, durationStr,
+                              barSizeSetting, whatToShow, useRTH):
+        tickerId = self.next_request_id()
+        done = self.requests.expect(tickerId, 'historical_data', bar_columns)
+        self.reqHistoricalData(
+            tickerId, contract, endDateTime, durationStr, barSizeSetting,
+            whatToShow, useRTH, formatDate=1, keepUpToDate=False,
+            chartOptions=[])
+        return tickerId, done
+
+    def start_current_time(self):
+        done, send = self.requests.expect_shared('current_time',
+                                                 'current_time')
+        if send:
+            self.reqCurrentTime()
+        return 'current_time', done
+
+    # done finishes once the order is Submitted or Filled.
+    def start_order(self, contract, order):
+        orderId = self.next_request_id()
+        done = self.orders.expect_status(orderId, ('Submitted', 'Filled'))
+        self.placeOrder(orderId, contract, order)
+        return orderId, done
+
+# Requests sent to IB and not answered yet, by kind, over every pooled
+# connection.
+def in_flight_requests():
+    with_kinds = {}
+    for pool in list(pools.values()):
+        for app in pool.apps():
+            counts = app.requests.in_flight_by_kind()
+            counts['order'] = app.orders.waiting()
+            for kind, count in counts.items():
+                with_kinds[(kind,)] = with_kinds.get((kind,), 0) + count
+    return with_kinds
+
+metrics.gauge('ibkr_requests_in_flight',
+              'Requests sent to IB that are still waiting for an answer',
+              ['request']).set_function(in_flight_requests)
+
+def ibkr_session(hostname=default_hostname, port=default_port,
+                 client_id=default_client_id):
+    return get_pool(ibkr_app, hostname, port, client_id).session(timeout_sec)
+
 def fetch_managed_accounts(hostname=default_hostname, port=default_port,
                            client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(0.01)
-    def run_loop():
-        app.run()
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    while isinstance(app.next_valid_id, type(None)):
-        time.sleep(0.01)
-    app.disconnect()
-    return app.managed_accounts
+    with ibkr_session(hostname, port, client_id) as app:
+        return app.managed_accounts
+
+# Turns a finished contract details request into (contract_details, errmsg)
+# and remembers the answer in contract_cache. Only "no security definition"
+# (error 200) is cached as a negative result; other errors may be transient.
+def contract_details_result(done, key):
+    if done.error is not None:
+        print(done.errors)
+        if done.error[0] == 200:
+            contract_cache.put(key, (None, done.error[1]), negative=True)
+        return None, done.error[1]
+    if not done.result:
+        return None, 'No contract details returned'
+    result = done.result[-1], None
+    contract_cache.put(key, result)
+    return result
 
 def fetch_contract_details(contract, hostname=default_hostname,
-                          port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(0.01)
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    while isinstance(app.next_valid_id, type(None)):
-        time.sleep(0.01)
-    tickerId = app.next_valid_id
-    app.reqContractDetails(tickerId, contract)
-    while app.contract_details_end != tickerId:
-        time.sleep(0.01)
-        if app.error_messages.iloc[-1]['errorCode'] == 200:
-            print(app.error_messages)
-            app.disconnect()
-            return None, app.error_messages.iloc[-1]['errorString']
-    app.disconnect()
-    return app.contract_details, None
-
-def fetch_historical_data(contract, endDateTime='', durationStr='30 D',
-                          barSizeSetting='1 hour', whatToShow='MIDPOINT',
-                          useRTH=True, hostname=default_hostname,
-                          port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(0.01)
-    def run_loop():
-        app.run()
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    while isinstance(app.next_valid_id, type(None)):
-        time.sleep(0.01)
-    tickerId = app.next_valid_id
-    app.reqHistoricalData(
-        tickerId, contract, endDateTime, durationStr, barSizeSetting,
-        whatToShow, useRTH, formatDate=1, keepUpToDate=False, chartOptions=[])
-    while app.historical_data_end != tickerId:
-        time.sleep(0.01)
-    app.disconnect()
-    return app.historical_data
-
-def fetch_current_time(hostname=default_hostname,
-                       port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, int(port), int(client_id))
-    start_time = datetime.now()
-    while not app.isConnected():
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
+                          port=default_port, client_id=default_client_id,
+                          use_cache=True):
+    key = contract_key(contract)
+    if use_cache:
+        cached = contract_cache.get(key)
+        if cached is not None:
+            return cached
+    return contract_details_flights.do(
+        (key, hostname, port), request_contract_details, contract, key,
+        hostname, port, client_id)
+
+# One reqContractDetails round trip.
+def request_contract_details(contract, key, hostname, port, client_id):
+    with ibkr_session(hostname, port, client_id) as app:
+        tickerId, done = app.start_contract_details(contract)
+        if not done.wait(timeout_sec):
+            app.requests.discard(tickerId)
             raise Exception(
-                "fetch_current_time",
+                "fetch_contract_details",
                 "timeout",
-                "couldn't connect to IBKR"
+                "contract_details not received"
             )
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    start_time = datetime.now()
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
+    return contract_details_result(done, key)
+
+# Bars already fetched are kept in a local SQLite store (see bar_store.py)
+# and only the ranges of the requested window that aren't in it yet are asked
+# from IB. Pass use_cache=False to always go straight to IB.
+# With backfill=True, ranges longer than IB serves in one request for
+# barSizeSetting are fetched as several windows in parallel (see
+# backfill.py); on_progress(windows_done, windows_total) reports progress.
+# Only the newest window is requested at `priority`; the older ones wait for
+# pacing at batch_priority.
+# Windows that finished before a failure are kept in the store, so calling
+# again resumes where the last call stopped.
+# If the store already holds finer bars covering the whole window (say 5 min
+# bars, when 1 hour bars are asked for), the bars are built from those
+# locally instead (see resample.py).
+def fetch_historical_data(contract, endDateTime='', durationStr='30 D',
+                          barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                          useRTH=True, hostname=default_hostname,
+                          port=default_port, client_id=default_client_id,
+                          use_cache=True,
+                          bar_store_path=default_bar_store_path,
+                          priority=interactive_priority, backfill=False,
+                          on_progress=None, is_cancelled=None):
+    def fetch_window(contract, endDateTime, durationStr, barSizeSetting,
+                     whatToShow, useRTH, priority=priority):
+        try:
+            return fetch_historical_window(
+                contract, endDateTime, durationStr, barSizeSetting,
+                whatToShow, useRTH, hostname, port, client_id, priority)
+        except Exception as e:
+            # A window over a weekend or holiday legitimately has no bars.
+            if 'returned no data' not in str(e.args[-1]):
+                raise
+            return pd.DataFrame(columns=bar_columns)
+
+    end = parse_end_date_time(endDateTime)
+    start = end - parse_duration(durationStr)
+    if not use_cache or whatToShow == 'SCHEDULE':
+        if backfill and end - start > max_window(barSizeSetting):
+            return backfill_job(
+                fetch_window, contract, start, end, barSizeSetting,
+                whatToShow, useRTH, priority=priority, on_progress=on_progress,
+                is_cancelled=is_cancelled).run()
+        return fetch_historical_window(
+            contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+            useRTH, hostname, port, client_id, priority)
+
+    store = get_bar_store(bar_store_path)
+    series = store.series_key(contract, barSizeSetting, whatToShow, useRTH)
+    settled = settled_until(barSizeSetting)
+    missing = store.missing_ranges(series, start, end,
+                                   bar_size_delta(barSizeSetting), settled)
+    if missing:
+        resampled = resample_from_store(store, contract, start, end,
+                                        barSizeSetting, whatToShow, useRTH)
+        if resampled is not None:
+            cache_lookups.inc(cache='historical_bars', result='resampled')
+            return resampled
+    cache_lookups.inc(cache='historical_bars',
+                      result='miss' if missing else 'hit')
+    for gap_start, gap_end in missing:
+        # only the newest bars are what the caller is waiting to see; older
+        # gaps are filled at batch priority
+        gap_priority = priority if gap_end == missing[-1][1] \
+            else max(priority, batch_priority)
+        if backfill and gap_end - gap_start > max_window(barSizeSetting):
+            backfill_job(
+                fetch_window, contract, gap_start, gap_end, barSizeSetting,
+                whatToShow, useRTH, priority=gap_priority,
+                on_window=lambda window_start, window_end, bars: store.write(
+                    series, bars, window_start, window_end, settled),
+                on_progress=on_progress, is_cancelled=is_cancelled).run()
+            continue
+        bars = fetch_window(
+            contract, format_end_date_time(gap_end),
+            duration_for(gap_end - gap_start, barSizeSetting), barSizeSetting,
+            whatToShow, useRTH, gap_priority)
+        store.write(series, bars, gap_start, gap_end, settled)
+    return store.read(series, start, end)
+
+# fetch_historical_data without IB: only what the local bar store already
+# holds for the window (bars built from finer stored bars if that covers
+# all of it), possibly nothing. For redrawing a chart that was fetched
+# before, where asking IB again isn't worth the wait.
+def read_stored_historical_data(contract, endDateTime='', durationStr='30 D',
+                                barSizeSetting='1 hour',
+                                whatToShow='MIDPOINT', useRTH=True,
+                                bar_store_path=default_bar_store_path):
+    end = parse_end_date_time(endDateTime)
+    start = end - parse_duration(durationStr)
+    store = get_bar_store(bar_store_path)
+    series = store.series_key(contract, barSizeSetting, whatToShow, useRTH)
+    if store.missing_ranges(series, start, end,
+                            bar_size_delta(barSizeSetting),
+                            settled_until(barSizeSetting)):
+        resampled = resample_from_store(store, contract, start, end,
+                                        barSizeSetting, whatToShow, useRTH)
+        if resampled is not None:
+            return resampled
+    return store.read(series, start, end)
+
+# Bars from here on may still be forming, so the store never counts them as
+# fetched: the start of the bar the current time falls in, or for daily and
+# longer bars (whose sessions don't follow the clock) one bar before now.
+def settled_until(barSizeSetting):
+    now = pd.Timestamp.now().floor('s')
+    size = bar_size_delta(barSizeSetting)
+    if size < timedelta(days=1):
+        return now.floor(size)
+    return now - size
+
+# Bars of barSizeSetting for [start, end] built from a finer bar size whose
+# bars the store holds for the whole window, or None if there's none. If the
+# store also has the finer bars from the start of the bar that `start` falls
+# in, that bar is complete and included; otherwise it's left out rather than
+# returned with only part of its range.
+def resample_from_store(store, contract, start, end, barSizeSetting,
+                        whatToShow, useRTH):
+    start = pd.Timestamp(start)
+    # a trading day can start the evening before (FX)
+    lead = max(bar_size_delta(barSizeSetting), bar_size_delta('1 day'))
+    for source_bar_size in finer_bar_sizes(barSizeSetting):
+        source = store.series_key(contract, source_bar_size, whatToShow,
+                                  useRTH)
+        step = bar_size_delta(source_bar_size)
+        settled = settled_until(source_bar_size)
+        if store.missing_ranges(source, start, end, step, settled):
+            continue
+        bars = resample_bars(store.read(source, start - lead, end),
+                             barSizeSetting, source_bar_size)
+        dates = bars['date'].values
+        first = np.searchsorted(dates, start.to_datetime64(), side='right')
+        if first and not store.missing_ranges(source, bars['date'][first - 1],
+                                              start, step, settled):
+            first -= 1
+        return bars.iloc[first:].reset_index(drop=True)
+    return None
+
+# Keys the pacing scheduler uses for IB's "identical request" and "same
+# contract/exchange/tick type" rules.
+def historical_pacing_keys(contract, endDateTime, durationStr, barSizeSetting,
+                           whatToShow, useRTH):
+    same_contract = (contract_key(contract), whatToShow)
+    identical = same_contract + (endDateTime, durationStr, barSizeSetting,
+                                 str(useRTH))
+    return identical, same_contract
+
+# One reqHistoricalData round trip, no caching. Waits its turn in the pacing
+# scheduler first, so it never trips IB's pacing limits by itself. A call
+# identical to one already in flight waits for that one's bars instead of
+# asking again (which pacing would hold back for 15 s anyway).
+def fetch_historical_window(contract, endDateTime='', durationStr='30 D',
+                            barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                            useRTH=True, hostname=default_hostname,
+                            port=default_port, client_id=default_client_id,
+                            priority=interactive_priority):
+    identical, same_contract = historical_pacing_keys(
+        contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+        useRTH)
+    return historical_data_flights.do(
+        identical + (hostname, port), request_historical_window, contract,
+        endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+        hostname, port, client_id, priority)
+
+def request_historical_window(contract, endDateTime, durationStr,
+                              barSizeSetting, whatToShow, useRTH, hostname,
+                              port, client_id, priority):
+    historical_scheduler.acquire(
+        *historical_pacing_keys(contract, endDateTime, durationStr,
+                                barSizeSetting, whatToShow, useRTH),
+        priority=priority)
+    with ibkr_session(hostname, port, client_id) as app:
+        tickerId, done = app.start_historical_data(
+            contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+            useRTH)
+        if not done.wait(historical_timeout_sec):
+            app.requests.discard(tickerId)
+            app.cancelHistoricalData(tickerId)
             raise Exception(
-                "fetch_current_time",
+                "fetch_historical_data",
                 "timeout",
-                "next_valid_id not received"
+                "historical_data not received"
             )
+        if done.error is not None:
+            if 'pacing violation' in done.error[1].lower():
+                historical_scheduler.report_violation()
+            raise Exception("fetch_historical_data", "error", done.error[1])
+        return done.result
 
-    app.reqCurrentTime()
-    start_time = datetime.now()
-    while app.current_time is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
+def fetch_current_time(hostname=default_hostname,
+                       port=default_port, client_id=default_client_id):
+    with ibkr_session(hostname, port, client_id) as app:
+        key, done = app.start_current_time()
+        if not done.wait(timeout_sec):
+            app.requests.discard(key)
             raise Exception(
                 "fetch_current_time",
                 "timeout",
                 "current_time not received"
             )
-    app.disconnect()
-    return app.current_time
+        if done.error is not None:
+            raise Exception("fetch_current_time", "error", done.error[1])
+        return done.result
 
 def place_order(contract, order, hostname=default_hostname,
                            port=default_port, client_id=default_client_id):
-
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(0.01)
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-
-    app.placeOrder(app.next_valid_id, contract, order)
-    while not (('Submitted' in set(app.order_status['status']) or ('Filled' in set(app.order_status['status'])))):
-        time.sleep(0.25)
-
-    app.disconnect()
-
-    return app.order_status
-
-def fetch_contract_details_new(contract, hostname=default_hostname,
-                           port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, int(port), int(client_id))
-    start_time = datetime.now()
-    while not app.isConnected():
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_contract_details",
-                "timeout",
-                "couldn't connect to IBKR"
-            )
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    start_time = datetime.now()
-    while app.next_valid_id is None:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
-            raise Exception(
-                "fetch_contract_details",
-                "timeout",
-                "next_valid_id not received"
-            )
-
-    tickerId = app.next_valid_id
-    app.reqContractDetails(tickerId, contract)
-
-    start_time = datetime.now()
-    while app.contract_details_end != tickerId:
-        time.sleep(0.01)
-        if (datetime.now() - start_time).seconds > timeout_sec:
-            app.disconnect()
+    with ibkr_session(hostname, port, client_id) as app:
+        orderId, done = app.start_order(contract, order)
+        if not done.wait(order_timeout_sec):
+            app.orders.forget(orderId, done)
             raise Exception(
-                "fetch_contract_details",
+                "place_order",
                 "timeout",
-                "contract_details not received"
+                "order was not Submitted or Filled"
             )
+        if done.error is not None:
+            raise Exception("place_order", "error", done.error[1])
+        return app.orders.frame([orderId])
+
+# Places many orders over one connection: consecutive order ids are taken
+# from the connection's nextValidId, every placeOrder is sent before waiting
+# on any of them, and the acknowledgements are awaited together.
+# contracts_and_orders is a list of (contract, order) pairs. If accounts is
+# given (FA accounts), every order is placed once in each of those accounts.
+# Returns one row per order: its order_id, account, error (None if it was
+# Submitted or Filled) and latest status columns.
+def place_orders(contracts_and_orders, accounts=None,
+                 hostname=default_hostname, port=default_port,
+                 client_id=default_client_id):
+    if accounts:
+        fanned_out = []
+        for contract, order in contracts_and_orders:
+            for account in accounts:
+                account_order = copy.copy(order)
+                account_order.account = account
+                fanned_out.append((contract, account_order))
+        contracts_and_orders = fanned_out
+
+    with ibkr_session(hostname, port, client_id) as app:
+        order_ids = app.next_request_ids(len(contracts_and_orders))
+        waits = []
+        for orderId, (contract, order) in zip(order_ids,
+                                              contracts_and_orders):
+            waits.append(app.orders.expect_status(
+                orderId, ('Submitted', 'Filled')))
+            app.placeOrder(orderId, contract, order)
+
+        deadline = time.monotonic() + order_timeout_sec
+        errors = []
+        for orderId, done in zip(order_ids, waits):
+            if not done.wait(max(deadline - time.monotonic(), 0)):
+                app.orders.forget(orderId, done)
+                errors.append('order was not Submitted or Filled')
+            elif done.error is not None:
+                errors.append(done.error[1])
+            else:
+                errors.append(None)
+        statuses = app.orders.frame(order_ids)
+
+    results = pd.DataFrame({
+        'order_id': order_ids,
+        'account': [order.account for contract, order in
+                    contracts_and_orders],
+        'error': errors
+    })
+    return results.merge(statuses, on='order_id', how='left')
 
-    app.disconnect()
-
-    return app.contract_details
-
+def fetch_contract_details_new(contract, hostname=default_hostname,
+                           port=default_port, client_id=default_client_id):
+    contract_details, errmsg = fetch_contract_details(
+        contract, hostname, port, client_id)
+    if errmsg is not None:
+        raise Exception("fetch_contract_details", "error", errmsg)
+    return contract_details
@@ -1,5 +1,61 @@
 # Serve app on a local port via waitress
+#   python server.py              one process
+#   python server.py --workers 4  four worker processes sharing the port, with
+#                                 IB calls made by one gateway process
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+
 from waitress import serve
-import app
 
-serve(app.server, host='localhost', port=3001)
+host = 'localhost'
+port = 3001
+
+
+def serve_worker(sock):
+    import app
+    serve(app.server, sockets=[sock])
+
+
+def worker_count():
+    if '--workers' in sys.argv:
+        return int(sys.argv[sys.argv.index('--workers') + 1])
+    return int(os.environ.get('HW3_WORKERS', 1))
+
+
+if __name__ == '__main__':
+    workers = worker_count()
+    if workers <= 1:
+        import app
+        serve(app.server, host=host, port=port)
+    else:
+        from fintech_ibkr.jobs import job_store_variable
+
+        # Set before anything else is imported or started, so the gateway and
+        # every worker see it.
+        os.environ[job_store_variable] = os.path.join(
+            tempfile.gettempdir(), 'hw3_jobs_' + str(os.getpid()) + '.sqlite')
+        from fintech_ibkr.gateway import start_gateway
+
+        gateway = start_gateway()
+
+        # Every worker accepts connections on the same listening socket.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(1024)
+        processes = [
+            multiprocessing.Process(target=serve_worker, args=(sock,))
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                process.terminate()
+            gateway.shutdown()
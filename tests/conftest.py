@@ -0,0 +1,38 @@
+import sys
+
+import pytest
+from ibapi.contract import Contract
+
+from fintech_ibkr import bar_store, pacing
+from fintech_ibkr.connection_pool import close_all_pools, pools
+from fintech_ibkr.contract_cache import contract_cache
+from fintech_ibkr.simulator import ib_simulator, simulator_settings
+
+
+def fx_contract(symbol='EUR', currency='USD'):
+    contract = Contract()
+    contract.symbol = symbol
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = currency
+    return contract
+
+
+# The local IB simulator, with pacing relaxed the way the benchmarks relax
+# it: tests are about our side of the socket, not IB's rate limits.
+@pytest.fixture
+def simulator(monkeypatch, tmp_path):
+    # the bar store, order journal and job store go in the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bar_store, 'bar_stores', {})
+    monkeypatch.setattr(pacing, 'identical_request_sec', 0)
+    monkeypatch.setattr(pacing, 'same_contract_requests', sys.maxsize)
+    monkeypatch.setattr(pacing.historical_scheduler, 'max_requests',
+                        sys.maxsize)
+    server = ib_simulator(port=0, settings=simulator_settings(
+        pacing_limit=None, fill_delay_sec=0.0)).start()
+    yield server
+    close_all_pools()
+    pools.clear()
+    contract_cache.clear()
+    server.stop()
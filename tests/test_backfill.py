@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+import pandas as pd
+
+from fintech_ibkr import synchronous_functions
+from fintech_ibkr.backfill import backfill_job
+from fintech_ibkr.pacing import interactive_priority, batch_priority
+from fintech_ibkr.synchronous_functions import fetch_historical_data
+
+from conftest import fx_contract
+
+
+def test_only_the_newest_window_keeps_the_callers_priority():
+    priorities = {}
+
+    def fetch_window(contract, endDateTime, durationStr, barSizeSetting,
+                     whatToShow, useRTH, priority):
+        priorities[endDateTime] = priority
+        return pd.DataFrame(columns=['date'])
+
+    end = pd.Timestamp('2024-01-05 12:00:00')
+    job = backfill_job(fetch_window, fx_contract(), end - timedelta(days=3),
+                       end, '1 min', 'MIDPOINT', True,
+                       priority=interactive_priority)
+    job.run()
+    assert len(priorities) == 3
+    assert priorities.pop('20240105 12:00:00') == interactive_priority
+    assert set(priorities.values()) == {batch_priority}
+
+
+# Like the chart job: the newest window of the newest gap is what the chart
+# shows first, so only it goes at interactive priority.
+def test_older_gaps_and_windows_are_fetched_at_batch_priority(simulator,
+                                                              monkeypatch):
+    fetch_historical_data(fx_contract(), '20240104 12:00:00', '1 D', '1 min',
+                          port=simulator.port)
+    priorities = {}
+    fetch_window = synchronous_functions.fetch_historical_window
+
+    def recording_fetch_window(contract, endDateTime, durationStr,
+                               barSizeSetting, whatToShow, useRTH, hostname,
+                               port, client_id, priority):
+        priorities[endDateTime] = priority
+        return fetch_window(contract, endDateTime, durationStr,
+                            barSizeSetting, whatToShow, useRTH, hostname,
+                            port, client_id, priority)
+
+    monkeypatch.setattr(synchronous_functions, 'fetch_historical_window',
+                        recording_fetch_window)
+    bars = fetch_historical_data(fx_contract(), '20240108 12:00:00', '6 D',
+                                 '1 min', port=simulator.port,
+                                 priority=interactive_priority,
+                                 backfill=True)
+    assert bars['date'].is_monotonic_increasing
+    assert priorities.pop('20240108 12:00:00') == interactive_priority
+    assert len(priorities) > 1
+    assert set(priorities.values()) == {batch_priority}
@@ -0,0 +1,90 @@
+from datetime import timedelta
+
+import pandas as pd
+
+from fintech_ibkr import synchronous_functions
+from fintech_ibkr.bar_store import bar_store
+from fintech_ibkr.synchronous_functions import fetch_historical_data, \
+    read_stored_historical_data
+
+from conftest import fx_contract
+
+hour = timedelta(hours=1)
+
+
+def bars_at(*times):
+    dates = pd.to_datetime(list(times))
+    return pd.DataFrame({'date': dates, 'open': 1.0, 'high': 1.0, 'low': 1.0,
+                         'close': 1.0, 'volume': -1, 'bar_count': -1,
+                         'average': 1.0})
+
+
+def at(text):
+    return pd.Timestamp('2024-01-05 ' + text)
+
+
+def test_missing_ranges_skips_gaps_shorter_than_a_bar(tmp_path):
+    store = bar_store(str(tmp_path / 'bars.sqlite'))
+    store.write('s', bars_at(at('09:00')), at('09:00'), at('10:00'))
+    store.write('s', bars_at(at('12:00')), at('12:00'), at('13:00'))
+    assert store.missing_ranges('s', at('08:00'), at('14:00'), hour) == [
+        (at('08:00'), at('09:00')), (at('10:00'), at('12:00')),
+        (at('13:00'), at('14:00'))]
+    assert store.missing_ranges('s', at('09:00'), at('10:30'), hour) == []
+
+
+def test_missing_ranges_always_refetches_after_settled(tmp_path):
+    store = bar_store(str(tmp_path / 'bars.sqlite'))
+    store.write('s', bars_at(at('09:00'), at('10:00')), at('09:00'),
+                at('10:30'), settled=at('10:00'))
+    assert store.coverage('s') == [(at('09:00'), at('10:00'))]
+    # 10:00 to 10:40 is less than a bar, but the 10:00 bar was forming
+    assert store.missing_ranges('s', at('09:00'), at('10:40'), hour,
+                                at('10:00')) == [(at('10:00'), at('10:40'))]
+    # coverage written before settled was taken into account is cut back
+    store.write('s', bars_at(at('10:00')), at('10:00'), at('10:30'))
+    assert store.missing_ranges('s', at('09:00'), at('10:40'), hour,
+                                at('10:00')) == [(at('10:00'), at('10:40'))]
+
+
+# 1 hour bars fetched at 10:30 and the chart reloaded at 11:10: the reload
+# has to ask IB again and come back with the 11:00 bar.
+def test_reload_refetches_the_forming_bar(simulator, monkeypatch):
+    contract = fx_contract()
+    monkeypatch.setattr(synchronous_functions, 'settled_until',
+                        lambda barSizeSetting: at('10:00'))
+    first = fetch_historical_data(contract, '20240105 10:30:00', '1 D',
+                                  '1 hour', port=simulator.port)
+    assert first['date'].iloc[-1] == at('10:00')
+    assert simulator.stats['req_historical_data'] == 1
+
+    monkeypatch.setattr(synchronous_functions, 'settled_until',
+                        lambda barSizeSetting: at('11:00'))
+    second = fetch_historical_data(contract, '20240105 11:10:00', '1 D',
+                                   '1 hour', port=simulator.port)
+    assert second['date'].iloc[-1] == at('11:00')
+    assert simulator.stats['req_historical_data'] == 2
+
+
+def test_settled_history_comes_from_the_store(simulator):
+    contract = fx_contract()
+    first = fetch_historical_data(contract, '20240105 10:30:00', '1 D',
+                                  '1 hour', port=simulator.port)
+    second = fetch_historical_data(contract, '20240105 10:30:00', '1 D',
+                                   '1 hour', port=simulator.port)
+    pd.testing.assert_frame_equal(first, second)
+    assert simulator.stats['req_historical_data'] == 1
+
+
+def test_stored_bars_are_read_without_asking_ib(simulator):
+    fetched = fetch_historical_data(fx_contract(), '20240105 12:00:00', '2 D',
+                                    '1 hour', port=simulator.port)
+    simulator.stop()
+    stored = read_stored_historical_data(fx_contract(), '20240105 12:00:00',
+                                         '2 D', '1 hour')
+    pd.testing.assert_frame_equal(stored, fetched)
+    # bars built from finer ones the store holds
+    assert len(read_stored_historical_data(
+        fx_contract(), '20240105 12:00:00', '1 D', '4 hours')) == 7
+    assert read_stored_historical_data(fx_contract(), '20240110 12:00:00',
+                                       '2 D', '1 hour').empty
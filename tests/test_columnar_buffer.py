@@ -0,0 +1,14 @@
+from fintech_ibkr.synchronous_functions import ibkr_app, error_columns, \
+    max_error_messages
+
+
+def test_error_messages_keep_only_the_latest_errors():
+    app = ibkr_app()
+    for i in range(max_error_messages + 10):
+        app.error(-1, 2104, 'Market data farm connection is OK ' + str(i))
+    errors = app.error_messages
+    assert list(errors.columns) == error_columns
+    assert len(errors) == max_error_messages
+    assert errors['errorString'].iloc[0].endswith(' 10')
+    assert errors['errorString'].iloc[-1].endswith(
+        ' ' + str(max_error_messages + 9))
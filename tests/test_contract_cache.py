@@ -0,0 +1,50 @@
+import time
+
+from fintech_ibkr.contract_cache import contract_details_cache, \
+    contract_cache
+from fintech_ibkr.synchronous_functions import fetch_contract_details
+
+from conftest import fx_contract
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = contract_details_cache(size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire():
+    cache = contract_details_cache(ttl=60, negative_ttl=0.05)
+    cache.put('found', 1)
+    cache.put('not found', 2, negative=True)
+    time.sleep(0.1)
+    assert cache.get('found') == 1
+    assert cache.get('not found') is None
+    assert cache.stats()['size'] == 1
+
+
+def test_lookups_are_answered_from_the_cache(simulator):
+    details, errmsg = fetch_contract_details(fx_contract(),
+                                             port=simulator.port)
+    assert errmsg is None
+    # with IB gone, only the cache can answer
+    simulator.stop()
+    hits = contract_cache.stats()['hits']
+    assert fetch_contract_details(fx_contract(), port=simulator.port)[0] \
+        .contract.conId == details.contract.conId
+    assert contract_cache.stats()['hits'] == hits + 1
+
+
+def test_unknown_contracts_are_cached_as_not_found(simulator):
+    details, errmsg = fetch_contract_details(fx_contract('E1R'),
+                                             port=simulator.port)
+    assert details is None
+    assert 'No security definition' in errmsg
+    simulator.stop()
+    assert fetch_contract_details(fx_contract('E1R'), port=simulator.port) \
+        == (None, errmsg)
@@ -0,0 +1,36 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fintech_ibkr.indicators import make_indicator, indicator_from_dict, \
+    compute_indicators, update_indicators
+
+
+def bars(count):
+    close = 1.1 + 0.01 * np.sin(np.arange(count) / 3.0)
+    return pd.DataFrame({
+        'date': pd.date_range('2024-01-02', periods=count, freq='min'),
+        'open': close, 'high': close + 0.001, 'low': close - 0.001,
+        'close': close, 'volume': 100.0, 'bar_count': 1,
+        'average': close})
+
+
+# A live chart computes the history in one batch, keeps the indicators'
+# state in a dcc.Store (JSON) and updates them one bar at a time from there;
+# that has to give the same values as one batch over all the bars.
+@pytest.mark.parametrize('split', [5, 150])
+def test_updates_from_stored_state_match_the_batch(split):
+    history = bars(200)
+    names = ['sma', 'ema', 'bollinger', 'rsi', 'atr', 'vwap']
+    expected = compute_indicators(history,
+                                  [make_indicator(name) for name in names])
+    states = [make_indicator(name) for name in names]
+    compute_indicators(history.iloc[:split], states)
+    states = [indicator_from_dict(json.loads(json.dumps(state.to_dict())))
+              for state in states]
+    updated = update_indicators(history.iloc[split:], states)
+    pd.testing.assert_frame_equal(updated, expected.iloc[split:],
+                                  check_exact=False, atol=1e-9)
+    assert len(states[0].window) == states[0].period
@@ -0,0 +1,71 @@
+import multiprocessing
+import time
+
+from fintech_ibkr import jobs
+
+poll_timeout_sec = 10
+
+
+def slow_answer(job, value):
+    time.sleep(0.2)
+    return value
+
+
+def submit_and_wait(job_ids, collected):
+    job_ids.put(jobs.submit_job('chart', slow_answer, 42))
+    # the job runs in this process's executor, so stay up until the other
+    # worker has collected it
+    collected.wait(poll_timeout_sec)
+
+
+def poll(job_ids, answers, collected):
+    job_id = job_ids.get(timeout=poll_timeout_sec)
+    deadline = time.monotonic() + poll_timeout_sec
+    statuses = []
+    while time.monotonic() < deadline:
+        status = jobs.job_status(job_id)
+        statuses.append(None if status is None else status['status'])
+        if status is not None and status['status'] == jobs.done:
+            break
+        time.sleep(0.05)
+    answers.put((statuses, jobs.job_result(job_id)))
+    collected.set()
+
+
+# Like server.py with --workers: one worker process starts a job and another
+# one polls it. Spawned workers import jobs afresh, before reading the store
+# variable they inherit; fork isn't used, since this process has threads.
+def test_job_started_in_one_worker_is_visible_in_another(tmp_path,
+                                                         monkeypatch):
+    context = multiprocessing.get_context('spawn')
+    monkeypatch.setenv(jobs.job_store_variable,
+                       str(tmp_path / 'jobs.sqlite'))
+    job_ids, answers = context.Queue(), context.Queue()
+    collected = context.Event()
+    workers = [context.Process(target=submit_and_wait,
+                               args=(job_ids, collected)),
+               context.Process(target=poll,
+                               args=(job_ids, answers, collected))]
+    for worker in workers:
+        worker.start()
+    try:
+        statuses, result = answers.get(timeout=2 * poll_timeout_sec)
+    finally:
+        for worker in workers:
+            worker.join(poll_timeout_sec)
+            if worker.is_alive():
+                worker.terminate()
+    assert None not in statuses
+    assert statuses[-1] == jobs.done
+    assert result == 42
+
+
+def test_store_path_is_read_on_first_use(tmp_path, monkeypatch):
+    manager = jobs.job_manager(store_variable=jobs.job_store_variable)
+    monkeypatch.delenv(jobs.job_store_variable, raising=False)
+    assert manager.store is None
+    monkeypatch.setenv(jobs.job_store_variable,
+                       str(tmp_path / 'jobs.sqlite'))
+    assert manager.store is not None
+    assert manager.store.path == str(tmp_path / 'jobs.sqlite')
+
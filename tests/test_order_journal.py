@@ -0,0 +1,73 @@
+import pytest
+from ibapi.order import Order
+
+from fintech_ibkr.order_journal import order_journal
+from fintech_ibkr.synchronous_functions import place_order, \
+    fetch_current_time
+
+from conftest import fx_contract
+
+
+def market_order(action, quantity):
+    order = Order()
+    order.action = action
+    order.orderType = 'MKT'
+    order.totalQuantity = quantity
+    return order
+
+
+# What submit_trade in app.py does for every trade.
+def journal_order(journal, port, symbol, action, size):
+    info = place_order(fx_contract(symbol), market_order(action, size),
+                       port=port)
+    return journal.append(
+        timestamp=fetch_current_time(port=port),
+        order_id=info['order_id'][0], client_id=info['client_id'][0],
+        perm_id=info['perm_id'][0], symbol=symbol, action=action, size=size,
+        order_type='MKT')
+
+
+def test_placed_orders_are_paged_filtered_and_sorted(simulator, tmp_path):
+    journal = order_journal(str(tmp_path / 'orders.sqlite'), csv_path=None)
+    ids = [journal_order(journal, simulator.port, symbol, action, size)
+           for symbol, action, size in [('EUR', 'BUY', 100),
+                                        ('AUD', 'SELL', 300),
+                                        ('EUR', 'SELL', 200)]]
+    assert ids == sorted(ids)
+
+    rows, total = journal.query_page(0, 2)
+    assert total == 3
+    assert [row['symbol'] for row in rows] == ['EUR', 'AUD']
+    assert len({row['order_id'] for row in rows}) == 2
+
+    rows, total = journal.query_page(0, 10, sort_by=[('size', 'desc')],
+                                     filters=[('symbol', '=', 'EUR')])
+    assert total == 2
+    assert [row['size'] for row in rows] == [200, 100]
+
+    rows, total = journal.query_page(1, 2, filters=[('size', '>=', 100)])
+    assert (total, [row['action'] for row in rows]) == (3, ['SELL'])
+
+
+def test_filters_only_accept_journal_columns(tmp_path):
+    journal = order_journal(str(tmp_path / 'orders.sqlite'), csv_path=None)
+    with pytest.raises(Exception):
+        journal.query_page(0, 10, filters=[('size; DROP TABLE orders', '=',
+                                            1)])
+    with pytest.raises(Exception):
+        journal.query_page(0, 10, sort_by=[('id desc', 'asc')])
+
+
+def test_legacy_csv_is_imported_once(tmp_path):
+    csv_path = tmp_path / 'submitted_orders.csv'
+    csv_path.write_text(
+        'timestamp,order_id,client_id,perm_id,con_id,symbol,action,size,'
+        'order_type,lmt_price\n'
+        '2024-01-02 10:00:00,33.0,10645.0,1.0,27313073.0,EUR,BUY,100,MKT,\n')
+    path = str(tmp_path / 'orders.sqlite')
+    order_journal(path, csv_path=str(csv_path))
+    rows, total = order_journal(path, csv_path=str(csv_path)) \
+        .query_page(0, 10)
+    assert total == 1
+    assert rows[0]['order_id'] == 33
+    assert rows[0]['lmt_price'] is None
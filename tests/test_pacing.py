@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+
+from fintech_ibkr import fetch_historical_data_async
+from fintech_ibkr.pacing import historical_request_scheduler, \
+    interactive_priority, batch_priority
+
+from conftest import fx_contract
+
+
+# A chart request made while a backfill's windows are queued goes out as
+# soon as the next token comes back, ahead of all of them.
+def test_interactive_request_overtakes_queued_batch_requests():
+    scheduler = historical_request_scheduler(max_requests=1, window_sec=0.2)
+    scheduler.acquire(('request', 'first'), ('contract', 'first'))
+    order = []
+
+    def request(name, priority):
+        scheduler.acquire(('request', name), ('contract', name),
+                          priority=priority)
+        order.append(name)
+
+    threads = [threading.Thread(target=request,
+                                args=('batch ' + str(i), batch_priority))
+               for i in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=request,
+                                    args=('chart', interactive_priority)))
+    threads[-1].start()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['chart', 'batch 0', 'batch 1', 'batch 2']
+
+
+# More queued requests than the default executor has threads: waiting for
+# pacing must not take any of them, so other executor work still runs.
+def test_async_waiters_dont_hold_executor_threads():
+    scheduler = historical_request_scheduler(max_requests=1, window_sec=0.02)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        threads = threading.active_count()
+        waiters = [asyncio.ensure_future(
+            scheduler.acquire_async(('request', i), ('contract', i)))
+            for i in range(64)]
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        await loop.run_in_executor(None, lambda: None)
+        executor_wait = time.monotonic() - started
+        queued = len(scheduler.waiting)
+        await asyncio.gather(*waiters)
+        return threads, executor_wait, queued
+
+    threads, executor_wait, queued = asyncio.run(main())
+    assert queued > 32
+    assert executor_wait < 0.5
+    assert scheduler.stats()['dispatched'] == 64
+    assert threading.active_count() <= threads + 1
+
+
+def test_cancelled_async_waiter_leaves_the_queue():
+    scheduler = historical_request_scheduler(max_requests=1, window_sec=60)
+    scheduler.acquire(('request', 0), ('contract', 0))
+
+    async def main():
+        waiter = asyncio.ensure_future(
+            scheduler.acquire_async(('request', 1), ('contract', 1)))
+        await asyncio.sleep(0.05)
+        assert len(scheduler.waiting) == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(main())
+    assert scheduler.waiting == []
+
+
+def test_fetch_historical_data_async(simulator):
+    async def main():
+        return await asyncio.gather(*[
+            fetch_historical_data_async(
+                fx_contract(), '20240105 12:00:00', str(days) + ' D',
+                '1 hour', port=simulator.port)
+            for days in [1, 2, 3]])
+
+    frames = asyncio.run(main())
+    assert [len(frame) for frame in frames] == [25, 49, 73]
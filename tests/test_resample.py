@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from fintech_ibkr.resample import resample_bars, downsample_bars
+from fintech_ibkr.synchronous_functions import fetch_historical_data
+
+from conftest import fx_contract
+
+
+def test_minute_bars_add_up_to_five_minute_bars(simulator):
+    minutes = fetch_historical_data(fx_contract(), '20240105 12:00:00',
+                                    '3600 S', '1 min', port=simulator.port)
+    bars = resample_bars(minutes, '5 mins', '1 min')
+    assert len(bars) == -(-len(minutes) // 5)
+    assert (bars['date'].dt.minute % 5 == 0).all()
+    first = minutes[minutes['date'] < bars['date'][1]]
+    assert bars['open'][0] == first['open'].iloc[0]
+    assert bars['high'][0] == first['high'].max()
+    assert bars['low'][0] == first['low'].min()
+    assert bars['close'][0] == first['close'].iloc[-1]
+
+
+# Once minute bars are stored, hour bars over the same days are built from
+# them without asking IB.
+def test_coarser_bars_are_built_from_stored_finer_ones(simulator):
+    minutes = fetch_historical_data(fx_contract(), '20240105 12:00:00',
+                                    '2 D', '1 min', port=simulator.port)
+    simulator.stop()
+    hours = fetch_historical_data(fx_contract(), '20240105 12:00:00', '1 D',
+                                  '1 hour', port=simulator.port)
+    assert len(hours) == 25
+    for start, bar in zip(hours['date'], hours.itertuples()):
+        hour = minutes[(minutes['date'] >= start) &
+                       (minutes['date'] < start + pd.Timedelta(hours=1))]
+        assert (bar.open, bar.close) == (hour['open'].iloc[0],
+                                         hour['close'].iloc[-1])
+
+
+def test_downsampled_bars_keep_the_extremes():
+    count = 1000
+    close = np.sin(np.arange(count) / 10.0)
+    bars = pd.DataFrame({
+        'date': pd.date_range('2024-01-02', periods=count, freq='min'),
+        'open': close, 'high': close + 0.5, 'low': close - 0.5,
+        'close': close, 'volume': -1.0, 'bar_count': -1.0, 'average': close})
+    drawn = downsample_bars(bars, 300)
+    assert len(drawn) <= 300
+    assert drawn['high'].max() == bars['high'].max()
+    assert drawn['low'].min() == bars['low'].min()
+    assert drawn['date'][0] == bars['date'][0]
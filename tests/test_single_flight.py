@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from fintech_ibkr import synchronous_functions
+from fintech_ibkr.single_flight import single_flight
+from fintech_ibkr.synchronous_functions import fetch_contract_details
+
+from conftest import fx_contract
+
+
+def call_together(count, fn):
+    results = [None] * count
+    start = threading.Barrier(count)
+
+    def call(i):
+        start.wait()
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_overlapping_calls_run_once_and_share_copies_of_the_result():
+    flights = single_flight('test')
+    calls = []
+
+    def slow_list():
+        calls.append(1)
+        time.sleep(0.2)
+        return [1, 2, 3]
+
+    results = call_together(8, lambda: flights.do('key', slow_list))
+    assert len(calls) == 1
+    assert all(result == [1, 2, 3] for result in results)
+    assert len({id(result) for result in results}) == 8
+    assert flights.in_flight() == 0
+    # finished calls aren't remembered
+    assert flights.do('key', slow_list) == [1, 2, 3]
+    assert len(calls) == 2
+
+
+def test_waiters_get_the_leaders_exception():
+    flights = single_flight('test')
+
+    def slow_failure():
+        time.sleep(0.2)
+        raise Exception("slow_failure", "error", "failed")
+
+    results = call_together(4, lambda: flights.do('key', slow_failure))
+    assert [result.args[-1] for result in results] == ['failed'] * 4
+    assert flights.in_flight() == 0
+    with pytest.raises(Exception):
+        flights.do('key', slow_failure)
+
+
+# A double click on the trade form: both lookups are answered by one
+# reqContractDetails.
+def test_identical_contract_lookups_reach_ib_once(simulator, monkeypatch):
+    requests = []
+    request_contract_details = synchronous_functions.request_contract_details
+
+    def counting_request(*args):
+        requests.append(args)
+        time.sleep(0.2)
+        return request_contract_details(*args)
+
+    monkeypatch.setattr(synchronous_functions, 'request_contract_details',
+                        counting_request)
+    results = call_together(4, lambda: fetch_contract_details(
+        fx_contract(), port=simulator.port, use_cache=False))
+    assert len(requests) == 1
+    assert [details.contract.symbol for details, errmsg in results] == \
+        ['EUR'] * 4